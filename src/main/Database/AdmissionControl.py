@@ -0,0 +1,188 @@
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, make_response, request
+
+
+# endpoint -> (priority, concurrency limit); lower priority numbers are served first
+DEFAULT_LIMITS = {
+    "main.checkout": (0, 8),
+    "main.confirmation": (0, 8),
+    "main.cancel_order": (0, 4),
+    "main.batch_orders": (0, 2),
+    "main.menu": (1, 12),
+    "main.add_to_basket": (1, 12),
+    "main.remove_from_basket": (1, 12),
+    "main.build_pizza": (1, 12),
+    "main.staff_reports": (2, 2),
+}
+
+# seconds a request may wait for a slot before it is shed, per priority
+DEFAULT_MAX_WAIT = {0: 5.0, 1: 1.0, 2: 0.5}
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "endpoint", "admitted", "shed")
+
+    def __init__(self, priority, seq, endpoint):
+        self.priority = priority
+        self.seq = seq
+        self.endpoint = endpoint
+        self.admitted = False
+        self.shed = False
+
+
+class AdmissionController:
+    """Concurrency limits with a bounded priority queue in front of the blueprint.
+
+    Limited endpoints share `total_limit` slots (roughly the number of requests the
+    database should work on at once) and each has its own limit as well. When slots
+    run out, requests wait in a queue ordered by priority, so checkout and
+    confirmation are admitted before menu and report renders. Requests that would
+    wait too long, or find the queue full, get a 503 with Retry-After right away
+    instead of timing out later.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.limits = dict(DEFAULT_LIMITS)
+        self.max_wait = dict(DEFAULT_MAX_WAIT)
+        self.total_limit = 16
+        self.max_queue = 64
+        self.retry_after = 5
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiters = []
+        self._running = defaultdict(int)
+        self._total_running = 0
+        self._stats = defaultdict(lambda: {"admitted": 0, "queued": 0, "shed": 0, "wait_seconds": 0.0})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("ADMISSION_ENABLED", True)
+        self.limits = dict(app.config.get("ADMISSION_LIMITS", DEFAULT_LIMITS))
+        self.max_wait = dict(app.config.get("ADMISSION_MAX_WAIT", DEFAULT_MAX_WAIT))
+        self.total_limit = app.config.get("ADMISSION_TOTAL_LIMIT", 16)
+        self.max_queue = app.config.get("ADMISSION_MAX_QUEUE", 64)
+        self.retry_after = app.config.get("ADMISSION_RETRY_AFTER", 5)
+
+        @app.before_request
+        def admit_request():
+            if not self.enabled or request.endpoint not in self.limits:
+                return None
+            if not self.acquire(request.endpoint):
+                response = make_response(
+                    "Pizza Crisis is very busy right now, please try again in a few seconds.", 503)
+                response.headers["Retry-After"] = str(self.retry_after)
+                return response
+            g.admitted_endpoint = request.endpoint
+            return None
+
+        @app.teardown_request
+        def release_request(exc=None):
+            endpoint = g.pop("admitted_endpoint", None)
+            if endpoint is not None:
+                self.release(endpoint)
+
+    # queueing
+
+    def _has_capacity(self, endpoint):
+        return self._total_running < self.total_limit and self._running[endpoint] < self.limits[endpoint][1]
+
+    def _start(self, endpoint):
+        self._running[endpoint] += 1
+        self._total_running += 1
+
+    def _dispatch(self):
+        """Hand free slots to queued requests, best priority first."""
+        admitted = False
+        for waiter in sorted(self._waiters, key=lambda w: (w.priority, w.seq)):
+            if self._total_running >= self.total_limit:
+                break
+            if self._has_capacity(waiter.endpoint):
+                self._waiters.remove(waiter)
+                self._start(waiter.endpoint)
+                waiter.admitted = True
+                admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _make_room(self, priority):
+        """Shed the newest, least important waiter if it ranks below `priority`."""
+        if not self._waiters:
+            return False
+        victim = max(self._waiters, key=lambda w: (w.priority, w.seq))
+        if victim.priority <= priority:
+            return False
+        self._waiters.remove(victim)
+        victim.shed = True
+        self._cond.notify_all()
+        return True
+
+    def acquire(self, endpoint):
+        priority = self.limits[endpoint][0]
+        stats = self._stats[endpoint]
+        with self._cond:
+            if not self._waiters and self._has_capacity(endpoint):
+                self._start(endpoint)
+                stats["admitted"] += 1
+                return True
+            if len(self._waiters) >= self.max_queue and not self._make_room(priority):
+                stats["shed"] += 1
+                return False
+
+            waiter = _Waiter(priority, next(self._seq), endpoint)
+            self._waiters.append(waiter)
+            stats["queued"] += 1
+            self._dispatch()
+
+            started = time.monotonic()
+            deadline = started + self.max_wait.get(priority, 1.0)
+            while not waiter.admitted and not waiter.shed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiters.remove(waiter)
+                    waiter.shed = True
+                    break
+                self._cond.wait(remaining)
+
+            stats["wait_seconds"] += time.monotonic() - started
+            if waiter.admitted:
+                stats["admitted"] += 1
+                return True
+            stats["shed"] += 1
+            return False
+
+    def release(self, endpoint):
+        with self._cond:
+            self._running[endpoint] -= 1
+            self._total_running -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._cond:
+            queued_by_endpoint = defaultdict(int)
+            for waiter in self._waiters:
+                queued_by_endpoint[waiter.endpoint] += 1
+            return {
+                "running": self._total_running,
+                "total_limit": self.total_limit,
+                "queue_depth": len(self._waiters),
+                "max_queue": self.max_queue,
+                "endpoints": {
+                    endpoint: {
+                        "priority": priority,
+                        "limit": limit,
+                        "running": self._running[endpoint],
+                        "waiting": queued_by_endpoint[endpoint],
+                        **self._stats[endpoint],
+                    }
+                    for endpoint, (priority, limit) in self.limits.items()
+                },
+            }
+
+
+admission = AdmissionController()
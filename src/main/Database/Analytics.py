@@ -0,0 +1,545 @@
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from Model import db, database_key, Customer, Order, OrderPizza, Payment, Pizza, GenderEnum, ORDER_STATUSES, AGE_BUCKETS
+from Demographics import birthday_keys
+from Archive import archive, LINE_PIZZA
+from ChangeTracking import change_tracker
+from ResponseCache import response_cache
+from Sharding import shard_router
+
+
+STATUS_CODE = {name: code for code, name in enumerate(ORDER_STATUSES)}
+DELIVERED = STATUS_CODE['DELIVERED']
+FINAL_STATUSES = [STATUS_CODE['DELIVERED'], STATUS_CODE['CANCELLED']]
+
+GENDERS = [g.name for g in GenderEnum]
+GENDER_CODE = {name: code for code, name in enumerate(GENDERS)}
+
+AGE_GROUPS = [name for name, _, _ in AGE_BUCKETS]
+AGE_GROUP_CODE = {name: code for code, name in enumerate(AGE_GROUPS)}
+CATEGORIES = ["Normal", "Vegetarian", "Vegan"]
+
+
+def _empty_columns():
+    return {
+        # orders, kept sorted by id
+        "o_id": np.empty(0, np.int64),
+        "o_date": np.empty(0, np.int64),  # seconds since epoch (naive UTC, like order_date)
+        "o_status": np.empty(0, np.int8),
+        "o_customer": np.empty(0, np.int64),
+        # order lines (pizzas only)
+        "l_order": np.empty(0, np.int64),
+        "l_pizza": np.empty(0, np.int64),
+        "l_qty": np.empty(0, np.int32),
+        "l_price": np.empty(0, np.float64),  # unit price when ordered, NaN for older lines
+        # payments
+        "p_order": np.empty(0, np.int64),
+        "p_amount": np.empty(0, np.float64),
+        # customers, kept sorted by id
+        "c_id": np.empty(0, np.int64),
+        "c_postal": np.empty(0, np.int32),  # index into postal_codes
+        "c_gender": np.empty(0, np.int8),  # index into GENDERS, -1 if unknown
+        "c_age": np.empty(0, np.int8),  # index into AGE_GROUPS, -1 if unknown
+        "postal_codes": np.empty(0, "U10"),
+    }
+
+
+def _to_seconds(values):
+    return np.array([v or datetime(1970, 1, 1) for v in values], dtype="datetime64[s]").astype(np.int64)
+
+
+def timespan_start(timespan, today):
+    # same boundaries as the original staff report filters
+    if timespan == 'week':
+        return today - timedelta(days=today.weekday())
+    if timespan == 'month':
+        return today.replace(day=1)
+    return None
+
+
+class OrderAnalytics:
+    """Columnar, in-memory copy of orders, pizza lines and payments for the staff reports.
+
+    Data is pulled from the database in keyset-paginated chunks and kept as NumPy
+    arrays, so group-bys and filters run vectorized instead of as ad-hoc SQL.
+    The arrays are snapshotted to an .npz file, tagged with the database they came
+    from, and refreshed incrementally by order_date.
+    Each refresh also re-reads the last `refresh_overlap` before the newest known
+    order: an order is dated at flush but only shows up at commit, possibly after a
+    later one. Customers committed through this process are re-read when they
+    change, and all of them once after a start. Revenue per pizza uses the unit
+    price stored with each order line. Reports call `refresh_in_background()`,
+    which only blocks before the first load; when a background refresh brings in
+    new data the reports version is bumped, so reports cached meanwhile are rebuilt.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.chunk_size = 5000
+        self.snapshot_path = None
+        self.database = None
+        self.snapshot_interval = 60
+        self.refresh_overlap = timedelta(minutes=5)
+        self._cols = _empty_columns()
+        self._catalog = {}
+        self._age_groups_checked_on = None
+        self._changed_customers = None  # None: re-read every customer on the next refresh
+        self._changes_lock = threading.Lock()
+        self._last_saved = 0.0
+        self._dirty = False
+        self.loaded = False
+        self._refreshing = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self._changed_customers = None
+        self.chunk_size = app.config.get("ANALYTICS_CHUNK_SIZE", 5000)
+        self.snapshot_interval = app.config.get("ANALYTICS_SNAPSHOT_INTERVAL", 60)
+        self.refresh_overlap = timedelta(seconds=app.config.get("ANALYTICS_REFRESH_OVERLAP", 300))
+        self.snapshot_path = app.config.get(
+            "ANALYTICS_SNAPSHOT_PATH", os.path.join(app.instance_path, "analytics_snapshot.npz"))
+        self.database = database_key(app)
+        self._load_snapshot()
+
+    # snapshot handling
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with np.load(self.snapshot_path, allow_pickle=False) as data:
+                cols = _empty_columns()
+                if set(cols) - set(data.files):
+                    print("Analytics snapshot has an older layout, rebuilding")
+                    return
+                if "database" not in data.files or str(data["database"]) != self.database:
+                    print("Analytics snapshot is from another database, rebuilding")
+                    return
+                for key in cols:
+                    cols[key] = data[key]
+            self._cols = cols
+            self.loaded = True
+        except (OSError, ValueError) as e:
+            print(f"Analytics snapshot could not be loaded, rebuilding: {e}")
+            self._cols = _empty_columns()
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = self.snapshot_path + ".tmp.npz"
+        np.savez(tmp_path, database=np.array(self.database), **self._cols)
+        os.replace(tmp_path, self.snapshot_path)
+        self._last_saved = time.monotonic()
+        self._dirty = False
+
+    # extraction
+
+    def _fetch_orders(self, condition):
+        ids, dates, statuses, customers = [], [], [], []
+        for _ in shard_router.each():
+            last_id = 0
+            while True:
+                rows = db.session.execute(
+                    select(Order.id, Order.order_date, Order.status, Order.customer_id)
+                    .where(condition, Order.id > last_id)
+                    .order_by(Order.id)
+                    .limit(self.chunk_size)
+                ).all()
+                if not rows:
+                    break
+                for order_id, order_date, status, customer_id in rows:
+                    ids.append(order_id)
+                    dates.append(order_date)
+                    statuses.append(STATUS_CODE.get(status, 0))
+                    customers.append(customer_id or 0)
+                last_id = rows[-1][0]
+                if len(rows) < self.chunk_size:
+                    break
+        return (np.array(ids, np.int64), _to_seconds(dates),
+                np.array(statuses, np.int8), np.array(customers, np.int64))
+
+    def _fetch_children(self, order_ids):
+        lines, payments = [], []
+        for shard, id_list in shard_router.split_ids(order_ids.tolist()).items():
+            with shard_router.using(shard):
+                for start in range(0, len(id_list), self.chunk_size):
+                    chunk = id_list[start:start + self.chunk_size]
+                    lines.extend(db.session.execute(
+                        select(OrderPizza.order_id, OrderPizza.pizza_id, OrderPizza.quantity, OrderPizza.unit_price)
+                        .where(OrderPizza.order_id.in_(chunk))
+                    ).all())
+                    payments.extend(db.session.execute(
+                        select(Payment.order_id, Payment.amount).where(Payment.order_id.in_(chunk))
+                    ).all())
+        return (np.array([r[0] for r in lines], np.int64),
+                np.array([r[1] for r in lines], np.int64),
+                np.array([r[2] for r in lines], np.int32),
+                np.array([r[3] for r in lines], np.float64),
+                np.array([r[0] or 0 for r in payments], np.int64),
+                np.array([r[1] for r in payments], np.float64))
+
+    def customers_changed(self, customer_ids):
+        """Customers changed by a commit: their ids, or None when any of them may have."""
+        with self._changes_lock:
+            if customer_ids is None or self._changed_customers is None:
+                self._changed_customers = None
+            else:
+                self._changed_customers |= customer_ids
+
+    def _take_changed_customers(self):
+        with self._changes_lock:
+            changed, self._changed_customers = self._changed_customers, set()
+        return changed
+
+    def _fetch_customers(self, cols, changed):
+        """Add new customers and re-read `changed` ones (all of them when it is None)."""
+        before = {key: cols[key] for key in ("c_id", "c_postal", "c_gender", "c_age")}
+        postal_codes = list(cols["postal_codes"])
+        postal_index = {pc: i for i, pc in enumerate(postal_codes)}
+        columns = (Customer.id, Customer.postal_code, Customer.gender, Customer.age_bucket)
+
+        def values(rows):
+            ids, postals, genders, age_groups = [], [], [], []
+            for customer_id, postal_code, gender, age_bucket in rows:
+                if postal_code not in postal_index:
+                    postal_index[postal_code] = len(postal_codes)
+                    postal_codes.append(postal_code)
+                ids.append(customer_id)
+                postals.append(postal_index[postal_code])
+                genders.append(GENDER_CODE.get(gender.name, -1) if gender else -1)
+                age_groups.append(AGE_GROUP_CODE.get(age_bucket, -1))
+            return (np.array(ids, np.int64), np.array(postals, np.int32),
+                    np.array(genders, np.int8), np.array(age_groups, np.int8))
+
+        if changed is None:
+            for key, column in before.items():
+                cols[key] = column[:0]
+        elif changed:
+            known = sorted(changed)
+            c_postal, c_gender, c_age = cols["c_postal"].copy(), cols["c_gender"].copy(), cols["c_age"].copy()
+            for start in range(0, len(known), self.chunk_size):
+                rows = db.session.execute(
+                    select(*columns).where(Customer.id.in_(known[start:start + self.chunk_size]))).all()
+                ids, postals, genders, age_groups = values(rows)
+                c_rows = self._customer_rows(cols, ids)
+                found = c_rows >= 0
+                c_postal[c_rows[found]] = postals[found]
+                c_gender[c_rows[found]] = genders[found]
+                c_age[c_rows[found]] = age_groups[found]
+            cols["c_postal"], cols["c_gender"], cols["c_age"] = c_postal, c_gender, c_age
+
+        last_id = int(cols["c_id"][-1]) if len(cols["c_id"]) else 0
+        new = []
+        while True:
+            rows = db.session.execute(
+                select(*columns).where(Customer.id > last_id).order_by(Customer.id).limit(self.chunk_size)
+            ).all()
+            if not rows:
+                break
+            new.append(values(rows))
+            last_id = rows[-1][0]
+            if len(rows) < self.chunk_size:
+                break
+        for key, added in zip(("c_id", "c_postal", "c_gender", "c_age"), zip(*new)):
+            cols[key] = np.concatenate([cols[key], *added])
+        cols["postal_codes"] = np.array(postal_codes, "U10")
+        return any(not np.array_equal(before[key], cols[key]) for key in before)
+
+    def _refresh_age_groups(self, cols, today):
+        """Customers with a birthday since the last check may have moved to the next age bucket.
+
+        The first check after a start reloads every customer's bucket, because the
+        snapshot may be days old.
+        """
+        checked_on = self._age_groups_checked_on
+        if checked_on == today:
+            return False
+        query = select(Customer.id, Customer.age_bucket)
+        if checked_on is not None:
+            keys = set()
+            day = checked_on
+            while day < today:
+                day += timedelta(days=1)
+                keys.update(birthday_keys(day))
+            query = query.where(Customer.birth_month_day.in_(keys))
+        rows = db.session.execute(query).all()
+        self._age_groups_checked_on = today
+        if not rows:
+            return False
+        c_rows = self._customer_rows(cols, np.array([r[0] for r in rows], np.int64))
+        known = c_rows >= 0
+        c_age = cols["c_age"].copy()
+        c_age[c_rows[known]] = np.array([AGE_GROUP_CODE.get(r[1], -1) for r in rows], np.int8)[known]
+        changed = not np.array_equal(c_age, cols["c_age"])
+        cols["c_age"] = c_age
+        return changed
+
+    def _refresh_catalog(self):
+        pizzas = Pizza.query.options(selectinload(Pizza.ingredients)).all()
+        self._catalog = {
+            p.id: {"name": p.pizza_name, "price": p.final_amount(), "category": p.category or "Normal"}
+            for p in pizzas
+        }
+
+    def _fetch_archived(self, order_ids=None):
+        orders = archive.scan("orders")
+        lines = archive.scan("lines")
+        payments = archive.scan("payments")
+        keep = np.ones(len(orders["id"]), bool) if order_ids is None else np.isin(orders["id"], order_ids)
+        ids = orders["id"][keep]
+        pizzas = (lines["kind"] == LINE_PIZZA) & np.isin(lines["order_id"], ids)
+        paid = np.isin(payments["order_id"], ids)
+        return ((ids, orders["order_date"][keep], orders["status"][keep], orders["customer_id"][keep]),
+                (lines["order_id"][pizzas], lines["item_id"][pizzas], lines["quantity"][pizzas],
+                 lines["unit_price"][pizzas], payments["order_id"][paid], payments["amount"][paid]))
+
+    def refresh(self):
+        """Pull orders placed since the last refresh (less the overlap) plus every order that was still open.
+
+        Returns whether anything the reports show has changed.
+        """
+        with self._lock:
+            cols = dict(self._cols)
+            changed_customers = self._take_changed_customers()
+            try:
+                changed = self._fetch_customers(cols, changed_customers)
+            except Exception:
+                self.customers_changed(changed_customers)  # try them again next time
+                raise
+            changed = self._refresh_age_groups(cols, date.today()) or changed
+
+            full_load = not len(cols["o_id"])
+            open_ids = cols["o_id"][~np.isin(cols["o_status"], FINAL_STATUSES)]
+            if full_load:
+                fetched = [self._fetch_orders(Order.id > 0)]
+            else:
+                newest = datetime(1970, 1, 1) + timedelta(seconds=int(cols["o_date"].max()))
+                watermark = newest - self.refresh_overlap
+                fetched = [self._fetch_orders(Order.order_date >= watermark)]
+                for start in range(0, len(open_ids), self.chunk_size):
+                    chunk = open_ids[start:start + self.chunk_size].tolist()
+                    fetched.append(self._fetch_orders(Order.id.in_(chunk)))
+            db_ids = np.unique(np.concatenate([f[0] for f in fetched]))
+            children = [self._fetch_children(db_ids)]
+
+            # archived orders only exist in the archive files: all of them on a full load,
+            # and open orders that were finished and archived since the last refresh
+            missing = np.setdiff1d(open_ids, db_ids)
+            if full_load or len(missing):
+                archived_orders, archived_children = self._fetch_archived(None if full_load else missing)
+                fetched.append(archived_orders)
+                children.append(archived_children)
+
+            new_ids = np.concatenate([f[0] for f in fetched])
+            if len(new_ids) or len(open_ids):
+                new_ids, first = np.unique(new_ids, return_index=True)
+                new_dates = np.concatenate([f[1] for f in fetched])[first]
+                new_status = np.concatenate([f[2] for f in fetched])[first]
+                new_customers = np.concatenate([f[3] for f in fetched])[first]
+
+                # drop rows that are being replaced (open orders and the re-read window)
+                replaced = np.union1d(new_ids, open_ids)
+                keep = ~np.isin(cols["o_id"], replaced)
+                # re-read orders usually come back unchanged
+                changed = changed or not (np.array_equal(cols["o_id"][~keep], new_ids)
+                                          and np.array_equal(cols["o_status"][~keep], new_status))
+                keep_lines = ~np.isin(cols["l_order"], replaced)
+                keep_payments = ~np.isin(cols["p_order"], replaced)
+
+                l_order, l_pizza, l_qty, l_price, p_order, p_amount = (np.concatenate(c) for c in zip(*children))
+
+                o_id = np.concatenate([cols["o_id"][keep], new_ids])
+                order = np.argsort(o_id, kind="stable")
+                cols["o_id"] = o_id[order]
+                cols["o_date"] = np.concatenate([cols["o_date"][keep], new_dates])[order]
+                cols["o_status"] = np.concatenate([cols["o_status"][keep], new_status])[order]
+                cols["o_customer"] = np.concatenate([cols["o_customer"][keep], new_customers])[order]
+                cols["l_order"] = np.concatenate([cols["l_order"][keep_lines], l_order])
+                cols["l_pizza"] = np.concatenate([cols["l_pizza"][keep_lines], l_pizza])
+                cols["l_qty"] = np.concatenate([cols["l_qty"][keep_lines], l_qty])
+                cols["l_price"] = np.concatenate([cols["l_price"][keep_lines], l_price])
+                cols["p_order"] = np.concatenate([cols["p_order"][keep_payments], p_order])
+                cols["p_amount"] = np.concatenate([cols["p_amount"][keep_payments], p_amount])
+
+            self._refresh_catalog()
+            self._cols = cols
+            self.loaded = True
+            self._dirty = self._dirty or changed
+            if self._dirty and time.monotonic() - self._last_saved >= self.snapshot_interval:
+                self.save_snapshot()
+            return changed
+
+    def refresh_in_background(self):
+        """Refresh in a worker thread unless one is running; only the first load runs in the caller."""
+        if not self.loaded:
+            self.refresh()
+            return
+        with self._changes_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_app_context, name="analytics", daemon=True).start()
+
+    def _refresh_in_app_context(self):
+        try:
+            with self.app.app_context():
+                try:
+                    changed = self.refresh()
+                finally:
+                    db.session.remove()
+            if changed:
+                # reports cached while this ran were built from the older columns
+                response_cache.bump_reports()
+        except Exception as e:
+            print(f"Analytics refresh failed: {e}")
+        finally:
+            self._refreshing = False
+
+    def rebuild(self):
+        with self._lock:
+            self._cols = _empty_columns()
+            self._dirty = True
+        self.refresh()
+
+    # vectorized helpers
+
+    @staticmethod
+    def _lookup(sorted_ids, ids):
+        """Row of each id in a sorted id column, -1 when it is unknown."""
+        if not len(sorted_ids):
+            return np.full(len(ids), -1, np.int64)
+        idx = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[idx] == ids, idx, -1)
+
+    def _order_rows(self, cols, order_ids):
+        return self._lookup(cols["o_id"], order_ids)
+
+    def _customer_rows(self, cols, customer_ids):
+        return self._lookup(cols["c_id"], customer_ids)
+
+    def _order_mask(self, cols, timespan, today, gender='all', age_group='all', postal_code='all'):
+        """Delivered orders matching the report filters, plus each order's customer row."""
+        mask = cols["o_status"] == DELIVERED
+        start = timespan_start(timespan, today)
+        if start is not None:
+            start_s = int((datetime(start.year, start.month, start.day) - datetime(1970, 1, 1)).total_seconds())
+            mask &= cols["o_date"] >= start_s
+
+        c_rows = self._customer_rows(cols, cols["o_customer"])
+        mask &= c_rows >= 0
+        safe_rows = np.where(c_rows >= 0, c_rows, 0)
+
+        if gender and gender != 'all':
+            mask &= cols["c_gender"][safe_rows] == GENDER_CODE.get(gender, -2)
+        if postal_code and postal_code != 'all':
+            matches = np.flatnonzero(cols["postal_codes"] == postal_code)
+            mask &= np.isin(cols["c_postal"][safe_rows], matches)
+        if age_group and age_group != 'all':
+            mask &= cols["c_age"][safe_rows] == AGE_GROUP_CODE.get(age_group, -2)
+        return mask, safe_rows
+
+    # reports
+
+    def earnings_by_postal_code(self, timespan, gender, age_group, postal_code, today):
+        cols = self._cols
+        mask, c_rows = self._order_mask(cols, timespan, today, gender, age_group, postal_code)
+        p_rows = self._order_rows(cols, cols["p_order"])
+        paid = p_rows >= 0
+        paid[paid] = mask[p_rows[paid]]
+        postal = cols["c_postal"][c_rows[p_rows[paid]]]
+        n = len(cols["postal_codes"])
+        totals = np.bincount(postal, weights=cols["p_amount"][paid], minlength=n)
+        present = np.bincount(postal, minlength=n) > 0
+        rows = [(str(cols["postal_codes"][i]), float(totals[i])) for i in np.flatnonzero(present)]
+        return sorted(rows)
+
+    def _pizza_quantities(self, cols, mask):
+        l_rows = self._order_rows(cols, cols["l_order"])
+        selected = l_rows >= 0
+        selected[selected] = mask[l_rows[selected]]
+        return l_rows, selected
+
+    def undelivered_order_ids(self):
+        cols = self._cols
+        return cols["o_id"][cols["o_status"] != DELIVERED].tolist()
+
+    def revenue_by_pizza(self, timespan, today):
+        cols = self._cols
+        mask, _ = self._order_mask(cols, timespan, today)
+        _, selected = self._pizza_quantities(cols, mask)
+        pizza_ids, inverse = np.unique(cols["l_pizza"][selected], return_inverse=True)
+        quantities = np.bincount(inverse, weights=cols["l_qty"][selected], minlength=len(pizza_ids))
+        # lines from before prices were stored fall back to today's catalog price
+        current = np.array([self._catalog.get(int(pid), {}).get("price", 0.0) for pid in pizza_ids])
+        unit_prices = cols["l_price"][selected]
+        unit_prices = np.where(np.isnan(unit_prices), current[inverse], unit_prices)
+        revenue = np.bincount(inverse, weights=cols["l_qty"][selected] * unit_prices, minlength=len(pizza_ids))
+        return [
+            {"pizza_name": self._catalog.get(int(pizza_ids[i]), {}).get("name", f"#{pizza_ids[i]}"),
+             "quantity": int(quantities[i]), "revenue": float(revenue[i])}
+            for i in np.argsort(-revenue, kind="stable")
+        ]
+
+    def hourly_heatmap(self, timespan, today):
+        """Delivered orders per weekday (Monday first) and hour of day."""
+        cols = self._cols
+        mask, _ = self._order_mask(cols, timespan, today)
+        seconds = cols["o_date"][mask]
+        weekday = (seconds // 86400 + 3) % 7  # 1970-01-01 was a Thursday
+        hour = (seconds // 3600) % 24
+        return np.bincount(weekday * 24 + hour, minlength=7 * 24).reshape(7, 24).tolist()
+
+    def age_group_by_category(self, timespan, today):
+        """Pizzas sold per customer age group and pizza category."""
+        cols = self._cols
+        mask, c_rows = self._order_mask(cols, timespan, today)
+        l_rows, selected = self._pizza_quantities(cols, mask)
+        age_groups = cols["c_age"][c_rows[l_rows[selected]]]
+        category_of = {pid: CATEGORIES.index(info["category"]) if info["category"] in CATEGORIES else 0
+                       for pid, info in self._catalog.items()}
+        categories = np.array([category_of.get(int(pid), 0) for pid in cols["l_pizza"][selected]], np.int64)
+        qty = cols["l_qty"][selected]
+
+        table = {}
+        for code, group in enumerate(AGE_GROUPS):
+            in_group = age_groups == code
+            counts = np.bincount(categories[in_group], weights=qty[in_group], minlength=len(CATEGORIES))
+            table[group] = {category: int(counts[i]) for i, category in enumerate(CATEGORIES)}
+        return table
+
+
+analytics = OrderAnalytics()
+
+
+def _collect_customer_changes(changes, session):
+    if changes is not None:
+        # new customers are picked up by id, only edits need to be re-read
+        changes.update(obj.id for obj in session.dirty if isinstance(obj, Customer))
+    return changes
+
+
+def _collect_bulk_customer_changes(changes, model, orm_execute_state):
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and model is not None \
+            and issubclass(model, Customer):
+        return None
+    return changes
+
+
+def _apply_customer_changes(changes):
+    if changes is None or changes:
+        analytics.customers_changed(changes)
+
+
+change_tracker.subscribe("analytics", _apply_customer_changes,
+                         flushed=_collect_customer_changes, bulk=_collect_bulk_customer_changes)
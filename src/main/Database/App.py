@@ -3,32 +3,92 @@ import threading
 import os
 from flask import Flask
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from Model import db, Order, DeliveryPerson
 from routes import bp
 from Seeding import seed_database
-
-
-def create_app():
+from Analytics import analytics
+from Archive import archive
+from TopSellers import top_sellers
+from ResponseCache import response_cache
+from Demographics import demographics
+from DiscountCampaign import discount_campaigns
+from AdmissionControl import admission
+from OrderEvents import order_events
+from BulkOrders import bulk_orders
+from PricingRules import pricing
+from Inventory import inventory
+from CustomPizzas import pizza_builder
+from Profiler import profiler
+from GroupCommit import group_commit
+from CustomerSearch import customer_search
+from DeliveryEta import delivery_eta
+from ReadReplica import read_replica
+from Sharding import shard_router, parse_shards
+
+
+def create_app(test_config=None):
 
     app = Flask(__name__)
     load_dotenv()
 
 
     app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "a-default-secret-key")
-    app.config['SQLALCHEMY_DATABASE_URI'] = (
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL") or (
         f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@"
         f"{os.getenv('DB_HOST', 'localhost')}:3306/{os.getenv('DB_NAME', 'pizza')}"
     )
+    if os.getenv("DATABASE_REPLICA_URL"):
+        app.config["SQLALCHEMY_BINDS"] = {"replica": os.getenv("DATABASE_REPLICA_URL")}
+    if os.getenv("DATABASE_SHARDS"):
+        shard_binds, app.config["SHARD_RANGES"] = parse_shards(os.getenv("DATABASE_SHARDS"))
+        app.config.setdefault("SQLALCHEMY_BINDS", {}).update(shard_binds)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config["ARCHIVE_AFTER_DAYS"] = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))
+    app.config["SEED_CUSTOMERS"] = int(os.getenv("SEED_CUSTOMERS", 30))
+    app.config["SEED_DELIVERY_PERSONNEL"] = int(os.getenv("SEED_DELIVERY_PERSONNEL", 20))
+    app.config["SEED_ORDERS"] = int(os.getenv("SEED_ORDERS", 100))
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_ENDPOINT"] = os.getenv("PROFILE_ENDPOINT")
+    app.config["GROUP_COMMIT_ENABLED"] = os.getenv("GROUP_COMMIT_ENABLED", "0") == "1"
+    if test_config:
+        app.config.update(test_config)
 
     db.init_app(app)
+    shard_router.init_app(app)
+    read_replica.init_app(app)
+    pricing.init_app(app)
+    admission.init_app(app)
+    profiler.init_app(app)
+    response_cache.init_app(app)
     app.register_blueprint(bp)
 
     with app.app_context():
         db.create_all()
-        seed_database()
+        shard_router.create_all()
+        seed_database(app.config["SEED_CUSTOMERS"], app.config["SEED_DELIVERY_PERSONNEL"], app.config["SEED_ORDERS"])
+
+    archive.init_app(app)
+    analytics.init_app(app)
+    top_sellers.init_app(app)
+    demographics.init_app(app)
+    discount_campaigns.init_app(app)
+    order_events.init_app(app)
+    bulk_orders.init_app(app)
+    group_commit.init_app(app)
+    inventory.init_app(app)
+    pizza_builder.init_app(app)
+    customer_search.init_app(app)
+    delivery_eta.init_app(app)
+    with app.app_context():
+        top_sellers.rebuild()
+        demographics.refresh_age_buckets(full=True)
+        discount_campaigns.rebuild()
+        if customer_search.enabled:
+            customer_search.rebuild()
+        if not delivery_eta.loaded:
+            delivery_eta.rebuild()
 
     @app.route('/ping')
     def ping():
@@ -40,35 +100,69 @@ def create_app():
 def check_deliveries_job(app):
 
     with app.app_context():
-        now = datetime.utcnow()
-
-        overdue_orders = Order.query.filter(
-            Order.status == "OUT_FOR_DELIVERY",
-            Order.estimated_delivery_time < now
-        ).all()
-        for order in overdue_orders:
-            order.status = "DELIVERED"
-
-        pending_orders = Order.query.filter_by(status="PENDING_ASSIGNMENT").all()
-        for order in pending_orders:
-            available_driver = DeliveryPerson.query.filter(
-                DeliveryPerson.available_at <= now,
-                DeliveryPerson.postal_code == order.customer.postal_code
-            ).order_by(DeliveryPerson.available_at.asc()).first()
-            if available_driver:
-                order.delivery_person = available_driver
-                order.status = "OUT_FOR_DELIVERY"
-                order.estimated_delivery_time = now + timedelta(minutes=30)
-                available_driver.available_at = order.estimated_delivery_time
-                db.session.add(available_driver)
+        # every shard holds its own zones' orders and drivers, so they are checked side by side
+        shard_router.run_parallel(_check_shard_deliveries)
+        delivery_eta.flush()
+
+
+def _check_shard_deliveries(shard):
+    now = datetime.utcnow()
+
+    overdue_orders = Order.query.filter(
+        Order.status == "OUT_FOR_DELIVERY",
+        Order.estimated_delivery_time < now
+    ).all()
+    for order in overdue_orders:
+        # nobody confirmed these, so they are closed at their estimate and not learned from
+        order.status = "DELIVERED"
+        order.delivered_at = order.estimated_delivery_time
+
+    assigned_orders = []
+    pending_orders = Order.query.filter_by(status="PENDING_ASSIGNMENT").all()
+    for order in pending_orders:
+        available_driver = DeliveryPerson.query.filter(
+            DeliveryPerson.available_at <= now,
+            DeliveryPerson.postal_code == order.customer.postal_code
+        ).order_by(DeliveryPerson.available_at.asc()).first()
+        if available_driver:
+            order.delivery_person = available_driver
+            order.status = "OUT_FOR_DELIVERY"
+            order.dispatched_at = now
+            order.estimated_delivery_time, available_driver.available_at = (
+                delivery_eta.dispatch(order.customer.postal_code, now))
+            db.session.add(available_driver)
+            assigned_orders.append(order)
+
+    db.session.commit()
+
+    for order in overdue_orders:
+        top_sellers.record_order(order)
+        order_events.publish(order)
+    if overdue_orders:
+        # a report built since the commit bumped the version may lack these top sellers
+        response_cache.bump_reports()
+    for order in assigned_orders:
+        order_events.publish(order)
+
+
+def daily_job(app):
 
+    with app.app_context():
+        archived = archive.archive_orders()
+        if archived:
+            print(f"Archived {archived} finished orders")
+        demographics.refresh_age_buckets()
+        inventory.prune_reservations(datetime.utcnow() - timedelta(days=1))
         db.session.commit()
 
 
-
 def run_scheduler(app):
+    last_daily_run = None
     while True:
         check_deliveries_job(app)
+        if date.today() != last_daily_run:
+            daily_job(app)
+            last_daily_run = date.today()
         time.sleep(300)  # Check every 5 minutes
 
 
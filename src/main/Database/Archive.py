@@ -0,0 +1,295 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, delete, literal
+
+from Model import db, database_key, Order, OrderPizza, OrderDrink, OrderDessert, Payment, ORDER_STATUSES
+from Sharding import shard_router
+
+
+STATUS_CODE = {name: code for code, name in enumerate(ORDER_STATUSES)}
+ARCHIVED_STATUSES = ("DELIVERED", "CANCELLED")
+
+LINE_PIZZA, LINE_DRINK, LINE_DESSERT = 0, 1, 2
+
+# one append-only file per column, grouped per table inside a month partition
+COLUMNS = {
+    "orders": {
+        "id": "<i8",
+        "order_date": "<i8",
+        "estimated_delivery_time": "<i8",
+        "status": "i1",
+        "customer_id": "<i8",
+        "discount_id": "<i8",
+        "delivery_person_id": "<i8",
+    },
+    "lines": {
+        "order_id": "<i8",
+        "kind": "i1",
+        "item_id": "<i8",
+        "quantity": "<i4",
+        "unit_price": "<f8",  # pizzas only, NaN otherwise
+    },
+    "payments": {
+        "id": "<i8",
+        "order_id": "<i8",
+        "amount": "<f8",
+        "payment_date": "<i8",
+    },
+}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _seconds(value):
+    return -1 if value is None else int((value - EPOCH).total_seconds())
+
+
+def from_seconds(value):
+    return None if value < 0 else EPOCH + timedelta(seconds=int(value))
+
+
+class OrderArchive:
+    """Append-only, memory-mapped columnar storage for finished orders.
+
+    DELIVERED and CANCELLED orders older than ARCHIVE_AFTER_DAYS are moved out of the
+    orders/order lines/payments tables into one binary file per column, partitioned
+    by month (instance/archive/YYYY-MM/orders.id.bin, ...). Readers memory-map the
+    files, so full-history scans are sequential reads that never touch MySQL. The
+    archive records which database its orders were moved out of, and refuses to
+    start against another one.
+    """
+
+    def __init__(self, app=None):
+        self.root = None
+        self.database = None
+        self.after_days = 90
+        self.batch_size = 1000
+        self._pizza_counts = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get("ARCHIVE_PATH", os.path.join(app.instance_path, "archive"))
+        self.after_days = app.config.get("ARCHIVE_AFTER_DAYS", 90)
+        self.batch_size = app.config.get("ARCHIVE_BATCH_SIZE", 1000)
+        self._pizza_counts = None
+        self.database = database_key(app)
+        recorded = self._recorded_database()
+        if recorded is not None and recorded != self.database:
+            raise ValueError(f"The archive in {self.root} holds orders of {recorded}, not {self.database}; "
+                             f"point ARCHIVE_PATH elsewhere")
+
+    # storage
+
+    def partitions(self):
+        if not self.root or not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def _recorded_database(self):
+        path = os.path.join(self.root, "database.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["database"]
+
+    def _record_database(self):
+        if self._recorded_database() is None:
+            os.makedirs(self.root, exist_ok=True)
+            path = os.path.join(self.root, "database.json")
+            with open(path + ".tmp", "w") as f:
+                json.dump({"database": self.database}, f)
+            os.replace(path + ".tmp", path)
+
+    def _path(self, month, table, column):
+        return os.path.join(self.root, month, f"{table}.{column}.bin")
+
+    def _manifest(self, month):
+        """Committed row count per table; anything past it is the tail of an interrupted append."""
+        path = os.path.join(self.root, month, "manifest.json")
+        if not os.path.exists(path):
+            return {table: 0 for table in COLUMNS}
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, month, manifest):
+        path = os.path.join(self.root, month, "manifest.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def read(self, month, table):
+        rows = self._manifest(month)[table]
+        columns = {}
+        for column, dtype in COLUMNS[table].items():
+            if rows == 0:
+                columns[column] = np.empty(0, dtype)
+            elif not os.path.exists(self._path(month, table, column)):
+                columns[column] = self._missing_column(dtype, rows)
+            else:
+                columns[column] = np.memmap(self._path(month, table, column), dtype=dtype, mode="r", shape=(rows,))
+        return columns
+
+    @staticmethod
+    def _missing_column(dtype, rows):
+        # a column added after this partition was written
+        return np.full(rows, np.nan if np.dtype(dtype).kind == "f" else -1, dtype)
+
+    def _append(self, month, table, rows, columns):
+        for column, dtype in COLUMNS[table].items():
+            path = self._path(month, table, column)
+            if rows and not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(self._missing_column(dtype, rows).tobytes())
+            with open(path, "ab") as f:
+                f.truncate(rows * np.dtype(dtype).itemsize)
+                f.write(np.asarray(columns[column], dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        return rows + len(next(iter(columns.values())))
+
+    def scan(self, table, since=None):
+        """Concatenate a table across month partitions, optionally skipping months before `since`."""
+        first_month = since.strftime("%Y-%m") if since else None
+        parts = [self.read(month, table) for month in self.partitions() if not first_month or month >= first_month]
+        return {
+            column: np.concatenate([p[column] for p in parts]) if parts else np.empty(0, dtype)
+            for column, dtype in COLUMNS[table].items()
+        }
+
+    # archiving job
+
+    def archive_orders(self, older_than_days=None):
+        days = self.after_days if older_than_days is None else older_than_days
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        archived = 0
+        with self._lock:
+            self._record_database()
+            for _ in shard_router.each():
+                while True:
+                    orders = db.session.execute(
+                        select(Order.id, Order.order_date, Order.estimated_delivery_time, Order.status,
+                               Order.customer_id, Order.discount_id, Order.delivery_person_id)
+                        .where(Order.status.in_(ARCHIVED_STATUSES), Order.order_date < cutoff)
+                        .order_by(Order.id)
+                        .limit(self.batch_size)
+                    ).all()
+                    if not orders:
+                        break
+                    self._archive_batch(orders)
+                    archived += len(orders)
+            if archived:
+                self._pizza_counts = None
+        return archived
+
+    def _archive_batch(self, orders):
+        order_ids = [o.id for o in orders]
+        month_of = {o.id: o.order_date.strftime("%Y-%m") for o in orders}
+
+        lines = []
+        for kind, model, item_column, price_column in (
+                (LINE_PIZZA, OrderPizza, OrderPizza.pizza_id, OrderPizza.unit_price),
+                (LINE_DRINK, OrderDrink, OrderDrink.drink_id, literal(None)),
+                (LINE_DESSERT, OrderDessert, OrderDessert.dessert_id, literal(None))):
+            rows = db.session.execute(
+                select(model.order_id, item_column, model.quantity, price_column).where(model.order_id.in_(order_ids))
+            ).all()
+            lines.extend((order_id, kind, item_id, qty, price) for order_id, item_id, qty, price in rows)
+        payments = db.session.execute(
+            select(Payment.id, Payment.order_id, Payment.amount, Payment.payment_date)
+            .where(Payment.order_id.in_(order_ids))
+        ).all()
+
+        for month in sorted(set(month_of.values())):
+            # a previous run may have committed this batch and crashed before deleting it
+            already = set(self.read(month, "orders")["id"].tolist())
+            month_orders = [o for o in orders if month_of[o.id] == month and o.id not in already]
+            if not month_orders:
+                continue
+            ids = {o.id for o in month_orders}
+            os.makedirs(os.path.join(self.root, month), exist_ok=True)
+            manifest = self._manifest(month)
+            manifest["orders"] = self._append(month, "orders", manifest["orders"], {
+                "id": [o.id for o in month_orders],
+                "order_date": [_seconds(o.order_date) for o in month_orders],
+                "estimated_delivery_time": [_seconds(o.estimated_delivery_time) for o in month_orders],
+                "status": [STATUS_CODE[o.status] for o in month_orders],
+                "customer_id": [o.customer_id or -1 for o in month_orders],
+                "discount_id": [o.discount_id or -1 for o in month_orders],
+                "delivery_person_id": [o.delivery_person_id or -1 for o in month_orders],
+            })
+            month_lines = [line for line in lines if line[0] in ids]
+            manifest["lines"] = self._append(month, "lines", manifest["lines"], {
+                "order_id": [line[0] for line in month_lines],
+                "kind": [line[1] for line in month_lines],
+                "item_id": [line[2] for line in month_lines],
+                "quantity": [line[3] for line in month_lines],
+                "unit_price": [np.nan if line[4] is None else line[4] for line in month_lines],
+            })
+            month_payments = [p for p in payments if p.order_id in ids]
+            manifest["payments"] = self._append(month, "payments", manifest["payments"], {
+                "id": [p.id for p in month_payments],
+                "order_id": [p.order_id for p in month_payments],
+                "amount": [p.amount for p in month_payments],
+                "payment_date": [_seconds(p.payment_date) for p in month_payments],
+            })
+            self._write_manifest(month, manifest)
+
+        # the files are fsynced, only now remove the rows from the live tables
+        for model in (OrderPizza, OrderDrink, OrderDessert, Payment):
+            db.session.execute(delete(model).where(model.order_id.in_(order_ids)))
+        db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+        db.session.commit()
+
+    # readers
+
+    def pizza_count(self, customer_id):
+        """Pizzas in a customer's archived orders, so loyalty counts survive archiving."""
+        with self._lock:
+            if self._pizza_counts is None:
+                orders = self.scan("orders")
+                lines = self.scan("lines")
+                pizzas = lines["kind"] == LINE_PIZZA
+                order_sort = np.argsort(orders["id"])
+                sorted_ids = orders["id"][order_sort]
+                rows = np.searchsorted(sorted_ids, lines["order_id"][pizzas])
+                rows = np.minimum(rows, max(len(sorted_ids) - 1, 0))
+                customers = orders["customer_id"][order_sort][rows] if len(sorted_ids) else np.empty(0, np.int64)
+                qty = lines["quantity"][pizzas]
+                ids, inverse = np.unique(customers, return_inverse=True)
+                totals = np.bincount(inverse, weights=qty, minlength=len(ids))
+                self._pizza_counts = {int(c): int(t) for c, t in zip(ids, totals)}
+            return self._pizza_counts.get(customer_id, 0)
+
+    def customer_orders(self, customer_id):
+        """Archived orders of one customer, newest first, as plain dicts."""
+        history = []
+        for month in reversed(self.partitions()):
+            orders = self.read(month, "orders")
+            rows = np.flatnonzero(orders["customer_id"] == customer_id)
+            if not len(rows):
+                continue
+            lines = self.read(month, "lines")
+            payments = self.read(month, "payments")
+            for row in rows[np.argsort(-orders["order_date"][rows])]:
+                order_id = orders["id"][row]
+                line_rows = np.flatnonzero(lines["order_id"] == order_id)
+                history.append({
+                    "id": int(order_id),
+                    "order_date": from_seconds(orders["order_date"][row]),
+                    "status": ORDER_STATUSES[orders["status"][row]],
+                    "amount": float(payments["amount"][payments["order_id"] == order_id].sum()),
+                    "lines": [(int(lines["kind"][i]), int(lines["item_id"][i]), int(lines["quantity"][i]))
+                              for i in line_rows],
+                })
+        return history
+
+
+archive = OrderArchive()
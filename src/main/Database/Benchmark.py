@@ -0,0 +1,173 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import event, select
+
+from Model import db, Customer, DeliveryPerson, DiscountCode, Drink, Pizza
+from DiscountCampaign import discount_campaigns
+from BulkOrders import bulk_orders
+from GroupCommit import GroupCommitWriter
+
+
+def make_app(database_url):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if database_url.startswith("sqlite"):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30, "check_same_thread": False}}
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def run_threads(target, chunks):
+    threads = [threading.Thread(target=target, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def bench_discount_redemption(app, codes=2000, threads=8, guesses=100_000):
+    discount_campaigns.init_app(app)
+    prefix = f"BENCH{random.randrange(10 ** 6):06d}"
+    with app.app_context():
+        started = time.perf_counter()
+        discount_campaigns.generate_codes(codes, 10.0, datetime.now() + timedelta(days=1), prefix=prefix)
+        print(f"  minted {codes} codes in {time.perf_counter() - started:.2f}s")
+        discount_campaigns.rebuild()
+        minted = db.session.execute(
+            select(DiscountCode.id, DiscountCode.code).where(DiscountCode.code.like(f"{prefix}%"))).all()
+
+    # every code is attempted by two workers, exactly one of them may win it
+    attempts = [tuple(row) for row in minted] * 2
+    random.shuffle(attempts)
+    chunks = [attempts[i::threads] for i in range(threads)]
+    wins = []
+
+    def worker(chunk):
+        won = 0
+        with app.app_context():
+            for code_id, code in chunk:
+                if discount_campaigns.might_exist(code) and discount_campaigns.redeem(db.session, code_id):
+                    db.session.commit()
+                    won += 1
+                else:
+                    db.session.rollback()
+        wins.append(won)
+
+    elapsed = run_threads(worker, chunks)
+    print(f"  {len(attempts)} redemption attempts with {threads} threads in {elapsed:.2f}s: "
+          f"{sum(wins) / elapsed:.0f} redemptions/s, {len(attempts) / elapsed:.0f} attempts/s")
+    print(f"  codes redeemed: {sum(wins)} of {len(minted)} (double redemptions: {max(0, sum(wins) - len(minted))})")
+
+    # guessed codes go through the same might_exist() as checkout, counting what reaches the database
+    guesses_list = [discount_campaigns.new_code(prefix, 10) for _ in range(guesses)]
+    false_positives, queries = [], []
+
+    def count_query(*args):
+        queries.append(1)
+
+    def guesser(chunk):
+        with app.app_context():
+            false_positives.append(sum(1 for code in chunk if discount_campaigns.might_exist(code)))
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            elapsed = run_threads(guesser, [guesses_list[i::threads] for i in range(threads)])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_query)
+    print(f"  {guesses} guessed codes with {threads} threads: {guesses / elapsed:.0f}/s, "
+          f"{len(queries)} database queries, false positives: {sum(false_positives) / guesses:.2%}")
+
+
+def _seed_checkout_data(customers=200, drivers=20):
+    """A small catalog and customer base for the order write benchmarks."""
+    tag = f"{random.randrange(10 ** 6):06d}"
+    postal_codes = [f"{6200 + i}" for i in range(10)]
+    pizza = Pizza(pizza_name=f"Bench Margherita {tag}", base_price=8.0, category="Vegetarian")
+    drink = Drink(drink_name="Bench Cola", drink_price=2.5)
+    db.session.add_all([pizza, drink])
+    db.session.add_all(
+        Customer(first_name="Bench", last_name=f"Customer {i}", phone_number=f"bench-{tag}-{i}",
+                 birthdate=date(1990, 1, 1), address="Benchstraat 1", postal_code=postal_codes[i % 10],
+                 password_hash="-")
+        for i in range(customers))
+    db.session.add_all(
+        DeliveryPerson(first_name="Bench", last_name=f"Driver {i}", phone_number=f"bench-{tag}-d{i}",
+                       postal_code=postal_codes[i % 10], available_at=datetime.utcnow())
+        for i in range(drivers))
+    db.session.commit()
+    customer_ids = list(db.session.scalars(select(Customer.id).where(Customer.phone_number.like(f"bench-{tag}-%"))))
+    return customer_ids, pizza.id, drink.id
+
+
+def bench_group_commit(app, threads=8, orders=2000):
+    bulk_orders.init_app(app)
+    with app.app_context():
+        customer_ids, pizza_id, drink_id = _seed_checkout_data()
+
+    def requests(count):
+        return [{"customer_id": random.choice(customer_ids), "pizzas": {str(pizza_id): random.randint(1, 3)},
+                 "drinks": {str(drink_id): 1}} for _ in range(count)]
+
+    # the same bulk_orders.place() work either way, only the transactions differ
+    def per_request(chunk):
+        with app.app_context():
+            for order_request in chunk:
+                bulk_orders.place([order_request])
+                db.session.commit()
+
+    work = requests(orders)
+    elapsed = run_threads(per_request, [work[i::threads] for i in range(threads)])
+    baseline = orders / elapsed
+    print(f"  {orders} checkouts, one commit each, {threads} threads: {baseline:.0f} orders/s")
+
+    writer = GroupCommitWriter(app)
+    failed = []
+
+    def grouped(chunk):
+        for order_request in chunk:
+            result = writer.place(order_request)
+            if not result or not result["ok"]:
+                failed.append(result)
+
+    work = requests(orders)
+    elapsed = run_threads(grouped, [work[i::threads] for i in range(threads)])
+    print(f"  {orders} checkouts, group commit ({writer.window * 1000:g} ms window), {threads} threads: "
+          f"{orders / elapsed:.0f} orders/s ({orders / elapsed / baseline:.1f}x), "
+          f"{writer.orders / max(writer.batches, 1):.1f} orders per commit, {len(failed)} failed")
+
+
+BENCHMARKS = {
+    "discount_redemption": bench_discount_redemption,
+    "group_commit": bench_group_commit,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for Pizza Crisis hot paths.")
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="defaults to a temporary SQLite file")
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if not database_url:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    bench_app = make_app(database_url)
+
+    for name in args.names:
+        print(f"{name} ({database_url})")
+        BENCHMARKS[name](bench_app, threads=args.threads)
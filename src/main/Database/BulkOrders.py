@@ -0,0 +1,338 @@
+import heapq
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.orm import selectinload
+
+from Model import (
+    db, Customer, DeliveryPerson, Dessert, DiscountCode, Drink, Order, OrderDessert, OrderDrink, OrderPizza,
+    Payment, Pizza, birth_month_day
+)
+from Archive import archive
+from DiscountCampaign import discount_campaigns
+from PricingRules import pricing
+from Inventory import inventory, OutOfStock
+from DeliveryEta import delivery_eta
+from Sharding import shard_router
+
+
+LINE_KINDS = ("pizzas", "drinks", "desserts")
+
+
+class OrderRejected(ValueError):
+    pass
+
+
+class BulkOrderWriter:
+    """Validates, prices and inserts many orders in one transaction.
+
+    Everything the orders refer to (customers, catalog prices, loyalty counts,
+    discount codes, free drivers) is loaded with one set-based query per table, and
+    orders, lines and payments are written with bulk INSERTs. Orders that fail
+    validation are reported individually and the rest of the batch still goes in.
+    The whole batch is priced with one PricingPlan, like a single checkout. With
+    sharding on, the batch is split by the customers' shards and each part is
+    written to its own shard.
+    """
+
+    def __init__(self, app=None):
+        self.max_batch = 1000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_batch = app.config.get("BULK_ORDER_MAX_BATCH", 1000)
+
+    # lookups
+
+    @staticmethod
+    def _ids(requests, kind):
+        ids = set()
+        for request in requests:
+            items = request.get(kind)
+            for item_id in items if isinstance(items, dict) else ():
+                try:
+                    ids.add(int(item_id))
+                except (TypeError, ValueError):
+                    pass  # rejected with the order itself
+        return ids
+
+    def _load_prices(self, requests, plan):
+        pizza_ids = self._ids(requests, "pizzas")
+        drink_ids = self._ids(requests, "drinks")
+        dessert_ids = self._ids(requests, "desserts")
+        pizzas = db.session.scalars(
+            select(Pizza).options(selectinload(Pizza.ingredients)).where(Pizza.id.in_(pizza_ids))
+        ).all() if pizza_ids else []
+        drinks = db.session.execute(
+            select(Drink.id, Drink.drink_price).where(Drink.id.in_(drink_ids))).all() if drink_ids else []
+        desserts = db.session.execute(
+            select(Dessert.id, Dessert.dessert_price).where(Dessert.id.in_(dessert_ids))).all() if dessert_ids else []
+        return {
+            "pizzas": {pizza.id: pizza.final_amount(plan) for pizza in pizzas},
+            "drinks": dict(drinks),
+            "desserts": dict(desserts),
+        }
+
+    @staticmethod
+    def _load_customers(customer_ids):
+        if not customer_ids:
+            return {}, {}
+        customers = {
+            row.id: row for row in db.session.execute(
+                select(Customer.id, Customer.postal_code, Customer.birth_month_day)
+                .where(Customer.id.in_(customer_ids)))
+        }
+        pizza_counts = dict(db.session.execute(
+            select(Order.customer_id, func.sum(OrderPizza.quantity))
+            .join(OrderPizza, OrderPizza.order_id == Order.id)
+            .where(Order.customer_id.in_(customers))
+            .group_by(Order.customer_id)
+        ).all())
+        past_pizzas = {
+            customer_id: int(pizza_counts.get(customer_id) or 0) + archive.pizza_count(customer_id)
+            for customer_id in customers
+        }
+        return customers, past_pizzas
+
+    @staticmethod
+    def _load_codes(codes):
+        known = [code for code in codes if discount_campaigns.might_exist(code)]
+        if not known:
+            return {}
+        rows = db.session.execute(
+            select(DiscountCode.id, DiscountCode.code, DiscountCode.discount_percentage,
+                   DiscountCode.is_used, DiscountCode.expires_at)
+            .where(DiscountCode.code.in_(known))).all()
+        return {row.code: row for row in rows}
+
+    @staticmethod
+    def _free_drivers(postal_codes, now):
+        """Heap of free drivers per postal code, earliest available first."""
+        drivers = defaultdict(list)
+        if postal_codes:
+            rows = db.session.execute(
+                select(DeliveryPerson.id, DeliveryPerson.postal_code, DeliveryPerson.available_at)
+                .where(DeliveryPerson.postal_code.in_(postal_codes), DeliveryPerson.available_at <= now)
+                .with_for_update()
+            ).all()
+            for driver_id, postal_code, available_at in rows:
+                heapq.heappush(drivers[postal_code], (available_at, driver_id))
+        return drivers
+
+    # validation and pricing
+
+    @staticmethod
+    def _lines(request, prices):
+        lines = {}
+        for kind in LINE_KINDS:
+            items = request.get(kind) or {}
+            if not isinstance(items, dict):
+                raise OrderRejected(f"'{kind}' must map item ids to quantities")
+            lines[kind] = {}
+            for item_id, quantity in items.items():
+                try:
+                    item_id, quantity = int(item_id), int(quantity)
+                except (TypeError, ValueError):
+                    raise OrderRejected(f"Invalid {kind} line {item_id!r}: {quantity!r}")
+                if quantity < 1:
+                    raise OrderRejected(f"Quantity for {kind} {item_id} must be positive")
+                if item_id not in prices[kind]:
+                    raise OrderRejected(f"{kind.capitalize()[:-1]} with ID {item_id} not found.")
+                lines[kind][item_id] = lines[kind].get(item_id, 0) + quantity
+        if not any(lines.values()):
+            raise OrderRejected("Order has no items")
+        return lines
+
+    @staticmethod
+    def _price(plan, lines, prices, past_pizzas, is_birthday, code_percentage, now):
+        pizza_lines = [(prices["pizzas"][pizza_id], quantity) for pizza_id, quantity in lines["pizzas"].items()]
+        total = sum(prices[kind][item_id] * quantity for kind in LINE_KINDS for item_id, quantity in lines[kind].items())
+        return plan.apply(total, pizza_lines, past_pizzas, is_birthday, code_percentage, now)
+
+    @staticmethod
+    def _reserve_stock(validated, results):
+        """Take ingredients for the whole batch at once, or order by order when it falls short.
+
+        Returns the orders that got their ingredients and {index: needs} of what they took.
+        """
+        needs = {index: inventory.needs_for(lines["pizzas"]) for index, _, _, lines in validated}
+        batch_needs = defaultdict(int)
+        for order_needs in needs.values():
+            for ingredient_id, portions in order_needs.items():
+                batch_needs[ingredient_id] += portions
+        try:
+            inventory.reserve(db.session, batch_needs)
+            return validated, needs
+        except OutOfStock:
+            pass
+        in_stock = []
+        for order in validated:
+            try:
+                inventory.reserve(db.session, needs[order[0]])
+                in_stock.append(order)
+            except OutOfStock as e:
+                results[order[0]] = {"index": order[0], "ok": False, "error": str(e)}
+        return in_stock, needs
+
+    # writing
+
+    def _insert_orders(self, rows):
+        """Insert order rows and return their new ids in the same order."""
+        if db.session.get_bind(Order).dialect.insert_executemany_returning:
+            # autoincrement ids follow the VALUES order, so sorting them restores the row order
+            # (sort_by_parameter_order would fall back to one INSERT per row on SQLite)
+            return sorted(db.session.scalars(insert(Order).returning(Order.id), rows))
+        # without multi-row RETURNING (MySQL) the ORM flush still batches everything in this transaction
+        orders = [Order(**row) for row in rows]
+        db.session.add_all(orders)
+        db.session.flush()
+        return [order.id for order in orders]
+
+    def place(self, requests, now=None):
+        """Place a batch of orders; returns one result dict per request, in order.
+
+        Each request is {"customer_id": int, "pizzas": {id: qty}, "drinks": {...},
+        "desserts": {...}, "discount_code": optional str}. The caller commits.
+        """
+        now = now or datetime.utcnow()
+        plan = pricing.plan
+        if not shard_router.enabled:
+            return self._place(requests, now, plan)
+
+        customer_ids = {request["customer_id"] for request in requests
+                        if isinstance(request, dict) and isinstance(request.get("customer_id"), int)}
+        postal_codes = dict(db.session.execute(
+            select(Customer.id, Customer.postal_code).where(Customer.id.in_(customer_ids))).all()) if customer_ids else {}
+        by_shard = defaultdict(list)
+        for index, request in enumerate(requests):
+            customer_id = request.get("customer_id") if isinstance(request, dict) else None
+            postal_code = postal_codes.get(customer_id) if isinstance(customer_id, int) else None
+            # unknown customers land on the first shard and are rejected there
+            by_shard[shard_router.shard_for(postal_code)].append(index)
+
+        results = [None] * len(requests)
+        for shard, indexes in by_shard.items():
+            with shard_router.using(shard):
+                for index, result in zip(indexes, self._place([requests[i] for i in indexes], now, plan)):
+                    results[index] = dict(result, index=index)
+        return results
+
+    def _place(self, requests, now, plan):
+        today_key = birth_month_day(date.today())
+        valid_requests = [request for request in requests if isinstance(request, dict)]
+
+        prices = self._load_prices(valid_requests, plan)
+        customer_ids = {r["customer_id"] for r in valid_requests if isinstance(r.get("customer_id"), int)}
+        customers, past_pizzas = self._load_customers(customer_ids)
+        codes = self._load_codes({r["discount_code"] for r in valid_requests if isinstance(r.get("discount_code"), str)})
+        drivers = self._free_drivers({customer.postal_code for customer in customers.values()}, now)
+
+        results = [None] * len(requests)
+        validated = []
+        for index, request in enumerate(requests):
+            try:
+                if not isinstance(request, dict):
+                    raise OrderRejected("Order must be an object")
+                customer_id = request.get("customer_id")
+                if not isinstance(customer_id, int):
+                    raise OrderRejected(f"customer_id must be an integer, got {customer_id!r}")
+                customer = customers.get(customer_id)
+                if customer is None:
+                    raise OrderRejected(f"Customer {request.get('customer_id')!r} not found.")
+                lines = self._lines(request, prices)
+            except OrderRejected as e:
+                results[index] = {"index": index, "ok": False, "error": str(e)}
+                continue
+            validated.append((index, request, customer, lines))
+
+        validated, reserved = self._reserve_stock(validated, results)
+
+        accepted = []
+        for index, request, customer, lines in validated:
+            discounts = []
+            code = None
+            code_input = request.get("discount_code")
+            if code_input:
+                code = codes.get(code_input) if isinstance(code_input, str) else None
+                if code is None:
+                    discounts.append("❌ Invalid discount code")
+                elif code.expires_at <= datetime.now():
+                    discounts.append("❌ Code expired")
+                    code = None
+                elif code.is_used:
+                    discounts.append("❌ Code already used")
+                    code = None
+
+            now_local = datetime.now()
+            is_birthday = customer.birth_month_day == today_key
+            total, applied = self._price(
+                plan, lines, prices, past_pizzas[customer.id], is_birthday, None, now_local)
+            if code is not None:
+                with_code, code_applied = self._price(
+                    plan, lines, prices, past_pizzas[customer.id], is_birthday, code.discount_percentage, now_local)
+                # a stopping rule or the discount cap can leave the code without effect; it is then not spent
+                if with_code >= total:
+                    discounts.append("ℹ️ Code not used: it would not lower this order's total")
+                    code = None
+                elif not discount_campaigns.redeem(db.session, code.id):
+                    # conditional redemption, also catches a second use inside this batch
+                    discounts.append("❌ Code already used")
+                    code = None
+                else:
+                    total, applied = with_code, code_applied
+            past_pizzas[customer.id] += sum(lines["pizzas"].values())
+            accepted.append((index, customer, lines, code, total, applied + discounts))
+
+        if not accepted:
+            return results
+
+        order_rows = []
+        driver_updates = []
+        for index, customer, lines, code, total, applied in accepted:
+            free = drivers.get(customer.postal_code)
+            row = {"customer_id": customer.id, "order_date": now,
+                   "discount_id": code.id if code is not None else None}
+            if free:
+                _, driver_id = heapq.heappop(free)
+                estimated, available_at = delivery_eta.dispatch(customer.postal_code, now)
+                row.update(delivery_person_id=driver_id, status="OUT_FOR_DELIVERY", dispatched_at=now,
+                           estimated_delivery_time=estimated)
+                driver_updates.append({"id": driver_id, "available_at": available_at})
+            else:
+                row.update(delivery_person_id=None, status="PENDING_ASSIGNMENT", dispatched_at=None,
+                           estimated_delivery_time=delivery_eta.pending(customer.postal_code, now))
+            order_rows.append(row)
+
+        order_ids = self._insert_orders(order_rows)
+
+        line_rows = {kind: [] for kind in LINE_KINDS}
+        payment_rows = []
+        for order_id, (index, customer, lines, code, total, applied), row in zip(order_ids, accepted, order_rows):
+            for item_id, quantity in lines["pizzas"].items():
+                line_rows["pizzas"].append({"order_id": order_id, "pizza_id": item_id, "quantity": quantity,
+                                            "unit_price": prices["pizzas"][item_id]})
+            for item_id, quantity in lines["drinks"].items():
+                line_rows["drinks"].append({"order_id": order_id, "drink_id": item_id, "quantity": quantity})
+            for item_id, quantity in lines["desserts"].items():
+                line_rows["desserts"].append({"order_id": order_id, "dessert_id": item_id, "quantity": quantity})
+            payment_rows.append({"order_id": order_id, "amount": total, "payment_date": now})
+            results[index] = {
+                "index": index, "ok": True, "order_id": order_id, "status": row["status"], "total": total,
+                "discounts": applied, "delivery_person_id": row["delivery_person_id"],
+                "estimated_delivery_time": row["estimated_delivery_time"].isoformat(timespec="minutes"),
+            }
+
+        for model, kind in ((OrderPizza, "pizzas"), (OrderDrink, "drinks"), (OrderDessert, "desserts")):
+            if line_rows[kind]:
+                db.session.execute(insert(model), line_rows[kind])
+        db.session.execute(insert(Payment), payment_rows)
+        inventory.record_reservations(
+            db.session, {order_id: reserved[accepted_order[0]] for order_id, accepted_order in zip(order_ids, accepted)})
+        if driver_updates:
+            db.session.execute(update(DeliveryPerson), driver_updates)
+        return results
+
+
+bulk_orders = BulkOrderWriter()
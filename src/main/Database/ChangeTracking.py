@@ -0,0 +1,67 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class ChangeTracker:
+    """Hands what each transaction wrote to the in-memory caches once it commits.
+
+    A subscriber keeps some pending state per session: `start()` creates it,
+    `flushed(pending, session)` adds a flush (session.new, dirty and deleted still
+    list the flushed objects), and `bulk(pending, model, orm_execute_state)` adds an
+    ORM insert, update or delete statement, which bypasses the flush; `model` is
+    None when the statement has no mapped entity. Both return the new pending state.
+    After the commit `committed(pending)` receives it, a rollback drops it, and a
+    transaction that wrote nothing calls nobody.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, name, committed, start=set, flushed=None, bulk=None):
+        self._subscribers[name] = (start, flushed, bulk, committed)
+
+    @staticmethod
+    def _pending(session):
+        return session.info.setdefault("tracked_changes", {})
+
+    def flushed(self, session):
+        pending = self._pending(session)
+        for name, (start, flushed, _, _) in self._subscribers.items():
+            if flushed is not None:
+                pending[name] = flushed(pending[name] if name in pending else start(), session)
+
+    def bulk(self, orm_execute_state):
+        mapper = orm_execute_state.bind_mapper
+        model = mapper.class_ if mapper is not None else None
+        pending = self._pending(orm_execute_state.session)
+        for name, (start, _, bulk, _) in self._subscribers.items():
+            if bulk is not None:
+                pending[name] = bulk(pending[name] if name in pending else start(), model, orm_execute_state)
+
+    def committed(self, session):
+        for name, changes in session.info.pop("tracked_changes", {}).items():
+            self._subscribers[name][3](changes)
+
+
+change_tracker = ChangeTracker()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_flushed_changes(session, flush_context):
+    change_tracker.flushed(session)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        change_tracker.bulk(orm_execute_state)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed_changes(session):
+    change_tracker.committed(session)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_changes(session):
+    session.info.pop("tracked_changes", None)
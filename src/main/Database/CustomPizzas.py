@@ -0,0 +1,149 @@
+import threading
+
+import numpy as np
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from Model import db, Ingredient, Pizza, pizzaingredient
+from PricingRules import pricing
+from ResponseCache import response_cache
+
+
+class PizzaBuilder:
+    """Build-your-own pizzas described by a bitmask of ingredient ids.
+
+    Ingredient prices and diet flags are cached as vectors indexed by ingredient id
+    (reloaded when the catalog version changes), so a mask is priced and classified
+    Vegan/Vegetarian/Normal with a couple of array operations. Every distinct mask is
+    stored once as a custom Pizza row keyed by the hex mask, and later orders of the
+    same combination reuse it. Custom pizzas bump their own version instead of the
+    catalog's, so the menu and report caches stay warm.
+    """
+
+    def __init__(self, app=None):
+        self.base_price = 5.00
+        self.max_ingredients = 8
+        self._catalog_version = None
+        self._lock = threading.Lock()
+        self.ingredients = []
+        self.prices = np.zeros(0)
+        self.vegan = np.zeros(0, dtype=bool)
+        self.vegetarian = np.zeros(0, dtype=bool)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.base_price = app.config.get("CUSTOM_PIZZA_BASE_PRICE", 5.00)
+        self.max_ingredients = app.config.get("CUSTOM_PIZZA_MAX_INGREDIENTS", 8)
+        self._catalog_version = None
+
+    def _load(self):
+        with self._lock:
+            if self._catalog_version == response_cache.catalog_version:
+                return
+            rows = db.session.execute(
+                select(Ingredient.id, Ingredient.ingredient_name, Ingredient.ingredient_price,
+                       Ingredient.is_vegan, Ingredient.is_vegetarian)
+                .order_by(Ingredient.ingredient_name)).all()
+            size = max((row.id for row in rows), default=-1) + 1
+            prices = np.zeros(size)
+            vegan = np.zeros(size, dtype=bool)
+            vegetarian = np.zeros(size, dtype=bool)
+            for row in rows:
+                prices[row.id] = row.ingredient_price
+                vegan[row.id] = bool(row.is_vegan)
+                vegetarian[row.id] = bool(row.is_vegetarian or row.is_vegan)
+            self.ingredients = rows
+            self.prices, self.vegan, self.vegetarian = prices, vegan, vegetarian
+            self._catalog_version = response_cache.catalog_version
+
+    def available_ingredients(self):
+        self._load()
+        return self.ingredients
+
+    # masks
+
+    def mask_for(self, ingredient_ids):
+        self._load()
+        known = {row.id for row in self.ingredients}
+        mask = 0
+        for ingredient_id in ingredient_ids:
+            ingredient_id = int(ingredient_id)
+            if ingredient_id not in known:
+                raise ValueError(f"Ingredient with ID {ingredient_id} not found.")
+            mask |= 1 << ingredient_id
+        if not mask:
+            raise ValueError("Pick at least one ingredient.")
+        if bin(mask).count("1") > self.max_ingredients:
+            raise ValueError(f"A pizza can have at most {self.max_ingredients} ingredients.")
+        return mask
+
+    def selection(self, mask):
+        """Boolean vector over ingredient ids for a mask."""
+        size = len(self.prices)
+        raw = np.frombuffer(mask.to_bytes((size + 7) // 8 or 1, "little"), dtype=np.uint8)
+        return np.unpackbits(raw, bitorder="little")[:size].astype(bool)
+
+    @staticmethod
+    def key(mask):
+        return format(mask, "x")
+
+    # pricing and classification
+
+    def classify(self, mask):
+        self._load()
+        selected = self.selection(mask)
+        if self.vegan[selected].all():
+            return "Vegan"
+        if self.vegetarian[selected].all():
+            return "Vegetarian"
+        return "Normal"
+
+    def quote(self, mask, plan=None):
+        """(price, category, ingredient names) of a custom pizza."""
+        self._load()
+        selected = self.selection(mask)
+        category = self.classify(mask)
+        subtotal = self.base_price + float(self.prices @ selected)
+        names = [row.ingredient_name for row in self.ingredients if selected[row.id]]
+        return (plan or pricing.plan).pizza_price(subtotal, category), category, names
+
+    # storage
+
+    def get_or_create(self, mask):
+        """The custom Pizza for a mask, inserting it the first time; the caller commits."""
+        key = self.key(mask)
+        pizza = Pizza.query.filter_by(ingredient_key=key).first()
+        if pizza is not None:
+            return pizza
+
+        _, category, names = self.quote(mask)
+        name = "Custom: " + ", ".join(names)
+        if len(name) > 100:
+            name = f"{name[:90]}… #{key}"[:100]
+        # the mask makes the second name unique, should a menu pizza already use the first
+        tagged = f"{name[:100 - len(key) - 2]} #{key}"
+        candidates = [name] if tagged == name else [name, tagged]
+        selected = self.selection(mask)
+        for candidate in candidates:
+            try:
+                # a savepoint, so losing the race to another request leaves our transaction usable
+                with db.session.begin_nested():
+                    pizza = Pizza(pizza_name=candidate, base_price=self.base_price, category=category,
+                                  is_custom=True, ingredient_key=key)
+                    db.session.add(pizza)
+                    db.session.flush()
+                    # plain link rows, so the ingredients are not marked as changed catalog entries
+                    db.session.execute(insert(pizzaingredient), [
+                        {"pizza_id": pizza.id, "ingredient_id": int(i)} for i in np.flatnonzero(selected)])
+                    db.session.expire(pizza, ["ingredients"])
+                return pizza
+            except IntegrityError:
+                # either another request stored this mask first, or the name is taken
+                pizza = Pizza.query.filter_by(ingredient_key=key).one_or_none()
+                if pizza is not None:
+                    return pizza
+                if candidate == candidates[-1]:
+                    raise
+
+pizza_builder = PizzaBuilder()
@@ -0,0 +1,221 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+
+from Model import db, Customer, GenderEnum, age_bucket_for, birth_month_day
+
+
+REQUIRED_FIELDS = ("first_name", "last_name", "phone_number", "birthdate", "address", "postal_code", "password")
+
+
+def hash_password(password):
+    # module level so the process pool can pickle it
+    return generate_password_hash(password, method='pbkdf2:sha256')
+
+
+def read_records(path):
+    """(line number, record) pairs from a CSV file with a header row or a JSON-lines file."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield line_no, json.loads(line)
+                    except ValueError as e:
+                        yield line_no, e
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+
+
+class CustomerImporter:
+    """Streams customers from a file into the customers table.
+
+    Records are processed in chunks: each chunk is validated, checked for phone
+    numbers already taken (one IN query per chunk, plus a set of the numbers seen
+    earlier in the file), hashed on a process pool and written with one bulk
+    INSERT and one commit. A chunk that still hits a constraint after looking the
+    phone numbers up again is inserted row by row, and the rows that fail are
+    reported. After every chunk the last imported line is saved to a progress
+    file, so an interrupted import continues where it stopped. Rejected records go
+    to an error report next to it.
+    """
+
+    def __init__(self, path, workers=None, chunk_size=1000, state_dir=None, today=None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.today = today or date.today()
+        base = os.path.join(state_dir or os.path.dirname(os.path.abspath(path)), os.path.basename(path))
+        self.progress_path = base + ".progress.json"
+        self.errors_path = base + ".errors.csv"
+        self.stats = {"line": 0, "imported": 0, "duplicates": 0, "invalid": 0}
+        self._seen_phones = set()
+
+    # progress
+
+    def _load_progress(self):
+        try:
+            with open(self.progress_path, encoding="utf-8") as f:
+                self.stats.update(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    def _save_progress(self):
+        with open(self.progress_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.stats, f)
+        os.replace(self.progress_path + ".tmp", self.progress_path)
+
+    def _report(self, errors):
+        if not errors:
+            return
+        new_file = not os.path.exists(self.errors_path)
+        with open(self.errors_path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["line", "phone_number", "error"])
+            writer.writerows(errors)
+
+    # validation
+
+    def _row(self, record):
+        if isinstance(record, Exception):
+            raise ValueError(f"Unreadable record: {record}")
+        missing = [field for field in REQUIRED_FIELDS if not str(record.get(field) or "").strip()]
+        if missing:
+            raise ValueError(f"Missing {', '.join(missing)}")
+        birthdate = datetime.strptime(str(record["birthdate"]).strip(), "%Y-%m-%d").date()
+        if birthdate >= self.today:
+            raise ValueError("Birthdate must be in the past.")
+        for field in REQUIRED_FIELDS[:-1]:
+            limit = getattr(Customer.__table__.c[field].type, "length", None)
+            if limit and len(str(record[field]).strip()) > limit:
+                raise ValueError(f"{field} is longer than {limit} characters")
+        gender = str(record.get("gender") or "Other").strip().capitalize()
+        row = {
+            "first_name": str(record["first_name"]).strip(),
+            "last_name": str(record["last_name"]).strip(),
+            "phone_number": str(record["phone_number"]).strip(),
+            "birthdate": birthdate,
+            "address": str(record["address"]).strip(),
+            "postal_code": str(record["postal_code"]).strip(),
+            "gender": GenderEnum(gender),
+            # derived columns the Customer validator fills in for single inserts
+            "birth_month_day": birth_month_day(birthdate),
+            "age_bucket": age_bucket_for(birthdate, self.today),
+            "is_staff": False,
+        }
+        return row, str(record["password"])
+
+    # import
+
+    def _taken(self, phones):
+        return set(db.session.scalars(select(Customer.phone_number).where(Customer.phone_number.in_(phones))))
+
+    def _import_chunk(self, chunk, pool):
+        errors = []
+        candidates = []
+        for line_no, record in chunk:
+            try:
+                row, password = self._row(record)
+            except (ValueError, TypeError, AttributeError) as e:
+                errors.append((line_no, record.get("phone_number") if isinstance(record, dict) else "", str(e)))
+                self.stats["invalid"] += 1
+                continue
+            if row["phone_number"] in self._seen_phones:
+                errors.append((line_no, row["phone_number"], "Phone number appears earlier in the file."))
+                self.stats["duplicates"] += 1
+                continue
+            self._seen_phones.add(row["phone_number"])
+            candidates.append((line_no, row, password))
+
+        for attempt in range(2):
+            taken = self._taken([row["phone_number"] for _, row, _ in candidates]) if candidates else set()
+            for line_no, row, _ in candidates:
+                if row["phone_number"] in taken:
+                    errors.append((line_no, row["phone_number"], "Phone number already registered."))
+                    self.stats["duplicates"] += 1
+            candidates = [candidate for candidate in candidates if candidate[1]["phone_number"] not in taken]
+            if not candidates:
+                break
+
+            # only passwords of customers that will actually be inserted are hashed
+            hashes = pool.map(hash_password, [password for _, _, password in candidates],
+                              chunksize=max(1, len(candidates) // (4 * self.workers)))
+            rows = [dict(row, password_hash=password_hash) for (_, row, _), password_hash in zip(candidates, hashes)]
+            try:
+                db.session.execute(insert(Customer), rows)
+                db.session.commit()
+                self.stats["imported"] += len(rows)
+                break
+            except IntegrityError:
+                # somebody registered one of these numbers meanwhile, look them up again
+                db.session.rollback()
+                if attempt:
+                    self._insert_one_by_one(candidates, rows, errors)
+
+        self._report(errors)
+        self.stats["line"] = chunk[-1][0]
+        self._save_progress()
+
+    def _insert_one_by_one(self, candidates, rows, errors):
+        for (line_no, _, _), row in zip(candidates, rows):
+            try:
+                db.session.execute(insert(Customer), [row])
+                db.session.commit()
+                self.stats["imported"] += 1
+            except IntegrityError as e:
+                db.session.rollback()
+                errors.append((line_no, row["phone_number"], f"Could not be inserted: {e.orig}"))
+                self.stats["invalid"] += 1
+
+    def run(self, restart=False):
+        if restart:
+            for path in (self.progress_path, self.errors_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            self._load_progress()
+        resume_after = self.stats["line"]
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            chunk = []
+            for line_no, record in read_records(self.path):
+                if line_no <= resume_after:
+                    continue
+                chunk.append((line_no, record))
+                if len(chunk) == self.chunk_size:
+                    self._import_chunk(chunk, pool)
+                    chunk = []
+            if chunk:
+                self._import_chunk(chunk, pool)
+        return self.stats
+
+
+if __name__ == '__main__':
+    from App import create_app
+
+    parser = argparse.ArgumentParser(description="Import customers from a CSV or JSON-lines file.")
+    parser.add_argument("path", help="CSV with a header row, or .jsonl; fields: " + ", ".join(REQUIRED_FIELDS)
+                        + ", gender (optional)")
+    parser.add_argument("--workers", type=int, default=None, help="hashing processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and start over")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        importer = CustomerImporter(args.path, args.workers, args.chunk_size)
+        stats = importer.run(restart=args.restart)
+    print(f"Imported {stats['imported']} customers, skipped {stats['duplicates']} duplicates "
+          f"and {stats['invalid']} invalid records (up to line {stats['line']}).")
+    if stats["duplicates"] or stats["invalid"]:
+        print(f"Details in {importer.errors_path}")
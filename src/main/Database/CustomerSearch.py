@@ -0,0 +1,211 @@
+import bisect
+import re
+import threading
+import time
+from itertools import chain
+
+from sqlalchemy import func, select
+
+from ChangeTracking import change_tracker
+from Model import db, Customer
+
+
+_NON_DIGITS = re.compile(r"\D")
+# separators stripped from stored phone numbers when searching the database directly
+_PHONE_SEPARATORS = " ()+-./"
+
+
+def phone_key(phone_number):
+    return _NON_DIGITS.sub("", phone_number or "")
+
+
+def name_key(last_name):
+    return (last_name or "").strip().lower()
+
+
+def _phone_digits(column):
+    for separator in _PHONE_SEPARATORS:
+        column = func.replace(column, separator, "")
+    return column
+
+
+class CustomerSearch:
+    """Type-ahead customer lookup for staff, by phone number or last name prefix.
+
+    Two sorted lists of (key, customer id) pairs live in memory: phone numbers
+    reduced to their digits and lowercased last names. A prefix query is one bisect
+    plus a short scan, so answers come back in microseconds however many customers
+    there are. The index is built at startup, updated from committed changes made
+    through this process and rebuilt in a background thread every `ttl` seconds to
+    pick up anything written elsewhere (such as a CustomerImport run); searches keep
+    using the old index until the new one is ready. When the index is off or not
+    built yet, the search falls back to LIKE 'prefix%' queries on the same keys.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.ttl = 600
+        self.max_results = 20
+        self._lock = threading.Lock()
+        self._phones = []
+        self._names = []
+        self._customers = {}
+        self._built_at = None
+        self._building = False
+        self._missed = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("CUSTOMER_SEARCH_INDEX", True)
+        self.ttl = app.config.get("CUSTOMER_SEARCH_TTL", 600)
+        self.max_results = app.config.get("CUSTOMER_SEARCH_MAX_RESULTS", 20)
+        self._built_at = None
+
+    # index maintenance
+
+    @staticmethod
+    def _record(customer_id, first_name, last_name, phone_number, postal_code):
+        return {"id": customer_id, "first_name": first_name, "last_name": last_name,
+                "phone_number": phone_number, "postal_code": postal_code}
+
+    def _claim_rebuild(self):
+        with self._lock:
+            if self._building:
+                return False
+            self._building = True
+            self._missed = []
+            return True
+
+    def rebuild(self):
+        if self._claim_rebuild():
+            self._load()
+
+    def _rebuild_in_background(self):
+        if self._claim_rebuild():
+            threading.Thread(target=self._load_in_app_context, name="customer-search", daemon=True).start()
+
+    def _load_in_app_context(self):
+        with self.app.app_context():
+            try:
+                self._load()
+            finally:
+                db.session.remove()
+
+    def _load(self):
+        try:
+            rows = db.session.execute(select(
+                Customer.id, Customer.first_name, Customer.last_name, Customer.phone_number, Customer.postal_code)
+            ).all()
+            customers = {row.id: self._record(*row) for row in rows}
+            phones = sorted((phone_key(c["phone_number"]), c["id"]) for c in customers.values())
+            names = sorted((name_key(c["last_name"]), c["id"]) for c in customers.values())
+            with self._lock:
+                self._customers, self._phones, self._names = customers, phones, names
+                self._built_at = time.monotonic()
+                # commits that landed while we were reading may be missing from the snapshot
+                for record, deleted in self._missed:
+                    self._update(record, deleted)
+        finally:
+            with self._lock:
+                self._building = False
+                self._missed = []
+
+    @staticmethod
+    def _remove(entries, entry):
+        index = bisect.bisect_left(entries, entry)
+        if index < len(entries) and entries[index] == entry:
+            del entries[index]
+
+    def _update(self, record, deleted):
+        old = self._customers.pop(record["id"], None)
+        if old is not None:
+            self._remove(self._phones, (phone_key(old["phone_number"]), old["id"]))
+            self._remove(self._names, (name_key(old["last_name"]), old["id"]))
+        if not deleted:
+            self._customers[record["id"]] = record
+            bisect.insort(self._phones, (phone_key(record["phone_number"]), record["id"]))
+            bisect.insort(self._names, (name_key(record["last_name"]), record["id"]))
+
+    def apply(self, changes):
+        """Apply committed changes: (record, deleted) pairs, or None for "rebuild"."""
+        with self._lock:
+            if changes is None:
+                if self._built_at is not None:
+                    self._built_at = 0.0  # bulk statements changed rows we cannot see, rebuild on next search
+                return
+            if self._building:
+                self._missed.extend(changes)
+            if self._built_at is not None:
+                for record, deleted in changes:
+                    self._update(record, deleted)
+
+    # searching
+
+    def _scan(self, entries, prefix, limit):
+        found = []
+        index = bisect.bisect_left(entries, (prefix,))
+        while index < len(entries) and len(found) < limit and entries[index][0].startswith(prefix):
+            found.append(self._customers[entries[index][1]])
+            index += 1
+        return found
+
+    def _fallback(self, prefix, by_phone, limit):
+        # LIKE is case-insensitive on SQLite and MySQL, so last names keep their index
+        key = _phone_digits(Customer.phone_number) if by_phone else Customer.last_name
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = db.session.execute(
+            select(Customer.id, Customer.first_name, Customer.last_name, Customer.phone_number, Customer.postal_code)
+            .where(key.like(pattern, escape="\\"))
+            .order_by(key, Customer.id).limit(limit)
+        ).all()
+        return [self._record(*row) for row in rows]
+
+    def search(self, query, limit=None):
+        """Customers whose phone number (digits only) or last name starts with `query`."""
+        query = (query or "").strip()
+        limit = max(1, min(limit or self.max_results, self.max_results))
+        by_phone = not any(ch.isalpha() for ch in query)
+        prefix = phone_key(query) if by_phone else name_key(query)
+        if not prefix:
+            return []
+
+        if self.enabled:
+            if self._built_at is None or time.monotonic() - self._built_at > self.ttl:
+                self._rebuild_in_background()
+            with self._lock:
+                if self._built_at is not None:
+                    return self._scan(self._phones if by_phone else self._names, prefix, limit)
+        return self._fallback(prefix, by_phone, limit)
+
+
+customer_search = CustomerSearch()
+
+
+def _snapshot(customer, deleted):
+    return customer_search._record(customer.id, customer.first_name, customer.last_name,
+                                   customer.phone_number, customer.postal_code), deleted
+
+
+def _collect_customer_changes(changes, session):
+    if changes is None:
+        return None
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, Customer):
+            changes.append(_snapshot(obj, False))
+    for obj in session.deleted:
+        if isinstance(obj, Customer):
+            changes.append(_snapshot(obj, True))
+    return changes
+
+
+def _collect_bulk_customer_changes(changes, model, orm_execute_state):
+    if model is not None and issubclass(model, Customer):
+        return None
+    return changes
+
+
+change_tracker.subscribe("customer_search", customer_search.apply, start=list,
+                         flushed=_collect_customer_changes, bulk=_collect_bulk_customer_changes)
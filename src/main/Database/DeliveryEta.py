@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from Model import db, database_key, Customer, Order
+from Sharding import shard_router
+
+
+class DeliveryEta:
+    """Delivery time estimates learned from confirmed deliveries.
+
+    Every postal code has a histogram of dispatch-to-door minutes per hour of day
+    (one-minute bins up to `max_minutes`), and the same is kept summed over all
+    postal codes. An estimate is a quantile of the most specific histogram with at
+    least `min_samples` deliveries: postal code and hour, then postal code, then
+    hour, then everything, and finally `default_minutes`. Customers are promised
+    the `quantile` (p80 by default). A driver is booked for a typical round trip,
+    twice the `driver_quantile` (median) drive, or `default_minutes` in all while
+    nothing is learned; confirming a delivery rebooks the driver until one drive
+    back after the confirmation.
+
+    A cell whose count passes `max_samples` is halved, so older deliveries fade and
+    the estimates follow changes in traffic. The histograms are snapshotted to an
+    .npz file and rebuilt from the orders table when there is no snapshot, or only
+    one of another database.
+    """
+
+    def __init__(self, app=None):
+        self.quantile = 0.8
+        self.driver_quantile = 0.5
+        self.min_samples = 20
+        self.default_minutes = 30
+        self.pending_minutes = 30
+        self.max_minutes = 120
+        self.max_samples = 2000
+        self.snapshot_path = None
+        self.database = None
+        self.snapshot_interval = 60
+        self._lock = threading.Lock()
+        self._zones = {}
+        self._hours = np.zeros((24, self.max_minutes + 1))
+        self.loaded = False
+        self._dirty = False
+        self._saved_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.quantile = app.config.get("DELIVERY_ETA_QUANTILE", 0.8)
+        self.driver_quantile = app.config.get("DELIVERY_DRIVER_QUANTILE", 0.5)
+        self.min_samples = app.config.get("DELIVERY_ETA_MIN_SAMPLES", 20)
+        self.default_minutes = app.config.get("DELIVERY_ETA_DEFAULT_MINUTES", 30)
+        self.pending_minutes = app.config.get("DELIVERY_PENDING_MINUTES", 30)
+        self.max_minutes = app.config.get("DELIVERY_ETA_MAX_MINUTES", 120)
+        self.max_samples = app.config.get("DELIVERY_ETA_MAX_SAMPLES", 2000)
+        self.snapshot_interval = app.config.get("DELIVERY_ETA_SNAPSHOT_INTERVAL", 60)
+        self.snapshot_path = app.config.get(
+            "DELIVERY_ETA_SNAPSHOT_PATH", os.path.join(app.instance_path, "delivery_eta.npz"))
+        self.database = database_key(app)
+        self._reset()
+        self._load_snapshot()
+
+    def _reset(self):
+        self._zones = {}
+        self._hours = np.zeros((24, self.max_minutes + 1))
+        self.loaded = False
+
+    # snapshot handling
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with np.load(self.snapshot_path, allow_pickle=False) as data:
+                zones, counts = data["zones"], data["counts"]
+                database = str(data["database"]) if "database" in data.files else None
+            if database != self.database:
+                print("Delivery ETA snapshot is from another database, rebuilding")
+                return
+            if counts.shape[1:] != self._hours.shape:
+                print("Delivery ETA snapshot has an older layout, rebuilding")
+                return
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Delivery ETA snapshot could not be loaded, rebuilding: {e}")
+            return
+        with self._lock:
+            self._zones = {str(zone): counts[i].copy() for i, zone in enumerate(zones)}
+            self._hours = counts.sum(axis=0) if len(zones) else self._hours
+            self.loaded = True
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            zones = sorted(self._zones)
+            counts = np.stack([self._zones[zone] for zone in zones]) if zones else np.zeros((0,) + self._hours.shape)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = self.snapshot_path + ".tmp.npz"
+        np.savez(tmp_path, database=np.array(self.database), zones=np.array(zones, dtype=str), counts=counts)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def rebuild(self):
+        """Recount every delivered order that has both timestamps."""
+        rows = []
+        for _ in shard_router.each():
+            rows.extend(db.session.execute(
+                select(Order.customer_id, Order.dispatched_at, Order.delivered_at)
+                .where(Order.status == "DELIVERED", Order.dispatched_at.is_not(None), Order.delivered_at.is_not(None))
+            ).all())
+        rows.sort(key=lambda row: row.delivered_at)
+
+        # customers stay on the primary, so their postal codes are looked up separately
+        postal_codes = {}
+        customer_ids = list({row.customer_id for row in rows})
+        for start in range(0, len(customer_ids), 1000):
+            postal_codes.update(db.session.execute(
+                select(Customer.id, Customer.postal_code).where(Customer.id.in_(customer_ids[start:start + 1000]))
+            ).all())
+
+        with self._lock:
+            self._reset()
+            for customer_id, dispatched_at, delivered_at in rows:
+                if customer_id in postal_codes:
+                    self._add(postal_codes[customer_id], dispatched_at, delivered_at)
+            self.loaded = True
+        self.save_snapshot()
+        return len(rows)
+
+    # recording
+
+    def _add(self, postal_code, dispatched_at, delivered_at):
+        minutes = (delivered_at - dispatched_at).total_seconds() / 60
+        if minutes < 0:
+            return
+        hour = dispatched_at.hour
+        minute_bin = min(int(minutes), self.max_minutes)
+        zone = self._zones.get(postal_code)
+        if zone is None:
+            zone = self._zones[postal_code] = np.zeros_like(self._hours)
+        if zone[hour].sum() >= self.max_samples:
+            self._hours[hour] -= zone[hour] / 2
+            zone[hour] /= 2
+        zone[hour, minute_bin] += 1
+        self._hours[hour, minute_bin] += 1
+        self._dirty = True
+
+    def record(self, postal_code, dispatched_at, delivered_at):
+        """Learn from one confirmed delivery."""
+        if dispatched_at is None or delivered_at is None:
+            return
+        with self._lock:
+            self._add(postal_code, dispatched_at, delivered_at)
+            save = time.monotonic() - self._saved_at >= self.snapshot_interval
+        if save:
+            self.save_snapshot()
+
+    def flush(self):
+        if self._dirty:
+            self.save_snapshot()
+
+    # estimates
+
+    def _quantile(self, histogram, quantile):
+        cumulative = np.cumsum(histogram)
+        # the upper edge of the bin holding the quantile
+        return int(np.searchsorted(cumulative, quantile * cumulative[-1])) + 1
+
+    def _learned_minutes(self, postal_code, when, quantile):
+        hour = when.hour
+        with self._lock:
+            zone = self._zones.get(postal_code)
+            candidates = []
+            if zone is not None:
+                candidates += [zone[hour], zone.sum(axis=0)]
+            candidates += [self._hours[hour], self._hours.sum(axis=0)]
+            for histogram in candidates:
+                if histogram.sum() >= self.min_samples:
+                    return self._quantile(histogram, quantile)
+        return None
+
+    def minutes(self, postal_code, when, quantile=None):
+        minutes = self._learned_minutes(postal_code, when, self.quantile if quantile is None else quantile)
+        return self.default_minutes if minutes is None else minutes
+
+    def return_trip(self, postal_code, when):
+        """Typical drive back to the shop, half the default round trip while nothing is learned."""
+        minutes = self._learned_minutes(postal_code, when, self.driver_quantile)
+        return timedelta(minutes=self.default_minutes / 2 if minutes is None else minutes)
+
+    def dispatch(self, postal_code, now):
+        """(estimated delivery time, driver available at) for an order handed to a driver now."""
+        estimate = now + timedelta(minutes=self.minutes(postal_code, now))
+        return estimate, now + 2 * self.return_trip(postal_code, now)
+
+    def pending(self, postal_code, now):
+        """Estimated delivery time for an order still waiting for a driver."""
+        return now + timedelta(minutes=self.pending_minutes + self.minutes(postal_code, now))
+
+    def stats(self):
+        with self._lock:
+            return {"zones": len(self._zones), "deliveries": int(self._hours.sum())}
+
+
+delivery_eta = DeliveryEta()
@@ -0,0 +1,103 @@
+import bisect
+import threading
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import select, update, or_
+
+from Model import db, Customer, age_bucket_for, birth_month_day
+
+
+def birthday_keys(today):
+    """Birthdays that make customers one year older today; Feb 29 counts on Mar 1 in common years."""
+    keys = [birth_month_day(today)]
+    if today.month == 3 and today.day == 1 and (today - timedelta(days=1)).day == 28:
+        keys.append("02-29")
+    return keys
+
+
+class CustomerDemographics:
+    """Precomputed customer attributes behind the staff report filters.
+
+    Age buckets and birthday keys are stored on the customers table (both indexed),
+    so filters become equality lookups. Only customers whose birthday is today can
+    change bucket, which keeps the daily refresh small. The postal code list is
+    cached in memory and kept current on register.
+    """
+
+    def __init__(self, app=None):
+        self.postal_code_ttl = 600
+        self.chunk_size = 1000
+        self._postal_codes = None
+        self._postal_codes_loaded_at = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.postal_code_ttl = app.config.get("POSTAL_CODE_CACHE_TTL", 600)
+        self._postal_codes = None
+
+    # postal codes
+
+    def postal_codes(self):
+        with self._lock:
+            expired = time.monotonic() - self._postal_codes_loaded_at > self.postal_code_ttl
+            if self._postal_codes is None or expired:
+                rows = db.session.execute(
+                    select(Customer.postal_code).distinct().order_by(Customer.postal_code)).all()
+                self._postal_codes = [row[0] for row in rows]
+                self._postal_codes_loaded_at = time.monotonic()
+            return list(self._postal_codes)
+
+    def note_postal_code(self, postal_code):
+        with self._lock:
+            if self._postal_codes is not None:
+                index = bisect.bisect_left(self._postal_codes, postal_code)
+                if index == len(self._postal_codes) or self._postal_codes[index] != postal_code:
+                    self._postal_codes.insert(index, postal_code)
+
+    # age buckets and birthdays
+
+    def refresh_age_buckets(self, today=None, full=False):
+        """Recompute buckets for today's birthdays, or for everybody with `full`."""
+        today = today or date.today()
+        query = select(Customer.id, Customer.birthdate, Customer.age_bucket, Customer.birth_month_day)
+        if not full:
+            query = query.where(or_(
+                Customer.birth_month_day.in_(birthday_keys(today)),
+                Customer.birth_month_day.is_(None),
+                Customer.age_bucket.is_(None),
+            ))
+
+        updated = 0
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                query.where(Customer.id > last_id).order_by(Customer.id).limit(self.chunk_size)).all()
+            if not rows:
+                break
+            changes = []
+            for customer_id, birthdate, current_bucket, current_month_day in rows:
+                bucket = age_bucket_for(birthdate, today)
+                month_day = birth_month_day(birthdate)
+                if (bucket, month_day) != (current_bucket, current_month_day):
+                    changes.append({"id": customer_id, "age_bucket": bucket, "birth_month_day": month_day})
+            if changes:
+                db.session.execute(update(Customer), changes)
+                updated += len(changes)
+            last_id = rows[-1][0]
+        db.session.commit()
+        return updated
+
+    def birthdays_today(self, today=None):
+        today = today or date.today()
+        return (
+            Customer.query
+            .filter(Customer.birth_month_day == birth_month_day(today))
+            .order_by(Customer.last_name, Customer.first_name)
+            .all()
+        )
+
+
+demographics = CustomerDemographics()
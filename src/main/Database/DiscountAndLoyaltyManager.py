@@ -1,59 +1,83 @@
 from datetime import date, datetime
-from Model import DiscountCode
+from Model import DiscountCode, birth_month_day
+from Archive import archive
+from DiscountCampaign import discount_campaigns
+from PricingRules import pricing
 
 class DiscountAndLoyaltyManager:
-    def __init__(self, customer, order, discount_code=None):
+    def __init__(self, customer, order, discount_code=None, redeem=True, plan=None):
         self.customer = customer
         self.order = order
         self.discount_code = discount_code
+        self.redeem = redeem  # False when only quoting the basket
+        self.plan = plan or pricing.plan
         self.applied_discounts = []
-        self.final_total = order.total_amount
+        self.final_total = 0.0
         self.invalid_code = False
+        self.code_message = None
 
-    def apply_loyalty_discount(self):
-
-        total_past_pizzas = sum(
+    def past_pizzas(self):
+        return sum(
             sum(pizza_assoc.quantity for pizza_assoc in order.pizzas)
-            for order in self.customer.orders
-        )
-        current_pizzas = sum(pizza_assoc.quantity for pizza_assoc in self.order.pizzas)
-        total_pizzas = total_past_pizzas + current_pizzas
-        if total_pizzas >= 10:
-            self.final_total *= 0.90
-            self.applied_discounts.append("⭐ 10% Loyalty Discount (10+ pizzas total)")
-
-    def apply_birthday_discount(self):
-        today = date.today()
-        if self.customer.birthdate.month == today.month and self.customer.birthdate.day == today.day:
-            cheapest = min((p.final_amount() for p in self.order.pizzas), default=0)
-            if cheapest > 0:
-                self.final_total -= cheapest
-                self.applied_discounts.append("🎂 Birthday Free Pizza!")
-
-    def apply_discount_code(self, db_session):
+            for order in self.customer.orders if order is not self.order
+        ) + archive.pizza_count(self.customer.id)
+
+    def resolve_discount_code(self, db_session):
+        """The usable DiscountCode for the entered code, or None."""
         if not self.discount_code:
-            return
+            return None
+        if not discount_campaigns.might_exist(self.discount_code):
+            return self._reject("❌ Invalid discount code")
         code_obj = db_session.query(DiscountCode).filter_by(code=self.discount_code).first()
         if not code_obj:
-            self.applied_discounts.append("❌ Invalid discount code")
-            self.invalid_code = True
-            return
+            return self._reject("❌ Invalid discount code")
         if code_obj.is_used:
-            self.applied_discounts.append("❌ Code already used")
-            self.invalid_code = True
-            return
+            return self._reject("❌ Code already used")
         if code_obj.expires_at <= datetime.now():
-            self.applied_discounts.append("❌ Code expired")
-            self.invalid_code = True
-            return
-        self.final_total *= (1 - code_obj.discount_percentage / 100)
-        self.applied_discounts.append(f"✅ {code_obj.discount_percentage}% Discount Applied")
-        code_obj.is_used = True
-        db_session.commit()
+            return self._reject("❌ Code expired")
+        return code_obj
+
+    def _reject(self, message):
+        self.invalid_code = True
+        self.code_message = message
+        return None
 
     def apply_all_discounts(self, db_session):
-        self.apply_loyalty_discount()
-        self.apply_birthday_discount()
-        self.apply_discount_code(db_session)
-        final_total = round(float(self.final_total or 0.0), 2)
-        return final_total, self.applied_discounts
+        self.code_message = None
+        code_obj = self.resolve_discount_code(db_session)
+
+        pizza_lines = [(p.pizza.final_amount(self.plan), p.quantity) for p in self.order.pizzas]
+        total = (
+            sum(price * quantity for price, quantity in pizza_lines)
+            + sum(d.drink.drink_price * d.quantity for d in self.order.drinks)
+            + sum(d.dessert.dessert_price * d.quantity for d in self.order.desserts)
+        )
+
+        past_pizzas = self.past_pizzas()
+        is_birthday = self.customer.birth_month_day == birth_month_day(date.today())
+
+        def price(code_percentage):
+            return self.plan.apply(
+                total,
+                pizza_lines,
+                past_pizzas=past_pizzas,
+                is_birthday=is_birthday,
+                code_percentage=code_percentage,
+            )
+
+        self.final_total, self.applied_discounts = price(None)
+        if code_obj is not None:
+            with_code, labels = price(code_obj.discount_percentage)
+            # a stopping rule or the discount cap can leave the code without effect; it is then not spent
+            if with_code >= self.final_total:
+                self.code_message = "ℹ️ Code not used: it would not lower this order's total"
+            elif self.redeem and not discount_campaigns.redeem(db_session, code_obj.id):
+                # someone else may redeem the same code between our read and this update
+                self._reject("❌ Code already used")
+            else:
+                if self.redeem:
+                    self.order.discount_id = code_obj.id
+                self.final_total, self.applied_discounts = with_code, labels
+        if self.code_message:
+            self.applied_discounts.append(self.code_message)
+        return self.final_total, self.applied_discounts
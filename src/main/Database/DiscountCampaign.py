@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import math
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.exc import IntegrityError
+
+from Model import db, DiscountCode
+
+
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # no 0/O or 1/I look-alikes
+
+
+class CodeFilter:
+    """Bloom filter over discount codes: no false negatives, ~1% false positives at capacity."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1000)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, code):
+        digest = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, code):
+        for position in self._positions(code):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, code):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(code))
+
+
+class DiscountCampaigns:
+    """Bulk minting and fast validation of single-use discount codes.
+
+    Every code is kept in an in-memory Bloom filter that is rebuilt at startup. When
+    a code the filter does not know is checked, the filter is first topped up from
+    new rows, so codes minted by another process work within `sync_interval`
+    seconds. The top-up runs at most once per interval and never makes a request
+    wait for another's, so a flood of guessed codes costs at most one primary-key
+    range read per interval. Redemption is a conditional UPDATE that only succeeds
+    for one caller, however many try the same code at once.
+    """
+
+    def __init__(self, app=None):
+        self.capacity = 1_000_000
+        self.sync_interval = 1.0
+        self.batch_size = 10_000
+        self._filter = None
+        self._last_id = 0
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.capacity = app.config.get("DISCOUNT_FILTER_CAPACITY", 1_000_000)
+        self.sync_interval = app.config.get("DISCOUNT_FILTER_SYNC_INTERVAL", 1.0)
+        self._filter = None
+
+    # filter
+
+    def rebuild(self):
+        total = db.session.execute(select(func.count(DiscountCode.id))).scalar() or 0
+        with self._lock:
+            self._filter = CodeFilter(max(self.capacity, total * 2))
+            self._last_id = 0
+            self._load_new_codes()
+
+    def _load_new_codes(self):
+        while True:
+            rows = db.session.execute(
+                select(DiscountCode.id, DiscountCode.code)
+                .where(DiscountCode.id > self._last_id)
+                .order_by(DiscountCode.id)
+                .limit(self.batch_size)
+            ).all()
+            for _, code in rows:
+                self._filter.add(code)
+            if rows:
+                self._last_id = rows[-1][0]
+            if len(rows) < self.batch_size:
+                break
+        self._last_sync = time.monotonic()
+
+    def might_exist(self, code):
+        if self._filter is None:
+            self.rebuild()
+            return code in self._filter
+        if code in self._filter:
+            return True
+        # codes minted by other processes since the last look; a request that finds
+        # another one topping up answers from the filter as it is
+        if time.monotonic() - self._last_sync >= self.sync_interval and self._lock.acquire(blocking=False):
+            try:
+                if time.monotonic() - self._last_sync >= self.sync_interval:
+                    self._load_new_codes()
+            finally:
+                self._lock.release()
+        return code in self._filter
+
+    # minting
+
+    @staticmethod
+    def new_code(prefix, length):
+        return prefix + "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+    def generate_codes(self, count, discount_percentage, expires_at, prefix="", length=10):
+        """Insert `count` fresh codes in bulk batches and return how many were created."""
+        created = 0
+        while created < count:
+            batch = set()
+            target = min(self.batch_size, count - created)
+            while len(batch) < target:
+                batch.add(self.new_code(prefix, length))
+            rows = [{"code": code, "discount_percentage": discount_percentage,
+                     "expires_at": expires_at, "is_used": False} for code in batch]
+            try:
+                db.session.execute(insert(DiscountCode), rows)
+                db.session.commit()
+            except IntegrityError:
+                # a code collided with an existing one, mint this batch again
+                db.session.rollback()
+                continue
+            if self._filter is not None:
+                with self._lock:
+                    for code in batch:
+                        self._filter.add(code)
+            created += len(batch)
+        return created
+
+    # redemption
+
+    @staticmethod
+    def redeem(session, code_id, now=None):
+        """Mark a code used if nobody else did first; the caller commits."""
+        result = session.execute(
+            update(DiscountCode)
+            .where(DiscountCode.id == code_id,
+                   DiscountCode.is_used.is_(False),
+                   DiscountCode.expires_at > (now or datetime.now()))
+            .values(is_used=True)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount == 1
+
+
+discount_campaigns = DiscountCampaigns()
+
+
+if __name__ == '__main__':
+    from App import create_app
+
+    parser = argparse.ArgumentParser(description="Mint single-use discount codes for a campaign.")
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--percentage", type=float, required=True)
+    parser.add_argument("--days", type=int, default=30, help="days until the codes expire")
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--length", type=int, default=10)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        created = discount_campaigns.generate_codes(
+            args.count, args.percentage, datetime.now() + timedelta(days=args.days), args.prefix, args.length)
+        print(f"Created {created} codes in {time.perf_counter() - started:.1f}s")
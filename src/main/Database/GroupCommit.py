@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from Model import db, Order, StockReservation
+from BulkOrders import bulk_orders
+from DiscountCampaign import discount_campaigns
+from Inventory import inventory, OutOfStock
+from OrderEvents import order_events
+from Sharding import shard_router
+
+
+class GroupCommitWriter:
+    """Optional write path that commits concurrent checkouts together.
+
+    Checkout hands its order to `submit()` and waits on the returned future. A
+    single writer thread takes the first waiting order, collects whatever else
+    arrives within `window` seconds (up to `max_batch`), and places them all with
+    `bulk_orders.place()` in one transaction, so a surge pays for one commit and a
+    few executemany INSERTs instead of one of each per order. Every checkout gets
+    its own result: orders rejected by validation or stock fail alone, and if the
+    whole transaction fails the batch is retried order by order so one bad order
+    cannot take the others down with it. With shards the commit goes one database
+    after the other, so orders that already reached their shard keep their result
+    and are not placed again. An unexpected error fails the batch's open checkouts
+    and leaves the writer running.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.window = 0.005
+        self.max_batch = 200
+        self.timeout = 10
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.orders = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("GROUP_COMMIT_ENABLED", False)
+        self.window = app.config.get("GROUP_COMMIT_WINDOW", 0.005)
+        self.max_batch = app.config.get("GROUP_COMMIT_MAX_BATCH", 200)
+        self.timeout = app.config.get("GROUP_COMMIT_TIMEOUT", 10)
+
+    def submit(self, order_request):
+        """Queue one order (a bulk_orders.place request) and return a Future of its result."""
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                    self._thread.start()
+        future = Future()
+        self._queue.put((order_request, future))
+        return future
+
+    def place(self, order_request):
+        """Submit one order and wait for its result, or None if it timed out before being written."""
+        future = self.submit(order_request)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                return None
+        # already being written, so its outcome should follow shortly
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            return {"index": 0, "ok": False,
+                    "error": "Your order is taking unusually long, please check your order history before retrying."}
+
+    # writer thread
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # orders whose checkout gave up waiting are dropped here, before they can be written
+        return [(order_request, future) for order_request, future in batch if future.set_running_or_notify_cancel()]
+
+    def _write(self, batch):
+        results = bulk_orders.place([order_request for order_request, _ in batch])
+        db.session.commit()
+        return results
+
+    @staticmethod
+    def _committed(batch, results):
+        """{batch position: result} of the orders a failed commit still wrote to their shard.
+
+        The databases commit one after the other, in no set order, so the primary's
+        half of an order (its stock and discount code) may be missing from an order
+        that reached its shard, or left behind by one that did not. Both are put
+        right here: the kept orders get their stock and code, and the stock of the
+        lost ones is given back before they are placed again.
+        """
+        if not shard_router.enabled:
+            return {}  # one database commits all or nothing
+        placed = {result["order_id"]: position for position, result in enumerate(results) if result["ok"]}
+        committed, discounts = {}, {}
+        for shard, order_ids in shard_router.split_ids(placed).items():
+            with shard_router.using(shard):
+                rows = db.session.execute(select(Order.id, Order.customer_id, Order.discount_id)
+                                          .where(Order.id.in_(order_ids))).all()
+            for order_id, customer_id, discount_id in rows:
+                position = placed[order_id]
+                if customer_id == batch[position][0].get("customer_id"):
+                    committed[position] = results[position]
+                    discounts[order_id] = discount_id
+        try:
+            reserved = set(db.session.scalars(
+                select(StockReservation.order_id).where(StockReservation.order_id.in_(list(placed))).distinct()))
+            for order_id, position in placed.items():
+                if position not in committed:
+                    inventory.release(db.session, order_id)
+                    continue
+                needs = inventory.needs_for(batch[position][0].get("pizzas") or {})
+                if needs and order_id not in reserved:
+                    try:
+                        inventory.reserve(db.session, needs)
+                        inventory.record_reservations(db.session, {order_id: needs})
+                    except OutOfStock as e:
+                        print(f"Group commit kept order {order_id} without its stock: {e}")
+                if discounts[order_id] is not None:
+                    discount_campaigns.redeem(db.session, discounts[order_id])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Group commit could not settle the stock of a failed batch: {e}")
+        return committed
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            with self.app.app_context():
+                try:
+                    self._process(batch)
+                except Exception as e:
+                    print(f"Group commit writer error: {e}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result({"index": 0, "ok": False, "error": str(e)})
+                finally:
+                    db.session.remove()
+
+    def _process(self, batch):
+        results = None
+        try:
+            results = bulk_orders.place([order_request for order_request, _ in batch])
+            db.session.commit()
+            outcomes = [(batch, results)]
+        except Exception:
+            db.session.rollback()
+            committed = self._committed(batch, results) if results else {}
+            outcomes = [([batch[position]], [result]) for position, result in committed.items()]
+            for position, item in enumerate(batch):
+                if position in committed:
+                    continue
+                try:
+                    outcomes.append(([item], self._write([item])))
+                except Exception as e:
+                    db.session.rollback()
+                    outcomes.append(([item], [{"index": 0, "ok": False, "error": str(e)}]))
+
+        self.batches += 1
+        self.orders += len(batch)
+        written = []
+        for items, results in outcomes:
+            for (_, future), result in zip(items, results):
+                result = dict(result, index=0)
+                future.set_result(result)
+                if result["ok"]:
+                    written.append(result["order_id"])
+        for shard, order_ids in shard_router.split_ids(written).items():
+            with shard_router.using(shard):
+                for order in (Order.query.options(joinedload(Order.delivery_person))
+                              .filter(Order.id.in_(order_ids)).all()):
+                    order_events.publish(order)
+
+
+group_commit = GroupCommitWriter()
@@ -0,0 +1,256 @@
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, delete, func
+
+from Model import db, Ingredient, IngredientStock, StockReservation, pizzaingredient
+from ResponseCache import response_cache
+
+
+class OutOfStock(ValueError):
+    pass
+
+
+class IngredientInventory:
+    """Ingredient stock kept in `shards` counter rows per ingredient.
+
+    Checkout takes portions with a conditional UPDATE on one randomly chosen shard
+    (`quantity >= n`), so concurrent orders for the same ingredient usually lock
+    different rows; only when no single shard has enough are several drained. An
+    ingredient without stock rows is not tracked and never runs out.
+
+    Sold-out pizzas are found with bitmasks: every tracked ingredient gets a bit, a
+    pizza's mask holds the bits of its ingredients, and a pizza is unavailable when
+    its mask overlaps the sold-out mask. Stock totals are re-read at most every
+    `ttl` seconds, or right after this process sees an ingredient run short.
+
+    What an order took is kept in StockReservation rows, so a cancellation gives
+    back exactly that even if the recipes changed in between.
+    """
+
+    def __init__(self, app=None):
+        self.shards = 8
+        self.ttl = 10
+        self._lock = threading.Lock()
+        self._pizza_ingredients = None
+        self._catalog_version = None
+        self._pizza_masks = {}
+        self._bits = {}
+        self._tracked = frozenset()
+        self._sold_out_mask = 0
+        self._unavailable = frozenset()
+        self._loaded_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shards = app.config.get("INVENTORY_SHARDS", 8)
+        self.ttl = app.config.get("INVENTORY_TTL", 10)
+        self._pizza_ingredients = None
+        self._loaded_at = 0.0
+
+    # availability
+
+    @staticmethod
+    def _recipes_version():
+        return response_cache.catalog_version, response_cache.custom_pizza_version
+
+    def _refresh(self):
+        if self._pizza_ingredients is None or self._catalog_version != self._recipes_version():
+            self._catalog_version = self._recipes_version()
+            recipes = defaultdict(list)
+            for pizza_id, ingredient_id in db.session.execute(select(pizzaingredient)).all():
+                recipes[pizza_id].append(ingredient_id)
+            self._pizza_ingredients = dict(recipes)
+
+        totals = dict(db.session.execute(
+            select(IngredientStock.ingredient_id, func.sum(IngredientStock.quantity))
+            .group_by(IngredientStock.ingredient_id)).all())
+        bits = {ingredient_id: 1 << position for position, ingredient_id in enumerate(sorted(totals))}
+        sold_out_mask = 0
+        for ingredient_id, total in totals.items():
+            if not total:
+                sold_out_mask |= bits[ingredient_id]
+        pizza_masks = {
+            pizza_id: sum(bits.get(ingredient_id, 0) for ingredient_id in ingredient_ids)
+            for pizza_id, ingredient_ids in self._pizza_ingredients.items()
+        }
+        self._bits = bits
+        self._tracked = frozenset(totals)
+        self._pizza_masks = pizza_masks
+        self._sold_out_mask = sold_out_mask
+        self._unavailable = frozenset(p for p, mask in pizza_masks.items() if mask & sold_out_mask)
+        self._loaded_at = time.monotonic()
+
+    def _current(self):
+        with self._lock:
+            if (time.monotonic() - self._loaded_at > self.ttl
+                    or self._catalog_version != self._recipes_version()):
+                self._refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def sold_out_key(self):
+        """Changes whenever the set of sold-out pizzas does; used in cache keys."""
+        self._current()
+        return tuple(sorted(self._unavailable))
+
+    def unavailable_pizza_ids(self):
+        self._current()
+        return self._unavailable
+
+    def is_available(self, pizza_id):
+        return pizza_id not in self.unavailable_pizza_ids()
+
+    def sold_out_ingredients(self, ingredient_ids):
+        self._current()
+        return [i for i in ingredient_ids if self._bits.get(int(i), 0) & self._sold_out_mask]
+
+    # reservations
+
+    def needs_for(self, pizza_quantities):
+        """Portions per tracked ingredient for {pizza_id: quantity}."""
+        self._current()
+        needs = defaultdict(int)
+        for pizza_id, quantity in pizza_quantities.items():
+            for ingredient_id in self._pizza_ingredients.get(int(pizza_id), ()):
+                if ingredient_id in self._tracked:
+                    needs[ingredient_id] += int(quantity)
+        return dict(needs)
+
+    def _take(self, session, ingredient_id, shard, amount):
+        result = session.execute(
+            update(IngredientStock)
+            .where(IngredientStock.ingredient_id == ingredient_id,
+                   IngredientStock.shard == shard,
+                   IngredientStock.quantity >= amount)
+            .values(quantity=IngredientStock.quantity - amount)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount == 1
+
+    def _give(self, session, ingredient_id, shard, amount):
+        session.execute(
+            update(IngredientStock)
+            .where(IngredientStock.ingredient_id == ingredient_id, IngredientStock.shard == shard)
+            .values(quantity=IngredientStock.quantity + amount)
+            .execution_options(synchronize_session=False)
+        )
+
+    def _reserve_one(self, session, ingredient_id, amount):
+        start = random.randrange(self.shards)
+        shards = [(start + i) % self.shards for i in range(self.shards)]
+        for shard in shards:
+            if self._take(session, ingredient_id, shard, amount):
+                return [(shard, amount)]
+
+        # no single shard has enough, gather it from several
+        levels = dict(session.execute(
+            select(IngredientStock.shard, IngredientStock.quantity)
+            .where(IngredientStock.ingredient_id == ingredient_id)).all())
+        taken = []
+        remaining = amount
+        for shard in shards:
+            portion = min(levels.get(shard, 0), remaining)
+            if portion and self._take(session, ingredient_id, shard, portion):
+                taken.append((shard, portion))
+                remaining -= portion
+            if not remaining:
+                return taken
+        for shard, portion in taken:
+            self._give(session, ingredient_id, shard, portion)
+        return None
+
+    def reserve(self, session, needs):
+        """Take `needs` ({ingredient_id: portions}) from stock or raise OutOfStock.
+
+        Nothing is taken when it fails, so the caller's transaction stays usable.
+        """
+        taken = []
+        # a fixed ingredient order keeps concurrent checkouts from deadlocking on each other's rows
+        for ingredient_id in sorted(needs):
+            portions = self._reserve_one(session, ingredient_id, needs[ingredient_id])
+            if portions is None:
+                for taken_id, shard, portion in taken:
+                    self._give(session, taken_id, shard, portion)
+                self.invalidate()
+                name = session.execute(
+                    select(Ingredient.ingredient_name).where(Ingredient.id == ingredient_id)).scalar()
+                raise OutOfStock(f"Sorry, we ran out of {name}.")
+            taken.extend((ingredient_id, shard, portion) for shard, portion in portions)
+
+    def record_reservations(self, session, reservations):
+        """Remember what `reserve` took per order: {order_id: needs}."""
+        now = datetime.utcnow()
+        rows = [{"order_id": order_id, "ingredient_id": ingredient_id, "portions": portions, "reserved_at": now}
+                for order_id, needs in reservations.items() for ingredient_id, portions in needs.items() if portions]
+        if rows:
+            session.execute(insert(StockReservation), rows)
+
+    def release(self, session, order_id):
+        """Put back what was reserved for an order, e.g. when it is cancelled."""
+        reserved = session.execute(
+            select(StockReservation.ingredient_id, StockReservation.portions)
+            .where(StockReservation.order_id == order_id)).all()
+        for ingredient_id, portions in sorted(reserved):
+            self._give(session, ingredient_id, random.randrange(self.shards), portions)
+        if reserved:
+            session.execute(delete(StockReservation).where(StockReservation.order_id == order_id))
+            self.invalidate()
+
+    def prune_reservations(self, before):
+        """Forget reservations of orders placed before `before`, long past cancelling; the caller commits."""
+        return db.session.execute(delete(StockReservation).where(StockReservation.reserved_at < before)).rowcount
+
+    # stock levels
+
+    def levels(self):
+        return dict(db.session.execute(
+            select(Ingredient.ingredient_name, func.sum(IngredientStock.quantity))
+            .join(IngredientStock, IngredientStock.ingredient_id == Ingredient.id)
+            .group_by(Ingredient.ingredient_name)
+            .order_by(Ingredient.ingredient_name)).all())
+
+    def restock(self, ingredient_id, portions):
+        """Add portions spread evenly over the shards, creating them if needed; the caller commits."""
+        existing = set(db.session.scalars(
+            select(IngredientStock.shard).where(IngredientStock.ingredient_id == ingredient_id)))
+        missing = [{"ingredient_id": ingredient_id, "shard": shard, "quantity": 0}
+                   for shard in range(self.shards) if shard not in existing]
+        if missing:
+            db.session.execute(insert(IngredientStock), missing)
+        share, extra = divmod(portions, self.shards)
+        for shard in range(self.shards):
+            amount = share + (1 if shard < extra else 0)
+            if amount:
+                self._give(db.session, ingredient_id, shard, amount)
+        self.invalidate()
+
+
+inventory = IngredientInventory()
+
+
+if __name__ == '__main__':
+    from App import create_app
+
+    parser = argparse.ArgumentParser(description="Show or add ingredient stock.")
+    parser.add_argument("restock", nargs="*", metavar="NAME=PORTIONS", help='e.g. "Cheese=500"')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        for item in args.restock:
+            name, _, portions = item.rpartition("=")
+            ingredient = Ingredient.query.filter_by(ingredient_name=name).first()
+            if ingredient is None:
+                parser.error(f"Unknown ingredient {name!r}")
+            inventory.restock(ingredient.id, int(portions))
+        db.session.commit()
+        for name, portions in inventory.levels().items():
+            print(f"{name}: {portions}")
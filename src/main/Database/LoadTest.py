@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from sqlalchemy import event, select
+
+from Model import db, Customer, Drink, Pizza
+
+
+STEPS = ("login", "menu", "add_to_basket", "checkout", "confirmation")
+
+_local = threading.local()
+
+
+def _count_query(*args):
+    if getattr(_local, "counting", False):
+        _local.queries += 1
+
+
+class InProcessClient:
+    """One browser session against the app object, run on the executor's threads."""
+
+    def __init__(self, app, executor):
+        self.client = app.test_client()
+        self.executor = executor
+
+    def _call(self, method, path, data):
+        _local.counting, _local.queries = True, 0
+        try:
+            response = self.client.open(path, method=method, data=data)
+            return response.status_code, response.headers.get("Location", ""), _local.queries
+        finally:
+            _local.counting = False
+
+    async def request(self, method, path, data=None):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._call, method, path, data)
+
+
+class HttpClient:
+    """One browser session over plain HTTP/1.1, one connection per request."""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.cookies = {}
+
+    async def request(self, method, path, data=None):
+        body = urlencode(data, doseq=True).encode() if data else b""
+        headers = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Connection: close",
+                   f"Content-Length: {len(body)}"]
+        if data:
+            headers.append("Content-Type: application/x-www-form-urlencoded")
+        if self.cookies:
+            headers.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            location = ""
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                if name.lower() == "set-cookie":
+                    for key, morsel in SimpleCookie(value.strip()).items():
+                        self.cookies[key] = morsel.value
+                elif name.lower() == "location":
+                    location = value.strip()
+            await reader.read()
+        finally:
+            writer.close()
+        return status, location, None
+
+
+class LoadTest:
+    """Open-loop lunch-rush sessions: arrivals follow a Poisson process at a fixed rate,
+    whatever the response times, so a slow server builds up a backlog like a real one."""
+
+    def __init__(self, make_client, phone_numbers, pizza_ids, drink_ids, password, max_items=4):
+        self.make_client = make_client
+        self.phone_numbers = phone_numbers
+        self.pizza_ids = pizza_ids
+        self.drink_ids = drink_ids
+        self.password = password
+        self.max_items = max_items
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.queries = defaultdict(list)
+        self.sessions = Counter()
+
+    async def _step(self, client, step, method, path, data=None, expect=200, location=None):
+        started = time.perf_counter()
+        try:
+            status, redirect_to, queries = await client.request(method, path, data)
+        except (OSError, ValueError, IndexError) as e:
+            self.errors[step][type(e).__name__] += 1
+            return False
+        self.latencies[step].append(time.perf_counter() - started)
+        if queries is not None:
+            self.queries[step].append(queries)
+        if status != expect:
+            self.errors[step][f"HTTP {status}"] += 1
+            return False
+        if location and location not in redirect_to:
+            self.errors[step][f"redirected to {urlsplit(redirect_to).path}"] += 1
+            return False
+        return True
+
+    async def session(self):
+        client = self.make_client()
+        self.sessions["started"] += 1
+        login = {"phone_number": random.choice(self.phone_numbers), "password": self.password}
+        steps = [("login", "POST", "/login", login, 302, None), ("menu", "GET", "/menu", None, 200, None)]
+        for _ in range(random.randint(1, self.max_items)):
+            if self.drink_ids and random.random() < 0.25:
+                path = f"/add_to_basket/drinks/{random.choice(self.drink_ids)}"
+            else:
+                path = f"/add_to_basket/pizzas/{random.choice(self.pizza_ids)}"
+            steps.append(("add_to_basket", "GET", path, None, 302, None))
+        steps.append(("checkout", "POST", "/checkout", {"discount_code": ""}, 302, "/confirmation"))
+        steps.append(("confirmation", "GET", "/confirmation", None, 200, None))
+
+        for step, method, path, data, expect, location in steps:
+            if not await self._step(client, step, method, path, data, expect, location):
+                self.sessions["failed"] += 1
+                return
+        self.sessions["completed"] += 1
+
+    async def run(self, orders_per_minute, duration):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        arrival = 0.0
+        tasks = []
+        while True:
+            arrival += random.expovariate(orders_per_minute / 60)
+            if arrival > duration:
+                break
+            await asyncio.sleep(max(0.0, started + arrival - loop.time()))
+            tasks.append(asyncio.create_task(self.session()))
+        await asyncio.gather(*tasks)
+        return loop.time() - started
+
+    def report(self, orders_per_minute, elapsed):
+        print(f"\n=== {orders_per_minute} orders/min: {self.sessions['started']} sessions in {elapsed:.1f}s, "
+              f"{self.sessions['completed']} completed "
+              f"({self.sessions['completed'] / elapsed * 60:.0f}/min), "
+              f"session error rate {self.sessions['failed'] / max(self.sessions['started'], 1):.1%}")
+        print(f"{'step':<15}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+              f"{'queries':>9}")
+        for step in STEPS:
+            latencies = sorted(self.latencies[step])
+            errors = sum(self.errors[step].values())
+            if not latencies and not errors:
+                continue
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+
+            queries = self.queries[step]
+            mean_queries = f"{sum(queries) / len(queries):.1f}" if queries else "n/a"
+            print(f"{step:<15}{len(latencies):>9}{errors:>8}{percentile(0.5):>9.1f}{percentile(0.9):>9.1f}"
+                  f"{percentile(0.99):>9.1f}{(latencies[-1] * 1000 if latencies else 0):>9.1f}{mean_queries:>9}")
+            for reason, count in self.errors[step].most_common():
+                print(f"{'':<15}  {count} x {reason}")
+
+
+if __name__ == '__main__':
+    from App import create_app
+
+    parser = argparse.ArgumentParser(description="Simulate a lunch rush against Pizza Crisis.")
+    parser.add_argument("--rates", type=int, nargs="+", default=[50, 200, 1000], help="orders per minute")
+    parser.add_argument("--duration", type=float, default=60, help="seconds per rate")
+    parser.add_argument("--url", help="test a running server (same database) instead of the app in-process")
+    parser.add_argument("--database-url", default=os.getenv("LOADTEST_DATABASE_URL"),
+                        help="defaults to a temporary SQLite file")
+    parser.add_argument("--workers", type=int, default=32, help="request threads for in-process runs")
+    parser.add_argument("--seed-customers", type=int, default=2000)
+    parser.add_argument("--seed-orders", type=int, default=20000)
+    parser.add_argument("--password", default="password123", help="password of the seeded customers")
+    parser.add_argument("--max-items", type=int, default=4)
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    config = {
+        "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": args.workers, "max_overflow": 0},
+        "SEED_CUSTOMERS": args.seed_customers,
+        "SEED_ORDERS": args.seed_orders,
+    }
+    if not database_url:
+        # the snapshots and archive of a throwaway database go next to it, not into the instance folder
+        workdir = tempfile.mkdtemp()
+        database_url = "sqlite:///" + os.path.join(workdir, "loadtest.db")
+        config["ANALYTICS_SNAPSHOT_PATH"] = os.path.join(workdir, "analytics_snapshot.npz")
+        config["DELIVERY_ETA_SNAPSHOT_PATH"] = os.path.join(workdir, "delivery_eta.npz")
+        config["ARCHIVE_PATH"] = os.path.join(workdir, "archive")
+    config["SQLALCHEMY_DATABASE_URI"] = database_url
+    if database_url.startswith("sqlite"):
+        config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {"timeout": 30, "check_same_thread": False}
+
+    started = time.perf_counter()
+    app = create_app(config)
+    print(f"app ready in {time.perf_counter() - started:.1f}s ({database_url})")
+    with app.app_context():
+        phone_numbers = list(db.session.scalars(
+            select(Customer.phone_number).where(Customer.is_staff.is_(False)).limit(10_000)))
+        pizza_ids = list(db.session.scalars(select(Pizza.id).where(Pizza.is_custom.is_(False))))
+        drink_ids = list(db.session.scalars(select(Drink.id)))
+        event.listen(db.engine, "before_cursor_execute", _count_query)
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    for rate in args.rates:
+        if args.url:
+            make_client = lambda: HttpClient(args.url)
+        else:
+            make_client = lambda: InProcessClient(app, executor)
+        load_test = LoadTest(make_client, phone_numbers, pizza_ids, drink_ids, args.password, args.max_items)
+        elapsed = asyncio.run(load_test.run(rate, args.duration))
+        load_test.report(rate, elapsed)
+    executor.shutdown()
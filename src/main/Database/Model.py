@@ -2,11 +2,44 @@ from datetime import datetime ,date
 import enum
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import CheckConstraint
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import validates
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-db = SQLAlchemy()
+from PricingRules import pricing
+from ReadReplica import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+ORDER_STATUSES = ('PENDING', 'PENDING_ASSIGNMENT', 'OUT_FOR_DELIVERY', 'DELIVERED', 'CANCELLED')
+
+
+# age groups used by the staff report filters, precomputed per customer
+AGE_BUCKETS = (('under-18', 0, 17), ('18-25', 18, 25), ('26-40', 26, 40), ('41-60', 41, 60), ('60+', 61, 200))
+
+
+def age_on(birthdate, today):
+    return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+
+
+def age_bucket_for(birthdate, today):
+    age = age_on(birthdate, today)
+    for name, low, high in AGE_BUCKETS:
+        if low <= age <= high:
+            return name
+    return None
+
+
+def birth_month_day(birthdate):
+    return birthdate.strftime("%m-%d")
+
+
+def database_key(app):
+    """The app's primary database, for files built from its data; without driver, options or password."""
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    return url.set(drivername=url.get_backend_name(), query={}).render_as_string(hide_password=True)
+
 
 class GenderEnum(enum.Enum):
     MALE = 'Male'
@@ -24,14 +57,18 @@ class Customer(db.Model):
     __tablename__ = 'customers'
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100), nullable=False)
-    last_name = db.Column(db.String(100), nullable=False)
+    last_name = db.Column(db.String(100), nullable=False, index=True)
     phone_number = db.Column(db.String(50), unique=True, nullable=False)
     birthdate = db.Column(db.Date, nullable=False)
     address = db.Column(db.String(250), nullable=False)
-    postal_code = db.Column(db.String(10), nullable=False)
+    postal_code = db.Column(db.String(10), nullable=False, index=True)
     password_hash = db.Column(db.String(255), nullable=False)
     gender = db.Column(db.Enum(GenderEnum), nullable=True, default=GenderEnum.OTHER)
 
+    # derived from birthdate: "MM-DD" for birthday lookups, age bucket refreshed daily
+    birth_month_day = db.Column(db.String(5), nullable=True, index=True)
+    age_bucket = db.Column(db.String(10), nullable=True, index=True)
+
     is_staff = db.Column(db.Boolean, nullable=False, default=False)
 
     orders = db.relationship("Order", back_populates="customer", cascade="all, delete-orphan")
@@ -46,6 +83,8 @@ class Customer(db.Model):
     def validate_birthdate(self, key, birthdate_value):
         if birthdate_value >= date.today():
             raise ValueError("Birthdate must be in the past.")
+        self.birth_month_day = birth_month_day(birthdate_value)
+        self.age_bucket = age_bucket_for(birthdate_value, date.today())
         return birthdate_value
     def __repr__(self):
         return f"<Customer {self.id} {self.first_name} {self.last_name}>"
@@ -86,8 +125,10 @@ class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_date = db.Column(db.DateTime, default=datetime.utcnow)
     estimated_delivery_time = db.Column(db.DateTime, nullable=True)
+    dispatched_at = db.Column(db.DateTime, nullable=True)  # handed to a driver
+    delivered_at = db.Column(db.DateTime, nullable=True)
     status = db.Column(
-        db.Enum('PENDING', 'PENDING_ASSIGNMENT', 'OUT_FOR_DELIVERY', 'DELIVERED', 'CANCELLED'),
+        db.Enum(*ORDER_STATUSES),
         default='PENDING'
     )
 
@@ -123,6 +164,8 @@ class OrderPizza(db.Model):
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), primary_key=True)
     pizza_id = db.Column(db.Integer, db.ForeignKey('pizza.id'), primary_key=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
+    # price of one pizza when it was ordered, before order-wide discounts
+    unit_price = db.Column(db.Float, nullable=True)
 
     order = db.relationship("Order", back_populates="pizzas")
     pizza = db.relationship("Pizza", back_populates="order")
@@ -153,6 +196,8 @@ class Pizza(db.Model):
     base_price = db.Column(db.Float, nullable=False)
 
     category = db.Column(db.String(20), default="Normal") # "Normal", "Vegetarian", "Vegan"
+    is_custom = db.Column(db.Boolean, nullable=False, default=False)
+    ingredient_key = db.Column(db.String(64), unique=True, nullable=True)  # hex ingredient mask of custom pizzas
 
     ingredients = db.relationship("Ingredient", secondary=pizzaingredient, back_populates="pizzas")
     order= db.relationship("OrderPizza", back_populates="pizza", cascade="all, delete-orphan")
@@ -164,9 +209,8 @@ class Pizza(db.Model):
     def subtotal(self):
         return self.base_price + self.ingredient_cost()
 
-    def final_amount(self):
-        margin = self.subtotal() * 1.4
-        return round(margin * 1.09, 2)
+    def final_amount(self, plan=None):
+        return (plan or pricing.plan).pizza_price(self.subtotal(), self.category)
 
     def __repr__(self):
         return f"<Pizza {self.id} - {self.pizza_name} ({self.category})>"
@@ -178,6 +222,8 @@ class Ingredient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     ingredient_name = db.Column(db.String(100), nullable=False)
     ingredient_price = db.Column(db.Float ,CheckConstraint('ingredient_price >= 0',name='check_positive_price'), nullable=False )
+    is_vegan = db.Column(db.Boolean, nullable=False, default=False)
+    is_vegetarian = db.Column(db.Boolean, nullable=False, default=False)
 
     pizzas = db.relationship("Pizza", secondary=pizzaingredient, back_populates="ingredients")
 
@@ -185,6 +231,28 @@ class Ingredient(db.Model):
         return f"<Ingredient {self.id} - {self.ingredient_name}>"
 
 
+# stock in portions, spread over several rows so checkouts don't all lock the same one
+class IngredientStock(db.Model):
+    __tablename__ = 'ingredient_stock'
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredient.id'), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    quantity = db.Column(db.Integer, CheckConstraint('quantity >= 0', name='check_stock_not_negative'),
+                         nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<IngredientStock {self.ingredient_id}/{self.shard}: {self.quantity}>"
+
+
+# portions taken from stock for an order, given back exactly if the order is cancelled;
+# no foreign key to orders, which may live on a shard
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservation'
+    order_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredient.id'), primary_key=True)
+    portions = db.Column(db.Integer, nullable=False)
+    reserved_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
 class Drink(db.Model):
     __tablename__ = 'drinks'
     id = db.Column(db.Integer, primary_key=True)
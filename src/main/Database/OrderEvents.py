@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from collections import deque
+
+
+FINAL_STATUSES = ("DELIVERED", "CANCELLED")
+
+
+class OrderEvents:
+    """In-process fan-out of order status changes to Server-Sent Event streams.
+
+    Each order keeps a short log of its latest events. Streams for an order wait on
+    that order's own condition, so a publish only wakes the connections watching it;
+    the condition is dropped when its last waiter leaves. An open stream parks a
+    worker thread and sends a heartbeat every `heartbeat` seconds, so at most
+    `max_streams` are kept open at once. Past that, a stream sends what is new and
+    ends with a `busy_retry` reconnect delay, and the browser polls instead of
+    holding a thread. Event ids grow with wall-clock time, so a browser reconnecting
+    with `Last-Event-ID` after a restart still gets only newer events.
+    """
+
+    def __init__(self, app=None):
+        self.heartbeat = 15
+        self.history = 16
+        self.retention = 3600
+        self.max_streams = 100
+        self.busy_retry = 30
+        self._lock = threading.Lock()
+        self._conditions = {}
+        self._waiters = {}
+        self._streams = 0
+        self._logs = {}
+        self._touched = {}
+        self._last_id = 0
+        self._last_cleanup = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.heartbeat = app.config.get("ORDER_EVENTS_HEARTBEAT", 15)
+        self.retention = app.config.get("ORDER_EVENTS_RETENTION", 3600)
+        self.max_streams = app.config.get("ORDER_EVENTS_MAX_STREAMS", 100)
+        self.busy_retry = app.config.get("ORDER_EVENTS_BUSY_RETRY", 30)
+
+    # publishing
+
+    def _new_id(self):
+        self._last_id = max(self._last_id + 1, time.time_ns() // 1000)
+        return self._last_id
+
+    def publish(self, order):
+        """Record the order's current status; call after the change is committed."""
+        estimated = order.estimated_delivery_time
+        driver = order.delivery_person
+        payload = {
+            "order_id": order.id,
+            "status": str(order.status),
+            "status_label": str(order.status).replace("_", " ").title(),
+            "delivery_person": f"{driver.first_name} {driver.last_name}" if driver else None,
+            "estimated_delivery_time": estimated.strftime("%H:%M") if estimated else None,
+        }
+        with self._lock:
+            event_id = self._new_id()
+            log = self._logs.setdefault(order.id, deque(maxlen=self.history))
+            log.append((event_id, payload))
+            self._touched[order.id] = time.monotonic()
+            condition = self._conditions.get(order.id)
+            if condition is not None:
+                condition.notify_all()
+            self._cleanup()
+        return event_id
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for order_id in [o for o, touched in self._touched.items() if now - touched > self.retention]:
+            del self._touched[order_id]
+            del self._logs[order_id]
+
+    # subscribing
+
+    def last_event_id(self, order_id):
+        with self._lock:
+            log = self._logs.get(order_id)
+            return log[-1][0] if log else 0
+
+    def _events_after(self, order_id, last_id):
+        return [event for event in self._logs.get(order_id, ()) if event[0] > last_id]
+
+    def wait(self, order_id, last_id, timeout):
+        """Events newer than `last_id`, blocking up to `timeout` seconds for one."""
+        with self._lock:
+            events = self._events_after(order_id, last_id)
+            if events:
+                return events
+            condition = self._conditions.get(order_id)
+            if condition is None:
+                condition = self._conditions[order_id] = threading.Condition(self._lock)
+            self._waiters[order_id] = self._waiters.get(order_id, 0) + 1
+            try:
+                condition.wait(timeout)
+            finally:
+                self._waiters[order_id] -= 1
+                if not self._waiters[order_id]:
+                    del self._waiters[order_id]
+                    del self._conditions[order_id]
+            return self._events_after(order_id, last_id)
+
+    @staticmethod
+    def _format(event_id, payload):
+        return f"id: {event_id}\nevent: status\ndata: {json.dumps(payload)}\n\n"
+
+    def stream(self, order_id, last_id=0):
+        """SSE lines for one order; ends after a final status has been sent."""
+        with self._lock:
+            admitted = self._streams < self.max_streams
+            if admitted:
+                self._streams += 1
+            else:
+                events = self._events_after(order_id, last_id)
+        if not admitted:
+            yield f"retry: {self.busy_retry * 1000}\n\n"
+            for event_id, payload in events:
+                yield self._format(event_id, payload)
+            return
+
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                events = self.wait(order_id, last_id, self.heartbeat)
+                if not events:
+                    yield ": heartbeat\n\n"
+                    continue
+                for event_id, payload in events:
+                    last_id = event_id
+                    yield self._format(event_id, payload)
+                if events[-1][1]["status"] in FINAL_STATUSES:
+                    return
+        finally:
+            with self._lock:
+                self._streams -= 1
+
+
+order_events = OrderEvents()
@@ -1,10 +1,10 @@
-from sqlalchemy.orm import Session
-from Model import Pizza, PizzaIngredient, Ingredient, db
+from Model import Pizza, db
+from PricingRules import pricing
 
 
 
 class PizzaPriceCalculator:
-    def __init__(self, ingredient_costs: list[float]):
+    def __init__(self, ingredient_costs: list[float], plan=None):
         # where ingredient_costs is the price of each ingredient added on the pizza
         if not ingredient_costs:
             raise ValueError("Pizza must have at least one ingredient")
@@ -13,15 +13,16 @@ class PizzaPriceCalculator:
             raise ValueError("Ingredient costs must be > 0.")
 
         self.ingredient_costs = ingredient_costs
+        self.plan = plan or pricing.plan
 
     def base_cost(self) -> float:
         return sum(self.ingredient_costs)
 
     def with_margin(self) -> float:
-        return self.base_cost() * 1.40
+        return self.base_cost() * self.plan.margin
 
     def final_price(self) -> float:
-        return round(self.with_margin() * 1.09, 2)
+        return self.plan.pizza_price(self.base_cost())
 
     @staticmethod
     def calculate_pizza_price(pizza_id: int) -> float:
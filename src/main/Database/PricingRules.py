@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+
+# used when instance/pricing_rules.json does not exist; matches the original hardcoded pricing
+DEFAULT_RULES = {
+    "margin": 1.40,
+    "category_margins": {},
+    "vat": 1.09,
+    "max_discount_percent": None,
+    "rules": [
+        {"type": "loyalty", "min_pizzas": 10, "percent": 10,
+         "label": "⭐ 10% Loyalty Discount (10+ pizzas total)"},
+        {"type": "birthday", "label": "🎂 Birthday Free Pizza!"},
+        {"type": "code", "label": "✅ {percent}% Discount Applied"},
+    ],
+}
+
+RULE_TYPES = ("loyalty", "birthday", "code", "time_of_day")
+
+
+class PricingPlan:
+    """Pricing rules compiled into a flat tuple of steps.
+
+    Each step is a closure over its already-validated parameters, so pricing a
+    basket is one pass over the steps with no lookups or database access. Rules
+    apply in the order they are listed; a rule may cap its own amount (`max_amount`)
+    or stop the rules after it (`stop`), and `max_discount_percent` caps the
+    combined discount.
+    """
+
+    def __init__(self, config, version):
+        self.version = version
+        self.margin = float(config.get("margin", DEFAULT_RULES["margin"]))
+        self.category_margins = {
+            category: float(margin) for category, margin in (config.get("category_margins") or {}).items()}
+        self.vat = float(config.get("vat", DEFAULT_RULES["vat"]))
+        cap = config.get("max_discount_percent")
+        self.max_discount_percent = None if cap is None else float(cap)
+        self.steps = tuple(self._compile(rule) for rule in config.get("rules", ()))
+
+    # compilation
+
+    def _compile(self, rule):
+        kind = rule.get("type")
+        if kind not in RULE_TYPES:
+            raise ValueError(f"Unknown pricing rule type {kind!r}")
+        label = rule.get("label", kind)
+        stop = bool(rule.get("stop", False))
+        max_amount = rule.get("max_amount")
+        max_amount = None if max_amount is None else float(max_amount)
+
+        def limited(amount):
+            return amount if max_amount is None else min(amount, max_amount)
+
+        if kind == "loyalty":
+            min_pizzas = int(rule.get("min_pizzas", 10))
+            rate = float(rule["percent"]) / 100
+
+            def step(total, quote):
+                if quote["past_pizzas"] + quote["current_pizzas"] >= min_pizzas:
+                    return limited(total * rate), label
+                return 0.0, None
+
+        elif kind == "birthday":
+            def step(total, quote):
+                if quote["is_birthday"] and quote["pizza_prices"]:
+                    cheapest = min(quote["pizza_prices"])
+                    if cheapest > 0:
+                        return limited(cheapest), label
+                return 0.0, None
+
+        elif kind == "code":
+            def step(total, quote):
+                percent = quote["code_percentage"]
+                if percent is not None:
+                    return limited(total * percent / 100), label.format(percent=percent)
+                return 0.0, None
+
+        else:
+            start = datetime.strptime(rule["start"], "%H:%M").time()
+            end = datetime.strptime(rule["end"], "%H:%M").time()
+            weekdays = frozenset(rule.get("weekdays", range(7)))
+            rate = float(rule["percent"]) / 100
+            pizzas_only = rule.get("applies_to", "order") == "pizzas"
+
+            def step(total, quote):
+                now = quote["now"]
+                if now.weekday() in weekdays and start <= now.time() < end:
+                    base = min(total, quote["pizza_total"]) if pizzas_only else total
+                    return limited(base * rate), label
+                return 0.0, None
+
+        return step, stop
+
+    # evaluation
+
+    def pizza_price(self, subtotal, category=None):
+        margin = self.category_margins.get(category, self.margin)
+        return round(subtotal * margin * self.vat, 2)
+
+    def apply(self, total, pizza_lines, past_pizzas=0, is_birthday=False, code_percentage=None, now=None):
+        """Discounted total and applied labels for one basket.
+
+        `pizza_lines` are (unit price, quantity) pairs for the pizzas in the basket.
+        """
+        quote = {
+            "pizza_prices": [price for price, _ in pizza_lines],
+            "pizza_total": sum(price * quantity for price, quantity in pizza_lines),
+            "current_pizzas": sum(quantity for _, quantity in pizza_lines),
+            "past_pizzas": past_pizzas,
+            "is_birthday": is_birthday,
+            "code_percentage": code_percentage,
+            "now": now or datetime.now(),
+        }
+        gross = total
+        labels = []
+        for step, stop in self.steps:
+            amount, label = step(total, quote)
+            if label is None:
+                continue
+            total -= amount
+            labels.append(label)
+            if stop:
+                break
+        if self.max_discount_percent is not None:
+            floor = gross * (1 - self.max_discount_percent / 100)
+            if total < floor:
+                total = floor
+                labels.append(f"Discounts capped at {self.max_discount_percent:g}%")
+        return round(float(total or 0.0), 2), labels
+
+
+class PricingRules:
+    """Current pricing plan, hot-reloaded from instance/pricing_rules.json.
+
+    The file is checked at most every `check_interval` seconds; a changed file is
+    compiled into a new plan which then replaces the old one in a single
+    assignment. Callers take `pricing.plan` once and price a whole basket or batch
+    with it, so a reload never mixes rules inside one order. A file that fails to
+    compile is reported and the previous plan stays in use.
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.check_interval = 5
+        self._plan = PricingPlan(DEFAULT_RULES, 0)
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get("PRICING_RULES_PATH", os.path.join(app.instance_path, "pricing_rules.json"))
+        self.check_interval = app.config.get("PRICING_RULES_CHECK_INTERVAL", 5)
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reload()
+
+        @app.context_processor
+        def inject_pricing_version():
+            return {"pricing_version": self.plan.version}
+
+    def reload(self):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime if self.path else None
+            except OSError:
+                mtime = None
+            if mtime == self._mtime:
+                return self._plan
+            try:
+                if mtime is None:
+                    config = DEFAULT_RULES
+                else:
+                    with open(self.path, encoding="utf-8") as f:
+                        config = json.load(f)
+                plan = PricingPlan(config, self._plan.version + 1)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Pricing rules in {self.path} not loaded, keeping the current ones: {e}")
+                self._mtime = mtime
+                return self._plan
+            self._mtime = mtime
+            self._plan = plan
+            return plan
+
+    @property
+    def plan(self):
+        if time.monotonic() - self._checked_at > self.check_interval:
+            return self.reload()
+        return self._plan
+
+
+pricing = PricingRules()
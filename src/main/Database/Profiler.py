@@ -0,0 +1,203 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import request
+
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+class SamplingProfiler:
+    """Opt-in stack-sampling profiler for requests.
+
+    A request is profiled when its endpoint is the one being watched or, failing
+    that, with probability `sample_rate`. While any profiled request is running, a
+    background thread wakes every `interval` seconds, reads the stacks of just
+    those request threads from `sys._current_frames()` and counts them per
+    endpoint. Unprofiled requests only pay for one random() call, and the thread
+    sleeps while no profiled request is running.
+
+    Samples are written to instance/profiles every `export_interval` seconds, as
+    collapsed stacks (one file per endpoint, for flamegraph.pl and friends) and as a
+    single speedscope file with one profile per endpoint.
+    """
+
+    def __init__(self, app=None):
+        self.sample_rate = 0.0
+        self.endpoint = None
+        self.interval = 0.005
+        self.export_interval = 60
+        self.directory = None
+        self._lock = threading.Lock()
+        self._configure_lock = threading.Lock()
+        self._active = {}
+        self._samples = defaultdict(Counter)
+        self._labels = {}
+        self._dirty = False
+        self._thread = None
+        self._stop = threading.Event()
+        self._busy = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get("PROFILE_INTERVAL", 0.005)
+        self.export_interval = app.config.get("PROFILE_EXPORT_INTERVAL", 60)
+        self.directory = app.config.get("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+        self.configure(app.config.get("PROFILE_SAMPLE_RATE", 0.0), app.config.get("PROFILE_ENDPOINT"))
+
+        @app.before_request
+        def start_profiling():
+            if self.enabled and (request.endpoint == self.endpoint or random.random() < self.sample_rate):
+                with self._lock:
+                    self._active[threading.get_ident()] = request.endpoint or request.path
+                    self._busy.set()
+
+        @app.teardown_request
+        def stop_profiling(exc=None):
+            if self._active:
+                with self._lock:
+                    self._active.pop(threading.get_ident(), None)
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.endpoint is not None
+
+    def configure(self, sample_rate=0.0, endpoint=None):
+        """Change what is profiled; takes effect with the next request."""
+        sample_rate = float(sample_rate or 0.0)
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("The sample rate must be between 0 and 1.")
+        if endpoint and "." not in endpoint:
+            endpoint = f"main.{endpoint}"
+        with self._configure_lock:
+            self.sample_rate = sample_rate
+            self.endpoint = endpoint or None
+            if self._thread is not None:
+                # wake the old sampler and wait for it, so two never run at once
+                self._stop.set()
+                self._busy.set()
+                self._thread.join()
+                self._thread = None
+            if self.enabled:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name="profiler", daemon=True)
+                self._thread.start()
+
+    # sampling
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            path = code.co_filename.replace("\\", "/").rsplit("/", 2)
+            label = f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _sample(self):
+        with self._lock:
+            active = list(self._active.items())
+        if not active:
+            return
+        frames = sys._current_frames()
+        stacks = []
+        for thread_id, endpoint in active:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                stacks.append((endpoint, tuple(stack)))
+        del frames
+        with self._lock:
+            for endpoint, stack in stacks:
+                self._samples[endpoint][stack] += 1
+            self._dirty = self._dirty or bool(stacks)
+
+    def _run(self, stop):
+        exported_at = time.monotonic()
+        while not stop.is_set():
+            with self._lock:
+                if not self._active:
+                    self._busy.clear()
+            # sleeps until a profiled request starts, so an idle profiler costs nothing
+            self._busy.wait(self.export_interval)
+            if stop.wait(self.interval):
+                break
+            self._sample()
+            if self._dirty and time.monotonic() - exported_at > self.export_interval:
+                self.export()
+                exported_at = time.monotonic()
+        if self._dirty:
+            self.export()
+
+    # export
+
+    def stats(self):
+        with self._lock:
+            samples = {endpoint: sum(stacks.values()) for endpoint, stacks in self._samples.items()}
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "endpoint": self.endpoint,
+            "interval_ms": self.interval * 1000,
+            "profiling_now": len(self._active),
+            "samples": samples,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._samples = defaultdict(Counter)
+            self._dirty = False
+
+    def _write(self, filename, text):
+        path = os.path.join(self.directory, filename)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def export(self):
+        """Write the samples so far; returns the files written."""
+        with self._lock:
+            samples = {endpoint: dict(stacks) for endpoint, stacks in self._samples.items()}
+            self._dirty = False
+        if not samples:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        written = []
+        for endpoint, stacks in samples.items():
+            filename = f"{endpoint.strip('/').replace('/', '_') or 'root'}.collapsed"
+            self._write(filename, "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.items()))
+            written.append(filename)
+
+        frames, frame_index, profiles = [], {}, []
+        for endpoint, stacks in samples.items():
+            indexed = []
+            for stack in stacks:
+                for label in stack:
+                    if label not in frame_index:
+                        frame_index[label] = len(frames)
+                        frames.append({"name": label})
+                indexed.append([frame_index[label] for label in stack])
+            weights = [count * self.interval * 1000 for count in stacks.values()]
+            profiles.append({"type": "sampled", "name": endpoint, "unit": "milliseconds",
+                             "startValue": 0, "endValue": sum(weights), "samples": indexed, "weights": weights})
+        self._write("profile.speedscope.json", json.dumps({
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": "Pizza Crisis requests",
+            "exporter": "Pizza Crisis SamplingProfiler",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }))
+        written.append("profile.speedscope.json")
+        return written
+
+
+profiler = SamplingProfiler()
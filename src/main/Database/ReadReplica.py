@@ -0,0 +1,150 @@
+import argparse
+import sqlite3
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import Delete, Insert, Update
+
+from ChangeTracking import change_tracker
+from Sharding import shard_router
+
+# read-only pages whose queries may be served by the replica
+DEFAULT_ENDPOINTS = ("main.staff_reports", "main.menu", "main.order_history")
+
+
+class RoutingSession(FlaskSession):
+    """db.session that sends reads of replica-routed requests to the 'replica' bind.
+
+    Flushes, INSERT/UPDATE/DELETE statements and everything outside such a request
+    keep using the primary. Sharded tables always go to their shard.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            shard = shard_router.bind_for(mapper, clause)
+            if shard is not None:
+                return self._db.engines[shard]
+        if (bind is None and not self._flushing and read_replica.active()
+                and not isinstance(clause, (Insert, Update, Delete))):
+            engine = self._db.engines.get(read_replica.bind_key)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReadReplica:
+    """Routes the queries of read-only pages to a replica database.
+
+    The replica is the SQLALCHEMY_BINDS entry named `bind_key` (set from
+    DATABASE_REPLICA_URL). Requests to `endpoints` (staff reports, menu and order
+    history by default) read from it; checkout, cancellation, the delivery job and
+    all other code stay on the primary. A browser that committed something in the
+    last `sticky_seconds` reads from the primary too, so customers always see their
+    own new order even while the replica lags behind.
+
+    For local testing with SQLite, `sync()` copies the primary file onto the
+    replica with the sqlite3 backup API, optionally every `sync_interval` seconds.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.bind_key = "replica"
+        self.endpoints = frozenset(DEFAULT_ENDPOINTS)
+        self.sticky_seconds = 10
+        self.sync_interval = 0
+        self._sync_thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.bind_key = app.config.get("READ_REPLICA_BIND", "replica")
+        self.endpoints = frozenset(app.config.get("READ_REPLICA_ENDPOINTS", DEFAULT_ENDPOINTS))
+        self.sticky_seconds = app.config.get("READ_REPLICA_STICKY_SECONDS", 10)
+        self.sync_interval = app.config.get("READ_REPLICA_SYNC_INTERVAL", 0)
+
+        @app.before_request
+        def choose_database():
+            if not self.configured or request.endpoint not in self.endpoints:
+                return
+            wrote_at = session.get("db_wrote_at")
+            g.use_read_replica = not (wrote_at and time.time() - wrote_at < self.sticky_seconds)
+
+        if self.configured and self.sync_interval and self._sync_thread is None:
+            self._sync_thread = threading.Thread(target=self._sync_loop, name="replica-sync", daemon=True)
+            self._sync_thread.start()
+
+    @property
+    def configured(self):
+        return self.app is not None and self.bind_key in self.app.config.get("SQLALCHEMY_BINDS", {})
+
+    def active(self):
+        return has_request_context() and g.get("use_read_replica", False)
+
+    def note_write(self):
+        """Keep this browser on the primary for a while, e.g. after a write made on its behalf elsewhere."""
+        if has_request_context():
+            session["db_wrote_at"] = time.time()
+
+    # local replication
+
+    def sync(self):
+        """Copy the primary SQLite database onto the replica file."""
+        with self.app.app_context():
+            engines = self.app.extensions["sqlalchemy"].engines
+            primary, replica = engines[None].url, engines[self.bind_key].url
+        if primary.get_backend_name() != "sqlite" or replica.get_backend_name() != "sqlite":
+            raise ValueError("Only SQLite databases can be synced locally; use real replication otherwise.")
+        source = sqlite3.connect(primary.database)
+        target = sqlite3.connect(replica.database)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    def _sync_loop(self):
+        while True:
+            try:
+                self.sync()
+            except (sqlite3.Error, ValueError) as e:
+                print(f"Replica sync failed: {e}")
+            time.sleep(self.sync_interval)
+
+
+read_replica = ReadReplica()
+
+
+def _note_flushed_writes(wrote, session_):
+    return wrote or bool(session_.new or session_.dirty or session_.deleted)
+
+
+def _note_bulk_writes(wrote, model, orm_execute_state):
+    return True
+
+
+def _stick_to_primary(wrote):
+    if wrote:
+        read_replica.note_write()
+
+
+change_tracker.subscribe("read_replica", _stick_to_primary, start=bool,
+                         flushed=_note_flushed_writes, bulk=_note_bulk_writes)
+
+
+if __name__ == '__main__':
+    from App import create_app
+
+    parser = argparse.ArgumentParser(description="Copy the primary SQLite database onto the replica.")
+    parser.add_argument("--every", type=float, default=0, help="keep syncing every N seconds")
+    args = parser.parse_args()
+
+    app = create_app()
+    while True:
+        read_replica.sync()
+        print(f"Replica synced at {time.strftime('%H:%M:%S')}")
+        if not args.every:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,214 @@
+import hashlib
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+
+from flask import request
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from ChangeTracking import change_tracker
+from Model import (
+    Customer, DeliveryPerson, Dessert, Drink, Ingredient, Order, OrderDessert, OrderDrink, OrderPizza,
+    Payment, Pizza
+)
+from ReadReplica import read_replica
+
+
+CATALOG_MODELS = (Pizza, Ingredient, Drink, Dessert)
+REPORT_MODELS = (Order, OrderPizza, OrderDrink, OrderDessert, Payment, DeliveryPerson, Customer)
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class FragmentCacheExtension(Extension):
+    """`{% cache "name", key... %}...{% endcache %}` keeps the rendered block in memory."""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_cached_fragment", [nodes.List(key_parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cached_fragment(self, key_parts, caller):
+        key = tuple(key_parts)
+        fragment = response_cache.get_fragment(key)
+        if fragment is None:
+            fragment = caller()
+            # the replica may not have caught up with the versions in the key yet
+            if not read_replica.active():
+                response_cache.put_fragment(key, fragment)
+        return fragment
+
+
+class ResponseCache:
+    """Version-keyed caches for rendered fragments and report pages.
+
+    Two counters are bumped after a commit touches the relevant tables: the catalog
+    version (pizzas, ingredients, drinks, desserts) and the reports version (orders,
+    order lines, payments, drivers, customers). Cache keys include the version, so a
+    bump invalidates everything built from older data. The counters start over in
+    every process, so report keys also carry a random `boot_id`: an ETag from before
+    a restart, or from another worker, never matches. Custom pizzas from the
+    builder only bump `custom_pizza_version`, which no page is keyed on, so they
+    leave the menu and report caches alone.
+    """
+
+    def __init__(self, app=None, max_entries=256):
+        self.max_entries = max_entries
+        self.boot_id = secrets.token_hex(8)
+        self.catalog_version = 0
+        self.reports_version = 0
+        self.custom_pizza_version = 0
+        self.catalog_changed_at = _now()
+        self.reports_changed_at = _now()
+        self._fragments = OrderedDict()
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config.get("RESPONSE_CACHE_MAX_ENTRIES", self.max_entries)
+        if app.config.get("SEND_FILE_MAX_AGE_DEFAULT") is None:
+            app.config["SEND_FILE_MAX_AGE_DEFAULT"] = timedelta(days=7)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+
+        @app.context_processor
+        def inject_catalog_version():
+            return {"catalog_version": self.catalog_version}
+
+        @app.url_defaults
+        def version_static_urls(endpoint, values):
+            if endpoint == "static" and "filename" in values and "v" not in values:
+                values["v"] = self._static_version(app.static_folder, values["filename"])
+
+        @app.after_request
+        def cache_versioned_static(response):
+            # versioned URLs change whenever the file does, so they can be cached for good
+            if request.endpoint == "static" and "v" in request.args and response.status_code == 200:
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = STATIC_MAX_AGE
+                response.cache_control.immutable = True
+            return response
+
+    @staticmethod
+    def _static_version(static_folder, filename):
+        try:
+            return int(os.stat(os.path.join(static_folder, filename)).st_mtime)
+        except OSError:
+            return 0
+
+    # invalidation
+
+    def bump_catalog(self):
+        with self._lock:
+            self.catalog_version += 1
+            self.catalog_changed_at = _now()
+            self._fragments.clear()
+            self._reports.clear()
+
+    def bump_custom_pizzas(self):
+        with self._lock:
+            self.custom_pizza_version += 1
+
+    def bump_reports(self):
+        with self._lock:
+            self.reports_version += 1
+            self.reports_changed_at = _now()
+            self._reports.clear()
+
+    # storage
+
+    def _get(self, store, key):
+        with self._lock:
+            value = store.get(key)
+            if value is not None:
+                store.move_to_end(key)
+            return value
+
+    def _put(self, store, key, value):
+        with self._lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > self.max_entries:
+                store.popitem(last=False)
+
+    def get_fragment(self, key):
+        return self._get(self._fragments, key)
+
+    def put_fragment(self, key, fragment):
+        self._put(self._fragments, key, fragment)
+
+    def report_key(self, *parts):
+        return (self.boot_id, self.catalog_version, self.reports_version) + tuple(parts)
+
+    def get_report(self, key):
+        return self._get(self._reports, key)
+
+    def put_report(self, key, context):
+        self._put(self._reports, key, context)
+
+    @staticmethod
+    def etag_for(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @property
+    def last_modified(self):
+        return max(self.catalog_changed_at, self.reports_changed_at)
+
+
+response_cache = ResponseCache()
+
+
+def _classify(models, pending):
+    for model in models:
+        if issubclass(model, CATALOG_MODELS):
+            pending.add("catalog")
+        elif issubclass(model, REPORT_MODELS):
+            pending.add("reports")
+
+
+def _is_custom_pizza(obj):
+    return isinstance(obj, Pizza) and obj.is_custom
+
+
+def _collect_flushed_changes(pending, session):
+    changed = list(chain(session.new, session.dirty, session.deleted))
+    if any(_is_custom_pizza(obj) for obj in changed):
+        pending.add("custom_pizzas")
+    _classify({type(obj) for obj in changed if not _is_custom_pizza(obj)}, pending)
+    return pending
+
+
+def _collect_bulk_changes(pending, model, orm_execute_state):
+    if model is not None:
+        _classify([model], pending)
+    return pending
+
+
+def _apply_committed_changes(pending):
+    if "catalog" in pending:
+        response_cache.bump_catalog()
+    if "reports" in pending:
+        response_cache.bump_reports()
+    if "custom_pizzas" in pending:
+        response_cache.bump_custom_pizzas()
+
+
+change_tracker.subscribe("response_cache", _apply_committed_changes,
+                         flushed=_collect_flushed_changes, bulk=_collect_bulk_changes)
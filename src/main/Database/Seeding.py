@@ -1,4 +1,5 @@
 import random
+from collections import defaultdict
 from datetime import date, datetime, timedelta, timezone
 from faker import Faker
 from sqlalchemy.orm import Session
@@ -8,12 +9,14 @@ from Model import (
     db, Customer, DiscountCode, DeliveryPerson, Order,
     Pizza, Ingredient, Drink, Dessert, Payment, OrderPizza, OrderDessert, OrderDrink, GenderEnum
 )
+from Inventory import inventory
+from Sharding import shard_router
 
 
 fake = Faker('nl_BE')
 
 
-def seed_database():
+def seed_database(customer_count=30, delivery_person_count=20, order_count=100):
 
     print("Database seeding")
     if Customer.query.first():
@@ -24,18 +27,19 @@ def seed_database():
 
     # seed base data
     _seed_ingredients(session)
+    _seed_ingredient_stock(session)
     _seed_pizzas_and_link_ingredients(session)
     _seed_drinks(session)
     _seed_desserts(session)
     _seed_discount_codes(session)
     # seed customers
 
-    customers = _seed_customers(session, count=30)
+    customers = _seed_customers(session, count=customer_count)
     _seed_staff(session)
-    delivery_personnel = _seed_delivery_personnel(session, count=20)
+    _seed_delivery_personnel(session, count=delivery_person_count)
 
     # seed order
-    _seed_orders_and_payments(session, customers, delivery_personnel, count=100)
+    _seed_orders_and_payments(session, customers, count=order_count)
 
     print("Database seeding complete!")
 
@@ -44,20 +48,26 @@ def seed_database():
 
 def _seed_ingredients(session: Session):
     ingredients = [
-        Ingredient(ingredient_name="Cheese", ingredient_price=1.0),
-        Ingredient(ingredient_name="Tomato Sauce", ingredient_price=0.5),
+        Ingredient(ingredient_name="Cheese", ingredient_price=1.0, is_vegetarian=True),
+        Ingredient(ingredient_name="Tomato Sauce", ingredient_price=0.5, is_vegan=True, is_vegetarian=True),
         Ingredient(ingredient_name="Pepperoni", ingredient_price=1.5),
-        Ingredient(ingredient_name="Mushrooms", ingredient_price=1.2),
-        Ingredient(ingredient_name="Onion", ingredient_price=0.8),
-        Ingredient(ingredient_name="Olives", ingredient_price=1.0),
-        Ingredient(ingredient_name="Vegan Cheese", ingredient_price=1.8),
-        Ingredient(ingredient_name="Pineapple", ingredient_price=1.0),
+        Ingredient(ingredient_name="Mushrooms", ingredient_price=1.2, is_vegan=True, is_vegetarian=True),
+        Ingredient(ingredient_name="Onion", ingredient_price=0.8, is_vegan=True, is_vegetarian=True),
+        Ingredient(ingredient_name="Olives", ingredient_price=1.0, is_vegan=True, is_vegetarian=True),
+        Ingredient(ingredient_name="Vegan Cheese", ingredient_price=1.8, is_vegan=True, is_vegetarian=True),
+        Ingredient(ingredient_name="Pineapple", ingredient_price=1.0, is_vegan=True, is_vegetarian=True),
         Ingredient(ingredient_name="Chicken", ingredient_price=2.0),
     ]
     session.add_all(ingredients)
     session.commit()
 
 
+def _seed_ingredient_stock(session: Session, portions=1000):
+    for ingredient in session.query(Ingredient).all():
+        inventory.restock(ingredient.id, portions)
+    session.commit()
+
+
 def _seed_pizzas_and_link_ingredients(session: Session):
     pizzas_data = {
         "Margherita": {"base_price": 5.00, "category": "Vegetarian", "ingredients": ["Cheese", "Tomato Sauce"]},
@@ -109,7 +119,9 @@ def _seed_discount_codes(session: Session):
     session.commit()
 
 
-def _seed_customers(session: Session, count=20) -> list[Customer]:
+def _seed_customers(session: Session, count=20, chunk_size=5000) -> list[Customer]:
+    # hashing is deliberately slow, and every seeded customer has the same password anyway
+    password_hash = generate_password_hash("password123", method='pbkdf2:sha256')
     customers = []
     for _ in range(count):
         profile = fake.profile()
@@ -120,11 +132,14 @@ def _seed_customers(session: Session, count=20) -> list[Customer]:
             birthdate=profile['birthdate'],
             address=fake.street_address(),
             postal_code=fake.postcode(),
-            password_hash=generate_password_hash("password123", method='pbkdf2:sha256'),
+            password_hash=password_hash,
             gender = random.choice(list(GenderEnum))
         )
         customers.append(customer)
-    session.add_all(customers)
+        if len(customers) % chunk_size == 0:
+            session.add_all(customers[-chunk_size:])
+            session.commit()
+    session.add_all(customers[len(customers) - len(customers) % chunk_size:])
     session.commit()
     return customers
 
@@ -153,92 +168,131 @@ def _seed_delivery_personnel(session: Session, count=5) -> list[DeliveryPerson]:
             available_at=datetime.now(timezone.utc) #  all are available
         )
         personnel.append(person)
-    session.add_all(personnel)
-    session.commit()
+    personnel_by_shard = defaultdict(list)
+    for person in personnel:
+        personnel_by_shard[shard_router.shard_for(person.postal_code)].append(person)
+    for shard in shard_router.each():
+        session.add_all(personnel_by_shard.get(shard, []))
+        session.commit()
     return personnel
 
 
-def _seed_orders_and_payments(session: Session, customers: list[Customer], delivery_personnel: list[DeliveryPerson],
-                              count=100):
+def _seed_orders_and_payments(session: Session, customers: list[Customer], count=100, chunk_size=5000):
+    # orders are placed on their customer's shard, with drivers from that shard only
+    customers_by_shard = defaultdict(list)
+    for customer in customers:
+        customers_by_shard[shard_router.shard_for(customer.postal_code)].append(customer)
+    for shard in shard_router.each():
+        shard_customers = customers_by_shard.get(shard)
+        if not shard_customers:
+            continue
+        delivery_personnel = DeliveryPerson.query.all()
+        available_driver_pool = list(delivery_personnel)
+        shard_count = round(count * len(shard_customers) / len(customers))
+        for start in range(0, shard_count, chunk_size):
+            _seed_order_chunk(session, shard_customers, delivery_personnel, available_driver_pool,
+                              min(chunk_size, shard_count - start))
+
+
+def _delivery_minutes(postal_code, dispatched_at):
+    # some zones are further out, and lunch and dinner rushes are slower everywhere
+    zone_minutes = 12 + sum(map(ord, postal_code)) % 15
+    rush_minutes = 8 if dispatched_at.hour in (12, 13, 18, 19, 20) else 0
+    return max(5.0, random.gauss(zone_minutes + rush_minutes, 4))
+
+
+def _seed_order_chunk(session: Session, customers: list[Customer], delivery_personnel: list[DeliveryPerson],
+                      available_driver_pool: list[DeliveryPerson], count):
     pizzas = Pizza.query.all()
     drinks = Drink.query.all()
     desserts = Dessert.query.all()
 
-    available_driver_pool = list(delivery_personnel)
+    unit_prices = {pizza: pizza.final_amount() for pizza in pizzas}
 
     orders_to_add = []
-    for _ in range(count):
-        customer = random.choice(customers)
-
-        status = random.choices(
-            ["DELIVERED", "OUT_FOR_DELIVERY", "PENDING_ASSIGNMENT"],
-            weights=[0.9, 0.05, 0.05],
-            k=1
-        )[0]
-        order_date = None
-        estimated_delivery_time = None
-        delivery_person = None
-
-
-        if status == "PENDING_ASSIGNMENT":
-            minutes_ago = random.randint(31, 60)
-            order_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
-
-        elif status == "OUT_FOR_DELIVERY":
-            minutes_ago = random.randint(1, 30)
-            order_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
-            estimated_delivery_time = order_date + timedelta(minutes=30)
-
-            if available_driver_pool:
-                driver_index = random.randrange(len(available_driver_pool))
-                delivery_person = available_driver_pool.pop(driver_index)
-            else:
-                status = "PENDING_ASSIGNMENT"
+    # the orders only join the session below, so loading a customer's attributes must not flush
+    with session.no_autoflush:
+        for _ in range(count):
+            customer = random.choice(customers)
+
+            status = random.choices(
+                ["DELIVERED", "OUT_FOR_DELIVERY", "PENDING_ASSIGNMENT"],
+                weights=[0.9, 0.05, 0.05],
+                k=1
+            )[0]
+            order_date = None
+            estimated_delivery_time = None
+            dispatched_at = None
+            delivered_at = None
+            delivery_person = None
+
+
+            if status == "PENDING_ASSIGNMENT":
                 minutes_ago = random.randint(31, 60)
                 order_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
-                estimated_delivery_time = None  # Reset this
-
-        if status == "DELIVERED":
-
-            if order_date is None:
-                is_recent = random.choices([True, False], weights=[0.75, 0.25], k=1)[0]
-                days_past = random.randint(0, 29) if is_recent else random.randint(30, 90)
-                order_date = datetime.utcnow() - timedelta(days=days_past, hours=random.randint(1, 23))
 
-            delivery_person = random.choice(delivery_personnel)
-
-
-        new_order = Order(
-            customer=customer,
-            delivery_person=delivery_person,
-            status=status,
-            order_date=order_date,
-            estimated_delivery_time=estimated_delivery_time
-        )
-
-
-        items_in_order = {'pizzas': {}, 'drinks': {}, 'desserts': {}}
-        for _ in range(random.randint(2, 5)):
-            item_type = random.choices(['pizza', 'drink', 'dessert'], weights=[0.7, 0.2, 0.1], k=1)[0]
-            if item_type == 'pizza' and pizzas:
-                chosen = random.choice(pizzas)
-                items_in_order['pizzas'][chosen] = items_in_order['pizzas'].get(chosen, 0) + 1
-            elif item_type == 'drink' and drinks:
-                chosen = random.choice(drinks)
-                items_in_order['drinks'][chosen] = items_in_order['drinks'].get(chosen, 0) + 1
-            elif item_type == 'dessert' and desserts:
-                chosen = random.choice(desserts)
-                items_in_order['desserts'][chosen] = items_in_order['desserts'].get(chosen, 0) + 1
-
-        for pizza_obj, qty in items_in_order['pizzas'].items():
-            new_order.pizzas.append(OrderPizza(pizza=pizza_obj, quantity=qty))
-        for drink_obj, qty in items_in_order['drinks'].items():
-            new_order.drinks.append(OrderDrink(drink=drink_obj, quantity=qty))
-        for dessert_obj, qty in items_in_order['desserts'].items():
-            new_order.desserts.append(OrderDessert(dessert=dessert_obj, quantity=qty))
-
-        if new_order.pizzas or new_order.drinks or new_order.desserts:
-            orders_to_add.append(new_order)
+            elif status == "OUT_FOR_DELIVERY":
+                minutes_ago = random.randint(1, 30)
+                order_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
+                estimated_delivery_time = order_date + timedelta(minutes=30)
+                dispatched_at = order_date
+
+                if available_driver_pool:
+                    driver_index = random.randrange(len(available_driver_pool))
+                    delivery_person = available_driver_pool.pop(driver_index)
+                else:
+                    status = "PENDING_ASSIGNMENT"
+                    minutes_ago = random.randint(31, 60)
+                    order_date = datetime.utcnow() - timedelta(minutes=minutes_ago)
+                    estimated_delivery_time = None  # Reset this
+                    dispatched_at = None
+
+            if status == "DELIVERED":
+
+                if order_date is None:
+                    is_recent = random.choices([True, False], weights=[0.75, 0.25], k=1)[0]
+                    days_past = random.randint(0, 29) if is_recent else random.randint(30, 90)
+                    order_date = datetime.utcnow() - timedelta(days=days_past, hours=random.randint(1, 23))
+
+                delivery_person = random.choice(delivery_personnel) if delivery_personnel else None
+                dispatched_at = order_date + timedelta(minutes=random.randint(2, 10))
+                delivered_at = dispatched_at + timedelta(minutes=_delivery_minutes(customer.postal_code, dispatched_at))
+                estimated_delivery_time = delivered_at
+
+
+            new_order = Order(
+                customer=customer,
+                delivery_person=delivery_person,
+                status=status,
+                order_date=order_date,
+                estimated_delivery_time=estimated_delivery_time,
+                dispatched_at=dispatched_at,
+                delivered_at=delivered_at
+            )
+
+
+            items_in_order = {'pizzas': {}, 'drinks': {}, 'desserts': {}}
+            for _ in range(random.randint(2, 5)):
+                item_type = random.choices(['pizza', 'drink', 'dessert'], weights=[0.7, 0.2, 0.1], k=1)[0]
+                if item_type == 'pizza' and pizzas:
+                    chosen = random.choice(pizzas)
+                    items_in_order['pizzas'][chosen] = items_in_order['pizzas'].get(chosen, 0) + 1
+                elif item_type == 'drink' and drinks:
+                    chosen = random.choice(drinks)
+                    items_in_order['drinks'][chosen] = items_in_order['drinks'].get(chosen, 0) + 1
+                elif item_type == 'dessert' and desserts:
+                    chosen = random.choice(desserts)
+                    items_in_order['desserts'][chosen] = items_in_order['desserts'].get(chosen, 0) + 1
+
+            for pizza_obj, qty in items_in_order['pizzas'].items():
+                new_order.pizzas.append(OrderPizza(pizza=pizza_obj, quantity=qty, unit_price=unit_prices[pizza_obj]))
+            for drink_obj, qty in items_in_order['drinks'].items():
+                new_order.drinks.append(OrderDrink(drink=drink_obj, quantity=qty))
+            for dessert_obj, qty in items_in_order['desserts'].items():
+                new_order.desserts.append(OrderDessert(dessert=dessert_obj, quantity=qty))
+
+            if new_order.pizzas or new_order.drinks or new_order.desserts:
+                orders_to_add.append(new_order)
 
     session.add_all(orders_to_add)
     session.flush()
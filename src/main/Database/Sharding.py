@@ -0,0 +1,238 @@
+import bisect
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import g, has_request_context, session
+from sqlalchemy import Column, ForeignKey, MetaData, Table, inspect, select, text
+from sqlalchemy.engine import make_url
+
+
+# rows that belong to a delivery region; the catalog, customers, discount codes and
+# stock stay on the primary database
+SHARDED_TABLES = frozenset(("orders", "order_pizzas", "order_drinks", "order_desserts", "payments", "deliveryperson"))
+# tables with autoincrement ids, started at the shard's id offset
+ID_TABLES = ("orders", "payments", "deliveryperson")
+# databases _start_ids knows how to start those ids on
+SHARD_BACKENDS = ("sqlite", "mysql", "mariadb")
+
+_current_shard = contextvars.ContextVar("current_shard", default=None)
+
+
+class NoShardSelected(RuntimeError):
+    pass
+
+
+def parse_shards(value):
+    """'0:1000=sqlite:///a.db,1:5000=sqlite:///b.db' -> (SQLALCHEMY_BINDS entries, SHARD_RANGES).
+
+    Each entry is <shard index>:<first postal code>=<database url>.
+    """
+    binds, ranges = {}, {}
+    for entry in (part.strip() for part in value.split(",") if part.strip()):
+        key, _, url = entry.partition("=")
+        index, _, first_postal_code = key.partition(":")
+        if not url or not first_postal_code or not index.strip().isdigit():
+            raise ValueError(f"Expected <shard index>:<first postal code>=<database url>, got {entry!r}")
+        bind_key = f"shard{int(index)}"
+        binds[bind_key] = url.strip()
+        ranges[first_postal_code.strip()] = (bind_key, int(index))
+    return binds, ranges
+
+
+def _shard_metadata(metadata):
+    """Copies of the sharded tables, without foreign keys to tables that stay on the primary."""
+    shard_metadata = MetaData()
+    for name in sorted(SHARDED_TABLES):
+        table = metadata.tables[name]
+        columns = [
+            Column(column.name, column.type.copy(),
+                   *[ForeignKey(fk.target_fullname) for fk in column.foreign_keys
+                     if fk.column.table.name in SHARDED_TABLES],
+                   primary_key=column.primary_key, nullable=column.nullable, index=column.index,
+                   unique=column.unique, autoincrement=column.autoincrement)
+            for column in table.columns
+        ]
+        Table(name, shard_metadata, *columns, sqlite_autoincrement=name in ID_TABLES)
+    return shard_metadata
+
+
+class ShardRouter:
+    """Splits orders, order lines, payments and drivers over one database per delivery region.
+
+    SHARD_RANGES maps the first postal code of each region to a SQLALCHEMY_BINDS
+    key and a shard index, e.g. {"1000": ("shard0", 0), "5000": ("shard1", 1)}; a
+    postal code belongs to the region with the greatest first code not above it
+    (compared as strings, so keep the codes the same length). A customer's orders
+    and the drivers of their zone always share a shard, because delivery only ever
+    matches within a postal code.
+
+    db.session sends statements on SHARDED_TABLES to the current shard: the one
+    selected with `using()`, otherwise the logged-in customer's. Code that needs
+    every region loops over `each()`, or runs a function on all shards at once with
+    `run_parallel()`. The shard with index i hands out ids from i * id_span + 1, so
+    ids stay unique across shards and `shard_for_id()` finds the shard of any order,
+    payment or driver. Indexes are fixed once a shard holds data: a new region gets
+    an unused index, wherever its postal codes sort.
+
+    Writes to several shards in one transaction are committed one database after
+    the other, not atomically. Without SHARD_RANGES everything stays on the
+    primary and the loops above run once, with shard None.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.shards = []
+        self._starts = []
+        self._indexes = {}
+        self._by_index = {}
+        self.id_span = 100_000_000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        ranges = app.config.get("SHARD_RANGES") or {}
+        self._starts = sorted(ranges)
+        self.shards = [ranges[start][0] for start in self._starts]
+        self._indexes = {bind_key: int(index) for bind_key, index in ranges.values()}
+        self._by_index = {index: bind_key for bind_key, index in self._indexes.items()}
+        self.id_span = app.config.get("SHARD_ID_SPAN", 100_000_000)
+        if len(self._indexes) != len(self.shards) or len(self._by_index) != len(self.shards):
+            raise ValueError("Every shard needs its own bind key and its own index in SHARD_RANGES")
+        if any(index < 0 for index in self._by_index):
+            raise ValueError("Shard indexes must not be negative")
+        binds = app.config.get("SQLALCHEMY_BINDS", {})
+        missing = [shard for shard in self.shards if shard not in binds]
+        if missing:
+            raise ValueError(f"Shards {', '.join(missing)} are not in SQLALCHEMY_BINDS")
+        for shard in self.shards:
+            url = binds[shard]["url"] if isinstance(binds[shard], dict) else binds[shard]
+            backend = make_url(url).get_backend_name()
+            if backend not in SHARD_BACKENDS:
+                raise ValueError(f"Shard {shard} is on {backend}; shards must be on {', '.join(SHARD_BACKENDS)}")
+
+        @app.before_request
+        def choose_shard():
+            if self.enabled and "user_id" in session:
+                g.shard = self.shard_for(self._session_postal_code())
+
+    @property
+    def enabled(self):
+        return bool(self.shards)
+
+    def _session_postal_code(self):
+        if "postal_code" not in session:
+            db = self.app.extensions["sqlalchemy"]
+            customers = db.metadata.tables["customers"]
+            session["postal_code"] = db.session.execute(
+                select(customers.c.postal_code).where(customers.c.id == session["user_id"])).scalar()
+        return session["postal_code"]
+
+    # choosing a shard
+
+    def shard_for(self, postal_code):
+        if not self.enabled:
+            return None
+        index = bisect.bisect_right(self._starts, (postal_code or "").strip()) - 1
+        return self.shards[max(index, 0)]
+
+    def shard_for_id(self, row_id):
+        """Shard holding the order, payment or driver with this id; None if no shard hands it out."""
+        if not self.enabled:
+            return None
+        return self._by_index.get(int(row_id) // self.id_span)
+
+    def split_ids(self, ids):
+        """{shard: ids} for ids of sharded rows, or {None: ids} when sharding is off.
+
+        Ids that belong to no shard are left out.
+        """
+        groups = defaultdict(list)
+        for row_id in ids:
+            shard = self.shard_for_id(row_id)
+            if shard is not None or not self.enabled:
+                groups[shard].append(row_id)
+        return groups
+
+    def current(self):
+        shard = _current_shard.get()
+        if shard is None and has_request_context():
+            shard = g.get("shard")
+        return shard
+
+    @contextmanager
+    def using(self, shard):
+        token = _current_shard.set(shard)
+        try:
+            yield shard
+        finally:
+            _current_shard.reset(token)
+
+    def each(self):
+        """Yield every shard while it is selected, so a for loop body runs once per shard."""
+        for shard in self.shards or [None]:
+            with self.using(shard):
+                yield shard
+
+    def run_parallel(self, fn):
+        """fn(shard) for every shard at once, each in its own thread, app context and session."""
+        if not self.enabled:
+            return [fn(None)]
+
+        def run(shard):
+            with self.app.app_context(), self.using(shard):
+                return fn(shard)
+
+        with ThreadPoolExecutor(len(self.shards), thread_name_prefix="shard") as pool:
+            return list(pool.map(run, self.shards))
+
+    def bind_for(self, mapper=None, clause=None):
+        """Bind key for a statement on a sharded table, None for everything else."""
+        if not self.enabled:
+            return None
+        if mapper is not None:
+            table = inspect(mapper).local_table
+        else:
+            table = clause if isinstance(clause, Table) else getattr(clause, "table", None)
+        name = getattr(table, "name", None)
+        if name not in SHARDED_TABLES:
+            return None
+        shard = self.current()
+        if shard is None:
+            raise NoShardSelected(f"No shard selected for a statement on {name}; wrap it in shard_router.using().")
+        return shard
+
+    # schema
+
+    def create_all(self):
+        """Create the sharded tables on every shard; new tables start at the shard's id offset."""
+        db = self.app.extensions["sqlalchemy"]
+        metadata = _shard_metadata(db.metadata)
+        for shard in self.shards:
+            engine = db.engines[shard]
+            existing = set(inspect(engine).get_table_names())
+            metadata.create_all(engine)
+            offset = self._indexes[shard] * self.id_span
+            if not offset:
+                continue
+            with engine.begin() as connection:
+                for name in ID_TABLES:
+                    if name not in existing:
+                        self._start_ids(connection, name, offset)
+
+    @staticmethod
+    def _start_ids(connection, table, offset):
+        dialect = connection.dialect.name
+        if dialect == "sqlite":
+            connection.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table})
+            connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                               {"name": table, "seq": offset})
+        elif dialect in ("mysql", "mariadb"):
+            connection.execute(text(f"ALTER TABLE {table} AUTO_INCREMENT = {offset + 1}"))
+        else:
+            raise NotImplementedError(f"Cannot set the first id of {table} on {dialect}")
+
+
+shard_router = ShardRouter()
@@ -0,0 +1,172 @@
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from Model import db, Customer, Order, OrderPizza, Pizza
+from Archive import archive, LINE_PIZZA, STATUS_CODE, from_seconds
+from Sharding import shard_router
+
+
+class SpaceSaving:
+    """Space-Saving heavy-hitters sketch: keeps at most `capacity` counters.
+
+    When a new key arrives and the sketch is full, the smallest counter is handed
+    over to it, so counts can overestimate by at most that evicted value.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            self.counts[key] = self.counts.pop(victim) + count
+
+    def items(self):
+        return self.counts.items()
+
+
+def _count(counter, key, quantity):
+    if isinstance(counter, Counter):
+        counter[key] += quantity
+    else:
+        counter.add(key, quantity)
+
+
+class _DayBucket:
+    def __init__(self, day, make_counter):
+        self.day = day
+        self.totals = make_counter()
+        self.by_postal_code = {}
+
+
+class SlidingTopSellers:
+    """Pizzas sold per day in a ring buffer covering the last `window_days` days.
+
+    Delivered orders are added as they are delivered, so top-N for any window up to
+    `window_days` (overall, per postal code or per category) is a sum over at most
+    that many small counters instead of a join over orders and order lines.
+    With `sketch_capacity` set, every day keeps a Space-Saving sketch instead of an
+    exact counter, which bounds memory for large catalogs.
+    """
+
+    def __init__(self, app=None):
+        self.window_days = 90
+        self.sketch_capacity = None
+        self._buckets = []
+        self._pizzas = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window_days = app.config.get("TOP_SELLERS_WINDOW_DAYS", 90)
+        self.sketch_capacity = app.config.get("TOP_SELLERS_SKETCH_CAPACITY")
+        self._buckets = [None] * self.window_days
+
+    def _new_counter(self):
+        return SpaceSaving(self.sketch_capacity) if self.sketch_capacity else Counter()
+
+    def _add(self, day, pizza_id, quantity, postal_code):
+        ordinal = day.toordinal()
+        if ordinal <= datetime.utcnow().date().toordinal() - self.window_days:
+            return
+        slot = ordinal % self.window_days
+        bucket = self._buckets[slot]
+        if bucket is None or bucket.day < ordinal:
+            bucket = self._buckets[slot] = _DayBucket(ordinal, self._new_counter)
+        elif bucket.day > ordinal:
+            return
+        _count(bucket.totals, pizza_id, quantity)
+        if postal_code is not None:
+            if postal_code not in bucket.by_postal_code:
+                bucket.by_postal_code[postal_code] = self._new_counter()
+            _count(bucket.by_postal_code[postal_code], pizza_id, quantity)
+
+    def _load_pizzas(self):
+        self._pizzas = {
+            pizza_id: (name, category or "Normal")
+            for pizza_id, name, category in db.session.execute(
+                select(Pizza.id, Pizza.pizza_name, Pizza.category)).all()
+        }
+
+    def rebuild(self):
+        """Reload the window from delivered orders in the database and the archive."""
+        start = datetime.utcnow().date() - timedelta(days=self.window_days - 1)
+        since = datetime(start.year, start.month, start.day)
+
+        rows = []
+        for _ in shard_router.each():
+            rows.extend(db.session.execute(
+                select(Order.order_date, Order.customer_id, OrderPizza.pizza_id, OrderPizza.quantity)
+                .join(OrderPizza, Order.id == OrderPizza.order_id)
+                .where(Order.status == "DELIVERED", Order.order_date >= since)
+            ).all())
+
+        orders = archive.scan("orders", since=since)
+        lines = archive.scan("lines", since=since)
+        by_id = {
+            int(order_id): (from_seconds(order_date), int(customer_id))
+            for order_id, order_date, customer_id, status in zip(
+                orders["id"], orders["order_date"], orders["customer_id"], orders["status"])
+            if status == STATUS_CODE["DELIVERED"] and order_date >= 0
+        }
+        for order_id, kind, pizza_id, quantity in zip(
+                lines["order_id"], lines["kind"], lines["item_id"], lines["quantity"]):
+            if kind == LINE_PIZZA and int(order_id) in by_id:
+                order_date, customer_id = by_id[int(order_id)]
+                rows.append((order_date, customer_id, int(pizza_id), int(quantity)))
+
+        postal_codes = {}
+        customer_list = list({row[1] for row in rows})
+        for start_index in range(0, len(customer_list), 1000):
+            chunk = customer_list[start_index:start_index + 1000]
+            postal_codes.update(db.session.execute(
+                select(Customer.id, Customer.postal_code).where(Customer.id.in_(chunk))).all())
+
+        with self._lock:
+            self._buckets = [None] * self.window_days
+            for order_date, customer_id, pizza_id, quantity in rows:
+                if order_date >= since:
+                    self._add(order_date.date(), pizza_id, quantity, postal_codes.get(customer_id))
+            self._load_pizzas()
+
+    def record_order(self, order):
+        """Count a freshly delivered order."""
+        postal_code = order.customer.postal_code if order.customer else None
+        with self._lock:
+            for assoc in order.pizzas:
+                self._add(order.order_date.date(), assoc.pizza_id, assoc.quantity, postal_code)
+                if assoc.pizza_id not in self._pizzas:
+                    self._pizzas[assoc.pizza_id] = (assoc.pizza.pizza_name, assoc.pizza.category or "Normal")
+
+    def top(self, limit=3, days=30, postal_code=None, category=None):
+        days = min(days, self.window_days)
+        first_day = datetime.utcnow().date().toordinal() - days
+        totals = Counter()
+        with self._lock:
+            for bucket in self._buckets:
+                if bucket is None or bucket.day <= first_day:
+                    continue
+                counter = bucket.totals if postal_code is None else bucket.by_postal_code.get(postal_code)
+                if counter is not None:
+                    totals.update(dict(counter.items()))
+            pizzas = dict(self._pizzas)
+
+        if category is not None:
+            totals = Counter({pid: qty for pid, qty in totals.items()
+                              if pizzas.get(pid, ("", "Normal"))[1] == category})
+        return [
+            {"pizza_name": pizzas.get(pid, (f"#{pid}",))[0], "total_quantity_sold": qty}
+            for pid, qty in totals.most_common(limit)
+        ]
+
+
+top_sellers = SlidingTopSellers()
@@ -1,13 +1,33 @@
-from flask import render_template, Blueprint, session, redirect, url_for, request, flash
+from flask import (
+    render_template, Blueprint, session, redirect, url_for, request, flash, make_response, abort, Response,
+    jsonify
+)
 from Model import (
     Pizza, Dessert, Drink, Order, db, Customer, DeliveryPerson, OrderPizza, OrderDessert,
     OrderDrink, Payment  # <-- Import Payment
 )
 from DiscountAndLoyaltyManager import DiscountAndLoyaltyManager
+from Analytics import analytics, CATEGORIES
+from TopSellers import top_sellers
+from ResponseCache import response_cache
+from Demographics import demographics
+from Archive import archive, LINE_PIZZA, LINE_DRINK, LINE_DESSERT
+from OrderEvents import order_events
+from BulkOrders import bulk_orders, LINE_KINDS
+from GroupCommit import group_commit
+from CustomerSearch import customer_search
+from DeliveryEta import delivery_eta
+from ReadReplica import read_replica
+from Sharding import shard_router
+from PricingRules import pricing
+from Inventory import inventory, OutOfStock
+from CustomPizzas import pizza_builder
+from Profiler import profiler
+from AdmissionControl import admission
 from datetime import datetime, timedelta, timezone
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy import func
 from functools import wraps
-from sqlalchemy import func, desc,text
 
 bp = Blueprint("main", __name__)
 
@@ -79,6 +99,7 @@ def register():
 
             db.session.add(new_customer)
             db.session.commit()
+            demographics.note_postal_code(postal_code)
 
             flash("Registration successful! Please log in.", "success")
             return redirect(url_for("main.login"))
@@ -105,6 +126,7 @@ def login():
 
         if customer and customer.check_password(password):
             session["user_id"] = customer.id
+            session["postal_code"] = customer.postal_code  # picks the customer's shard
             flash("Logged in successfully!", "success")
             return redirect(url_for("main.home"))
         else:
@@ -114,6 +136,7 @@ def login():
 @bp.route("/logout")
 def logout():
     session.pop("user_id", None)
+    session.pop("postal_code", None)
 
     flash("You have been logged out.", "info")
     return redirect(url_for("main.login"))
@@ -122,13 +145,15 @@ def logout():
 @bp.route("/menu", methods=["GET", "POST"])
 @login_required
 def menu():
-    pizzas = Pizza.query.all()
-    desserts = Dessert.query.all()
-    drinks = Drink.query.all()
+    # only evaluated when the cached product grid has to be rendered again
+    pizzas = Pizza.query.options(selectinload(Pizza.ingredients)).filter(Pizza.is_custom.is_(False)).order_by(Pizza.id)
+    desserts = Dessert.query.order_by(Dessert.id)
+    drinks = Drink.query.order_by(Drink.id)
 
     basket = get_basket()
     basket_items = []
     subtotal = 0.0
+    plan = pricing.plan
     current_customer_id = session.get('user_id')
     customer = Customer.query.get(current_customer_id)
 
@@ -138,7 +163,7 @@ def menu():
             for pid, qty in items_in_basket.items():
                 pizza = Pizza.query.get(int(pid))
                 if pizza:
-                    price = pizza.final_amount() * qty
+                    price = pizza.final_amount(plan) * qty
                     basket_items.append({
                         "id": pid, "type": "pizzas",
                         "name": pizza.pizza_name,
@@ -204,7 +229,8 @@ def menu():
                         OrderDessert(dessert=dessert, quantity=qty)
                     )
 
-        manager = DiscountAndLoyaltyManager(customer, temp_order_for_discounts, discount_code_input)
+        manager = DiscountAndLoyaltyManager(
+            customer, temp_order_for_discounts, discount_code_input, redeem=False, plan=plan)
         final_total, applied_discounts = manager.apply_all_discounts(db.session)
         invalid_code = manager.invalid_code
 
@@ -214,6 +240,8 @@ def menu():
     return render_template(
         "menu.html",
         pizzas=pizzas,
+        unavailable_pizzas=inventory.unavailable_pizza_ids(),
+        sold_out_key=inventory.sold_out_key(),
         desserts=desserts,
         drinks=drinks,
         basket_items=basket_items,
@@ -225,9 +253,47 @@ def menu():
     )
 
 
+@bp.route("/build_pizza", methods=["GET", "POST"])
+@login_required
+def build_pizza():
+    selected_ids = request.form.getlist("ingredient_ids", type=int)
+    quote = None
+    if request.method == "POST":
+        try:
+            mask = pizza_builder.mask_for(selected_ids)
+        except ValueError as e:
+            flash(str(e), "warning")
+        else:
+            if request.form.get("action") != "add":
+                price, category, names = pizza_builder.quote(mask)
+                quote = {"price": price, "category": category, "names": names}
+            else:
+                if inventory.sold_out_ingredients(selected_ids):
+                    flash("Sorry, one of these ingredients is sold out.", "warning")
+                    return redirect(url_for("main.build_pizza"))
+                pizza = pizza_builder.get_or_create(mask)
+                db.session.commit()
+                basket = get_basket()
+                basket["pizzas"][str(pizza.id)] = basket["pizzas"].get(str(pizza.id), 0) + 1
+                session["basket"] = basket
+                flash(f"{pizza.pizza_name} added to basket!", "success")
+                return redirect(url_for("main.menu"))
+
+    return render_template(
+        "build_pizza.html",
+        ingredients=pizza_builder.available_ingredients(),
+        selected_ids=set(selected_ids),
+        quote=quote,
+        base_price=pizza_builder.base_price,
+    )
+
+
 @bp.route("/add_to_basket/<item_type>/<int:item_id>", methods=["GET"])
 @login_required
 def add_to_basket(item_type, item_id):
+    if item_type == "pizzas" and not inventory.is_available(item_id):
+        flash("Sorry, this pizza is sold out.", "warning")
+        return redirect(url_for("main.menu"))
     basket = get_basket()
     key = str(item_id)
     basket[item_type][key] = basket[item_type].get(key, 0) + 1
@@ -270,6 +336,8 @@ def checkout():
         return redirect(url_for("main.login"))
 
     discount_code_input = request.form.get("discount_code")
+    if group_commit.enabled:
+        return _checkout_grouped(customer, basket, discount_code_input)
 
     new_order = Order(customer=customer)
     db.session.add(new_order)
@@ -282,7 +350,7 @@ def checkout():
         for pid, qty in basket["pizzas"].items():
             pizza = Pizza.query.get(int(pid))
             if pizza:
-                order_pizza_assoc = OrderPizza(pizza=pizza, quantity=qty)
+                order_pizza_assoc = OrderPizza(pizza=pizza, quantity=qty, unit_price=pizza.final_amount())
                 new_order.pizzas.append(order_pizza_assoc)
             else:
                 raise ValueError(f"Pizza with ID {pid} not found.")
@@ -304,41 +372,157 @@ def checkout():
                 raise ValueError(f"Dessert with ID {desid} not found.")
 
 
+        needs = inventory.needs_for(basket["pizzas"])
+        inventory.reserve(db.session, needs)
+        inventory.record_reservations(db.session, {new_order.id: needs})
+
         manager = DiscountAndLoyaltyManager(customer, new_order, discount_code_input)
         final_total, applied_discounts = manager.apply_all_discounts(db.session)
+        _flash_discounts(applied_discounts)
 
 
         new_payment = Payment(order_id=new_order.id, amount=final_total)
         db.session.add(new_payment)
 
 
+        now = datetime.utcnow()
         available_delivery_person = DeliveryPerson.query.filter(
             DeliveryPerson.postal_code == customer.postal_code,
-            DeliveryPerson.available_at <= datetime.utcnow()
+            DeliveryPerson.available_at <= now
         ).order_by(DeliveryPerson.available_at.asc()).first()
 
         if available_delivery_person:
             new_order.delivery_person = available_delivery_person
             new_order.status = "OUT_FOR_DELIVERY"
-            available_delivery_person.available_at = datetime.utcnow() + timedelta(minutes=30)
-            new_order.estimated_delivery_time = datetime.utcnow() + timedelta(minutes=30)
+            new_order.dispatched_at = now
+            new_order.estimated_delivery_time, available_delivery_person.available_at = (
+                delivery_eta.dispatch(customer.postal_code, now))
             flash(f"Order placed successfully! Delivery assigned to {available_delivery_person.first_name}.", "success")
         else:
             new_order.status = "PENDING_ASSIGNMENT"
-            new_order.estimated_delivery_time = datetime.utcnow() + timedelta(minutes=60)
+            new_order.estimated_delivery_time = delivery_eta.pending(customer.postal_code, now)
             flash("Order placed, but no delivery person is immediately available. Expect slight delay.", "warning")
 
         db.session.commit()
+        order_events.publish(new_order)
         session.pop("basket", None)
         session["last_order_id"] = new_order.id
         return redirect(url_for("main.confirmation"))
 
+    except OutOfStock as e:
+        db.session.rollback()
+        flash(str(e), "warning")
+        return redirect(url_for("main.menu"))
     except Exception as e:
         db.session.rollback()
         flash(f"Error placing order: {e}", "danger")
         return redirect(url_for("main.menu"))
 
 
+def _flash_discounts(discounts):
+    for label in discounts:
+        flash(label, "warning" if label.startswith("❌") else "info")
+
+
+def _checkout_grouped(customer, basket, discount_code):
+    """Checkout through the group-commit writer, committed together with concurrent checkouts."""
+    order_request = {"customer_id": customer.id, "discount_code": discount_code or None}
+    order_request.update((kind, basket[kind]) for kind in LINE_KINDS)
+    db.session.rollback()  # hand the connection back while the writer works
+
+    result = group_commit.place(order_request)
+    if result is None:
+        flash("We are very busy right now and could not place your order, please try again.", "danger")
+        return redirect(url_for("main.menu"))
+    if not result["ok"]:
+        flash(f"Error placing order: {result['error']}", "danger")
+        return redirect(url_for("main.menu"))
+
+    _flash_discounts(result["discounts"])
+    if result["delivery_person_id"]:
+        driver = db.session.get(DeliveryPerson, result["delivery_person_id"])
+        flash(f"Order placed successfully! Delivery assigned to {driver.first_name}.", "success")
+    else:
+        flash("Order placed, but no delivery person is immediately available. Expect slight delay.", "warning")
+    read_replica.note_write()  # committed by the writer thread, outside this request
+    session.pop("basket", None)
+    session["last_order_id"] = result["order_id"]
+    return redirect(url_for("main.confirmation"))
+
+
+@bp.route("/api/orders/batch", methods=["POST"])
+@login_required
+def batch_orders():
+    customer = Customer.query.get(session.get("user_id"))
+    if not customer or not customer.is_staff:
+        return jsonify({"error": "Staff members only."}), 403
+
+    payload = request.get_json(silent=True)
+    orders = payload.get("orders") if isinstance(payload, dict) else None
+    if not isinstance(orders, list) or not orders:
+        return jsonify({"error": "Expected a JSON body with a non-empty 'orders' list."}), 400
+    if len(orders) > bulk_orders.max_batch:
+        return jsonify({"error": f"At most {bulk_orders.max_batch} orders per batch."}), 413
+
+    try:
+        results = bulk_orders.place(orders)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error placing orders: {e}"}), 500
+
+    placed = sum(1 for result in results if result["ok"])
+    status = 201 if placed == len(results) else 207 if placed else 422
+    return jsonify({"placed": placed, "failed": len(results) - placed, "results": results}), status
+
+
+@bp.route("/staff/customers/search")
+@login_required
+def staff_customer_search():
+    customer = Customer.query.get(session.get("user_id"))
+    if not customer or not customer.is_staff:
+        return jsonify({"error": "Staff members only."}), 403
+
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", type=int)
+    return jsonify({"query": query, "customers": customer_search.search(query, limit)})
+
+
+@bp.route("/staff/profiler", methods=["GET", "POST"])
+@login_required
+def staff_profiler():
+    customer = Customer.query.get(session.get("user_id"))
+    if not customer or not customer.is_staff:
+        return jsonify({"error": "Staff members only."}), 403
+
+    if request.method == "POST":
+        settings = request.get_json(silent=True) or request.form
+        action = settings.get("action", "start")
+        try:
+            if action == "start":
+                profiler.configure(settings.get("sample_rate", 0.0), settings.get("endpoint"))
+            elif action == "stop":
+                profiler.configure(0.0, None)
+            elif action == "export":
+                return jsonify({**profiler.stats(), "written": profiler.export()})
+            elif action == "reset":
+                profiler.reset()
+            else:
+                return jsonify({"error": f"Unknown action {action!r}."}), 400
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(profiler.stats())
+
+
+@bp.route("/staff/admission")
+@login_required
+def staff_admission():
+    customer = Customer.query.get(session.get("user_id"))
+    if not customer or not customer.is_staff:
+        return jsonify({"error": "Staff members only."}), 403
+    return jsonify(admission.stats())
+
+
 @bp.route("/cancel_order/<int:order_id>", methods=["POST"])
 @login_required
 def cancel_order(order_id):
@@ -360,11 +544,45 @@ def cancel_order(order_id):
         return redirect(url_for('main.confirmation'))
 
     order.status = "CANCELLED"
+    inventory.release(db.session, order.id)
     db.session.commit()
+    order_events.publish(order)
     flash("Your order has been successfully cancelled.", "success")
 
     return redirect(url_for('main.confirmation'))
 
+@bp.route("/orders/<int:order_id>/delivered", methods=["POST"])
+@login_required
+def confirm_delivery(order_id):
+    customer = Customer.query.get(session.get("user_id"))
+    if not customer or not customer.is_staff:
+        return jsonify({"error": "Staff members only."}), 403
+
+    with shard_router.using(shard_router.shard_for_id(order_id)):
+        order = Order.query.options(
+            selectinload(Order.customer), joinedload(Order.delivery_person)).get_or_404(order_id)
+        if order.status != "OUT_FOR_DELIVERY":
+            return jsonify({"error": f"Order {order_id} is not out for delivery."}), 409
+
+        now = datetime.utcnow()
+        order.status = "DELIVERED"
+        order.delivered_at = now
+        # drivers are booked for a typical trip, so rebook this one around the real delivery,
+        # unless they already took another order
+        if order.delivery_person and not Order.query.filter(
+                Order.delivery_person_id == order.delivery_person.id, Order.status == "OUT_FOR_DELIVERY",
+                Order.id != order.id).first():
+            order.delivery_person.available_at = now + delivery_eta.return_trip(order.customer.postal_code, now)
+        db.session.commit()
+        delivery_eta.record(order.customer.postal_code, order.dispatched_at, now)
+        top_sellers.record_order(order)
+        response_cache.bump_reports()  # a report built since the commit may lack this order's pizzas
+        order_events.publish(order)
+        return jsonify({"order_id": order.id, "status": order.status,
+                        "minutes": round((now - order.dispatched_at).total_seconds() / 60, 1)
+                        if order.dispatched_at else None})
+
+
 @bp.route("/confirmation")
 @login_required
 def confirmation():
@@ -374,10 +592,11 @@ def confirmation():
         return redirect(url_for("main.home"))
 
 
+    # customers and discount codes stay on the primary when orders are sharded, so no joins to them
     order = Order.query.options(
-        joinedload(Order.customer),
+        selectinload(Order.customer),
         joinedload(Order.delivery_person),
-        joinedload(Order.discount),
+        selectinload(Order.discount),
         joinedload(Order.pizzas),
         joinedload(Order.drinks),
         joinedload(Order.desserts)
@@ -413,8 +632,77 @@ def confirmation():
         dessert_items_with_qty=dessert_items_with_qty,
         delivery_person=order.delivery_person,
         estimated_delivery_time=order.estimated_delivery_time.strftime("%H:%M") if order.estimated_delivery_time else "N/A",
-        is_cancellable = is_cancellable
+        is_cancellable = is_cancellable,
+        last_event_id=order_events.last_event_id(order.id)
+    )
+
+
+@bp.route("/orders/<int:order_id>/events")
+@login_required
+def order_events_stream(order_id):
+    owner_id = db.session.query(Order.customer_id).filter(Order.id == order_id).scalar()
+    if owner_id is None or owner_id != session.get("user_id"):
+        abort(404)
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("since") or 0
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        last_event_id = 0
+
+    # the stream outlives the request context, so it must not hold a database connection
+    db.session.close()
+    return Response(
+        order_events.stream(order_id, last_event_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@bp.route("/orders/history")
+@login_required
+def order_history():
+    customer_id = session.get("user_id")
+
+    live_orders = (
+        Order.query
+        .filter_by(customer_id=customer_id)
+        .options(
+            selectinload(Order.pizzas).selectinload(OrderPizza.pizza),
+            selectinload(Order.drinks).selectinload(OrderDrink.drink),
+            selectinload(Order.desserts).selectinload(OrderDessert.dessert)
+        )
+        .all()
     )
+    paid = dict(
+        db.session.query(Payment.order_id, func.sum(Payment.amount))
+        .filter(Payment.order_id.in_([order.id for order in live_orders]))
+        .group_by(Payment.order_id)
+        .all()
+    ) if live_orders else {}
+
+    orders = []
+    for order in live_orders:
+        items = [f"{a.quantity}× {a.pizza.pizza_name}" for a in order.pizzas]
+        items += [f"{a.quantity}× {a.drink.drink_name}" for a in order.drinks]
+        items += [f"{a.quantity}× {a.dessert.dessert_name}" for a in order.desserts]
+        orders.append({"id": order.id, "order_date": order.order_date, "status": order.status,
+                       "amount": paid.get(order.id, 0.0), "items": items})
+
+    # older finished orders live in the archive files
+    archived_orders = archive.customer_orders(customer_id)
+    if archived_orders:
+        names = {
+            LINE_PIZZA: dict(db.session.query(Pizza.id, Pizza.pizza_name).all()),
+            LINE_DRINK: dict(db.session.query(Drink.id, Drink.drink_name).all()),
+            LINE_DESSERT: dict(db.session.query(Dessert.id, Dessert.dessert_name).all()),
+        }
+        for record in archived_orders:
+            items = [f"{qty}× {names[kind].get(item_id, 'Unknown item')}" for kind, item_id, qty in record["lines"]]
+            orders.append({"id": record["id"], "order_date": record["order_date"], "status": record["status"],
+                           "amount": record["amount"], "items": items})
+
+    orders.sort(key=lambda o: o["order_date"] or datetime.min, reverse=True)
+    return render_template("order_history.html", orders=orders)
 
 @bp.route("/staff_reports")
 @login_required
@@ -432,75 +720,99 @@ def staff_reports():
     age_group_filter = request.args.get('age_group', 'all')
     postal_code_filter = request.args.get('postal_code', 'all')
 
-    earnings_query = db.session.query(
-        Customer.postal_code,
-        func.sum(Payment.amount).label("total_earnings")
-    ).join(Order, Customer.id == Order.customer_id).join(Payment, Order.id == Payment.order_id)
-
-    earnings_query = earnings_query.filter(Order.status == "DELIVERED")
-
-    today = datetime.utcnow().date()
-    if timespan_filter == 'week':
-        start_date = today - timedelta(days=today.weekday())
-        earnings_query = earnings_query.filter(Order.order_date >= start_date)
-    elif timespan_filter == 'month':
-        start_date = today.replace(day=1)
-        earnings_query = earnings_query.filter(Order.order_date >= start_date)
-
-    if gender_filter and gender_filter != 'all':
-        earnings_query = earnings_query.filter(Customer.gender == gender_filter)
-
-    if postal_code_filter and postal_code_filter != 'all':
-        earnings_query = earnings_query.filter(Customer.postal_code == postal_code_filter)
-
-    if age_group_filter and age_group_filter != 'all':
-
-        age = func.timestampdiff(text('YEAR'), Customer.birthdate, func.curdate())
-        if age_group_filter == '18-25':
-            earnings_query = earnings_query.filter(age.between(18, 25))
-        elif age_group_filter == '26-40':
-            earnings_query = earnings_query.filter(age.between(26, 40))
-        elif age_group_filter == '41-60':
-            earnings_query = earnings_query.filter(age.between(41, 60))
-        elif age_group_filter == '60+':
-            earnings_query = earnings_query.filter(age >= 60)
-
-    earnings_by_postal_code = earnings_query.group_by(Customer.postal_code).order_by(Customer.postal_code).all()
-    # Undelivered Orders
-    undelivered_orders = (
-        Order.query
-        .filter(Order.status != "DELIVERED")
-        .options(joinedload(Order.customer), joinedload(Order.delivery_person))
-        .all()
-    )
-
-    # Top 3 pizzas sold in the past month
-    one_month_ago = datetime.utcnow() - timedelta(days=30)
-    top_pizzas = (
-        db.session.query(
-            Pizza.pizza_name,
-            func.sum(OrderPizza.quantity).label("total_quantity_sold")
-        )
-        .join(OrderPizza, Pizza.id == OrderPizza.pizza_id)
-        .join(Order, Order.id == OrderPizza.order_id)
-        .filter(Order.order_date >= one_month_ago, Order.status == "DELIVERED")
-        .group_by(Pizza.pizza_name)
-        .order_by(desc("total_quantity_sold"))
-        .limit(3)
-        .all()
-    )
-
-    all_postal_codes = db.session.query(Customer.postal_code).distinct().order_by(Customer.postal_code).all()
-    all_postal_codes = [pc[0] for pc in all_postal_codes]
-
-    return render_template(
+    now = datetime.utcnow()
+    cache_key = response_cache.report_key(
+        timespan_filter, gender_filter, age_group_filter, postal_code_filter, now.date())
+    etag = response_cache.etag_for(cache_key)
+
+    # pending flash messages are part of the page, so those responses are never 304
+    if "_flashes" not in session:
+        if etag in request.if_none_match:
+            not_modified = make_response("", 304)
+            not_modified.set_etag(etag)
+            return not_modified
+
+    report = response_cache.get_report(cache_key)
+    # a report read from a lagging replica may be older than the versions in the key,
+    # so it is neither cached nor given the key's ETag
+    cacheable = report is not None or not read_replica.active()
+    if report is None:
+        report = _build_staff_report(now, timespan_filter, gender_filter, age_group_filter, postal_code_filter)
+        if cacheable:
+            response_cache.put_report(cache_key, report)
+
+    response = make_response(render_template(
         "staff_reports.html",
-        undelivered_orders=undelivered_orders,
-        top_pizzas=top_pizzas,
-        earnings_by_postal_code=earnings_by_postal_code,
         current_timespan=timespan_filter,
         current_gender=gender_filter,
         current_age_group=age_group_filter,
         current_postal_code=postal_code_filter,
-        all_postal_codes=all_postal_codes
-    )
\ No newline at end of file
+        **report
+    ))
+    if cacheable:
+        response.set_etag(etag)
+        response.last_modified = response_cache.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _build_staff_report(now, timespan_filter, gender_filter, age_group_filter, postal_code_filter):
+    analytics.refresh_in_background()
+    today = now.date()
+
+    earnings_by_postal_code = analytics.earnings_by_postal_code(
+        timespan_filter, gender_filter, age_group_filter, postal_code_filter, today)
+
+    # Undelivered Orders, gathered from the shard of each id
+    undelivered_orders = []
+    for shard, undelivered_ids in shard_router.split_ids(analytics.undelivered_order_ids()).items():
+        with shard_router.using(shard):
+            undelivered_orders += (
+                Order.query
+                .filter(Order.id.in_(undelivered_ids))
+                .options(selectinload(Order.customer), joinedload(Order.delivery_person))
+                .all()
+            )
+    undelivered_orders.sort(key=lambda order: order.id)
+    # plain values, the cached report outlives the session that loaded the orders
+    undelivered_orders = [
+        {
+            "id": order.id,
+            "customer": {"first_name": order.customer.first_name, "last_name": order.customer.last_name},
+            "status": order.status,
+            "delivery_person": {
+                "first_name": order.delivery_person.first_name,
+                "last_name": order.delivery_person.last_name,
+            } if order.delivery_person else None,
+            "order_date": order.order_date,
+        }
+        for order in undelivered_orders
+    ]
+
+    # Top 3 pizzas sold in the past month
+    top_pizzas = top_sellers.top(3, days=30)
+    top_pizzas_in_postal_code = (
+        top_sellers.top(3, days=30, postal_code=postal_code_filter)
+        if postal_code_filter and postal_code_filter != 'all' else None
+    )
+    top_pizzas_by_category = {category: top_sellers.top(3, days=30, category=category) for category in CATEGORIES}
+
+    birthdays_today = [
+        {"first_name": c.first_name, "last_name": c.last_name, "phone_number": c.phone_number,
+         "postal_code": c.postal_code}
+        for c in demographics.birthdays_today(today)
+    ]
+
+    return {
+        "undelivered_orders": undelivered_orders,
+        "top_pizzas": top_pizzas,
+        "top_pizzas_in_postal_code": top_pizzas_in_postal_code,
+        "top_pizzas_by_category": top_pizzas_by_category,
+        "earnings_by_postal_code": earnings_by_postal_code,
+        "revenue_by_pizza": analytics.revenue_by_pizza(timespan_filter, today),
+        "hourly_heatmap": analytics.hourly_heatmap(timespan_filter, today),
+        "age_group_by_category": analytics.age_group_by_category(timespan_filter, today),
+        "birthdays_today": birthdays_today,
+        "all_postal_codes": demographics.postal_codes(),
+    }